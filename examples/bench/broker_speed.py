@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of request brokers:
+
+    examples/bench/broker_speed.py --broker=txzmq --count=20000
+    examples/bench/broker_speed.py --broker=device --count=20000
+
+Broker runs in separate process, either ZmqBroker (txzmq) or native
+zmq.device(QUEUE) (device); client sending requests (at most --window of
+them at once) and echoing workers run in this process.
+"""
+import multiprocessing
+import os
+import sys
+import time
+from optparse import OptionParser
+
+rootdir = os.path.realpath(os.path.join(
+    os.path.dirname(sys.argv[0]), '..', '..'))
+sys.path.insert(0, rootdir)
+os.chdir(rootdir)
+
+import zmq
+
+from twisted.internet import defer, reactor
+
+from txzmq import ZmqEndpoint, ZmqFactory, ZmqXREQConnection
+from txzmq.broker import ZmqBroker, ZmqBrokerWorkerConnection
+from txzmq.xreq_xrep import ZmqXREPConnection
+
+
+parser = OptionParser("")
+parser.add_option("-b", "--broker", dest="broker", type="choice",
+                  choices=("txzmq", "device"), help="Broker")
+parser.add_option("-c", "--count", dest="count", type="int",
+                  help="Number of requests")
+parser.add_option("-w", "--workers", dest="workers", type="int",
+                  help="Number of workers")
+parser.add_option("-W", "--window", dest="window", type="int",
+                  help="Number of requests in flight")
+parser.add_option("-s", "--size", dest="size", type="int",
+                  help="Request size in bytes")
+parser.set_defaults(broker="txzmq", count=20000, workers=4, window=100,
+                    size=100)
+(options, args) = parser.parse_args()
+
+FRONTEND = "tcp://127.0.0.1:5701"
+BACKEND = "tcp://127.0.0.1:5702"
+
+
+def runBroker():
+    if options.broker == "device":
+        context = zmq.Context()
+        frontend = context.socket(zmq.XREP)
+        frontend.bind(FRONTEND)
+        backend = context.socket(zmq.XREQ)
+        backend.bind(BACKEND)
+        zmq.device(zmq.QUEUE, frontend, backend)
+    else:
+        ZmqBroker([ZmqEndpoint("bind", FRONTEND)],
+                  [ZmqEndpoint("bind", BACKEND)]).listen(ZmqFactory())
+        reactor.run()
+
+
+class DeviceWorker(ZmqXREPConnection):
+    autoReply = True
+
+    def gotMessage(self, message_id, *message_parts):
+        return message_parts
+
+
+class BrokerWorker(ZmqBrokerWorkerConnection):
+    autoReply = True
+    capacity = options.window
+
+    def gotMessage(self, message_id, *message_parts):
+        return message_parts
+
+
+@defer.inlineCallbacks
+def run(factory):
+    client = ZmqXREQConnection(ZmqEndpoint("connect", FRONTEND))
+    client.maxPendingRequests = options.window
+    client.maxWaitingRequests = None
+    client.connect(factory)
+    workerClass = DeviceWorker if options.broker == "device" else BrokerWorker
+    for i in xrange(options.workers):
+        worker = workerClass(ZmqEndpoint("connect", BACKEND))
+        worker.identity = "worker%d" % (i,)
+        worker.connect(factory)
+
+    # warm up connections
+    yield client.sendMsg("ping")
+    request = "x" * options.size
+    start = time.time()
+    yield defer.DeferredList(
+        [client.sendMsg(request) for i in xrange(options.count)])
+    elapsed = time.time() - start
+    print "%-6s %d workers %8.0f requests/s" % (
+        options.broker, options.workers, options.count / elapsed)
+    reactor.stop()
+
+
+broker = multiprocessing.Process(target=runBroker)
+broker.daemon = True
+broker.start()
+try:
+    time.sleep(0.5)
+    factory = ZmqFactory()
+    reactor.callWhenRunning(run, factory)
+    reactor.run()
+    factory.shutdown()
+finally:
+    broker.terminate()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of txZMQ payload codecs:
+
+    examples/bench/codec_speed.py --count=100000
+
+For each codec, measures encoding, decoding message by message and
+decoding in batches (as done on each reactor wakeup).
+"""
+import os
+import sys
+import time
+from optparse import OptionParser
+
+rootdir = os.path.realpath(os.path.join(
+    os.path.dirname(sys.argv[0]), '..', '..'))
+sys.path.insert(0, rootdir)
+os.chdir(rootdir)
+
+from txzmq import codec
+
+
+parser = OptionParser("")
+parser.add_option(
+    "-c", "--count", dest="count", type="int", help="Number of messages")
+parser.add_option(
+    "-b", "--batch", dest="batch", type="int", help="Batch size")
+parser.set_defaults(count=100000, batch=100)
+(options, args) = parser.parse_args()
+
+
+message = {'symbol': 'EURUSD', 'bid': 1.31523, 'ask': 1.31531,
+           'size': [1000000, 2000000], 'time': 1349782800.123}
+
+
+def measure(f, count):
+    start = time.time()
+    f()
+    return count / (time.time() - start)
+
+
+def bench(c):
+    objects = [message] * options.count
+    parts = map(c.encode, objects)
+    batches = [parts[i:i + options.batch]
+               for i in xrange(0, len(parts), options.batch)]
+
+    encode = measure(lambda: map(c.encode, objects), options.count)
+    decode = measure(lambda: map(c.decode, parts), options.count)
+    decodeMany = measure(
+        lambda: map(c.decodeMany, batches), options.count)
+    print "%-8s %6d bytes %10.0f enc/s %10.0f dec/s %10.0f batch dec/s" % (
+        c.name, len(parts[0]), encode, decode, decodeMany)
+
+
+for codecClass in (codec.JSONCodec, codec.PickleCodec, codec.MsgpackCodec):
+    try:
+        c = codecClass()
+    except ImportError, err:
+        print "%-8s skipped: %s" % (codecClass.name, err)
+        continue
+    bench(c)
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of XREQ request id generation:
+
+    examples/bench/request_id_speed.py --count=1000000
+
+Compares default ids of ZmqXREQConnection with uuid4-based ids.
+"""
+import os
+import sys
+import time
+import uuid
+from optparse import OptionParser
+
+rootdir = os.path.realpath(os.path.join(
+    os.path.dirname(sys.argv[0]), '..', '..'))
+sys.path.insert(0, rootdir)
+os.chdir(rootdir)
+
+from txzmq import ZmqEndpoint, ZmqXREQConnection
+
+
+parser = OptionParser("")
+parser.add_option(
+    "-c", "--count", dest="count", type="int", help="Number of ids")
+parser.set_defaults(count=1000000)
+(options, args) = parser.parse_args()
+
+
+def measure(name, getNextId):
+    start = time.time()
+    for i in xrange(options.count):
+        getNextId()
+    rate = options.count / (time.time() - start)
+    print "%-8s %3d bytes %10.0f ids/s" % (name, len(getNextId()), rate)
+
+
+connection = ZmqXREQConnection(ZmqEndpoint("connect", "inproc://bench"))
+measure("default", connection._getNextId)
+measure("uuid4", lambda: str(uuid.uuid4()))
+measure("uuid4hex", lambda: uuid.uuid4().hex)
+measure("uuid4raw", lambda: uuid.uuid4().bytes)
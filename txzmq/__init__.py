@@ -1,11 +1,13 @@
 """
 ZeroMQ integration into Twisted reactor.
 """
-from txzmq.connection import ZmqConnection, ZmqEndpoint, ZmqEndpointType
+from txzmq.connection import (
+    ZmqConnection, ZmqEndpoint, ZmqEndpointType, ZmqQueuePolicy)
 from txzmq.factory import ZmqFactory
 from txzmq.pubsub import ZmqPubConnection, ZmqSubConnection
 from txzmq.xreq_xrep import ZmqXREQConnection
 
 
 __all__ = ['ZmqConnection', 'ZmqEndpoint', 'ZmqEndpointType', 'ZmqFactory',
-           'ZmqPubConnection', 'ZmqSubConnection', 'ZmqXREQConnection']
+           'ZmqPubConnection', 'ZmqQueuePolicy', 'ZmqSubConnection',
+           'ZmqXREQConnection']
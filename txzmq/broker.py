@@ -0,0 +1,290 @@
+"""
+Load-balancing request broker.
+
+L{ZmqBroker} accepts requests from L{ZmqXREQConnection} clients on
+frontend and passes each of them to least recently used worker
+(L{ZmqBrokerWorkerConnection}) with free capacity on backend; replies are
+passed back to clients. Messages are forwarded as received, frames are
+neither copied nor decoded.
+
+Workers announce themselves and their capacity on connect. Broker and
+workers exchange heartbeats: broker forgets workers it didn't hear from
+for L{ZmqBroker.heartbeatLiveness} heartbeat intervals (requests they had
+are lost, clients should use request timeouts), and workers announce
+themselves again when broker goes silent, e.g. after broker restart.
+"""
+from collections import deque
+
+from zmq.core import constants
+
+from twisted.internet import task
+from twisted.python import log
+
+from txzmq import util
+from txzmq.connection import ZmqConnection
+from txzmq.xreq_xrep import ZmqXREPConnection
+
+
+READY = '\x01'
+HEARTBEAT = '\x02'
+
+
+class _ZmqBrokerConnection(ZmqConnection):
+    """
+    Broker frontend or backend, passing messages to broker as is.
+    """
+    socketType = constants.XREP
+    zeroCopyReceive = True
+
+    def __init__(self, handler, *endpoints):
+        ZmqConnection.__init__(self, *endpoints)
+        self.messageReceived = handler
+
+    def _splitPayload(self, message):
+        """
+        Messages are forwarded without decoding.
+        """
+        return message, []
+
+
+class ZmqBroker(object):
+    """
+    Load-balancing broker between clients and workers.
+
+    @cvar heartbeatInterval: interval between heartbeats (in seconds)
+    @type heartbeatInterval: C{float}
+    @cvar heartbeatLiveness: number of heartbeat intervals without word
+        from worker it is forgotten after
+    @type heartbeatLiveness: C{int}
+    @cvar maxQueuedRequests: maximum number of requests waiting for free
+        worker, broker stops reading requests once it is reached
+    @type maxQueuedRequests: C{int}
+
+    @ivar frontend: connection clients connect to
+    @type frontend: L{ZmqConnection}
+    @ivar backend: connection workers connect to
+    @type backend: L{ZmqConnection}
+    @ivar workers: identity -> time worker is forgotten at, for workers
+        alive
+    @type workers: C{dict}
+    @ivar pendingRequests: requests waiting for free worker
+    @type pendingRequests: C{deque}
+    """
+    heartbeatInterval = 1.0
+    heartbeatLiveness = 3
+    maxQueuedRequests = 1000
+
+    def __init__(self, frontendEndpoints, backendEndpoints):
+        """
+        Constructor.
+
+        @param frontendEndpoints: ZeroMQ addresses clients send requests
+            to
+        @type frontendEndpoints: C{list} of L{ZmqEndpoint}
+        @param backendEndpoints: ZeroMQ addresses workers connect to
+        @type backendEndpoints: C{list} of L{ZmqEndpoint}
+        """
+        self.frontend = _ZmqBrokerConnection(
+            self._requestReceived, *frontendEndpoints)
+        self.frontend._readLimit = self._frontendReadLimit
+        self.backend = _ZmqBrokerConnection(
+            self._workerMessageReceived, *backendEndpoints)
+        self.workers = {}
+        self.pendingRequests = deque()
+        # free worker slots, one identity per slot, least recently used
+        # first
+        self._available = deque()
+        self._heartbeat = None
+        self.reactor = None
+
+    def __repr__(self):
+        return "ZmqBroker(%r, %r)" % (
+            self.frontend.endpoints, self.backend.endpoints)
+
+    def listen(self, factory):
+        """
+        Connect or bind frontend and backend, start heartbeats.
+
+        @param factory: ZeroMQ Twisted factory
+        @type factory: L{ZmqFactory}
+        @return: deferred firing when broker is listening
+        @rtype: L{Deferred}
+        """
+        self.reactor = factory.reactor
+        d = self.frontend.listen(factory)
+        d.addCallback(lambda _: self.backend.listen(factory))
+        return d.addCallback(self._startHeartbeats)
+
+    def _startHeartbeats(self, _):
+        self._heartbeat = task.LoopingCall(self._sendHeartbeats)
+        self._heartbeat.clock = self.reactor
+        self._heartbeat.start(self.heartbeatInterval, now=False)
+        return self
+
+    def shutdown(self):
+        """
+        Shutdown frontend and backend.
+        """
+        if self._heartbeat is not None and self._heartbeat.running:
+            self._heartbeat.stop()
+        self.frontend.shutdown()
+        self.backend.shutdown()
+
+    def _requestReceived(self, message):
+        """
+        Called on request from client.
+        """
+        if self._available:
+            self.backend.send([self._available.popleft()] + message)
+            return
+        self.pendingRequests.append(message)
+        if len(self.pendingRequests) >= self.maxQueuedRequests:
+            self.frontend.pauseReading()
+
+    def _frontendReadLimit(self):
+        """
+        Don't read more requests than free worker slots and queue can
+        take, so the rest is left in ZeroMQ queues.
+        """
+        return (len(self._available) + self.maxQueuedRequests -
+                len(self.pendingRequests))
+
+    def _workerMessageReceived(self, message):
+        """
+        Called on reply or control message from worker.
+        """
+        identity = util.toBytes(message[0])
+        if len(message) > 3:
+            # reply: routing info, message id, delimiter and payload
+            self.frontend.send(message[1:])
+            if identity in self.workers:
+                self._workerAvailable(identity, 1)
+            return
+        command = util.toBytes(message[1])
+        if command == READY:
+            if identity in self.workers:
+                # announced again, capacity is counted anew
+                self._available = deque(
+                    worker for worker in self._available
+                    if worker != identity)
+            self._workerAvailable(identity, int(util.toBytes(message[2])))
+        elif command == HEARTBEAT:
+            if identity in self.workers:
+                self._workerSeen(identity)
+        else:
+            log.msg("Unknown command %r from worker %r in %r" % (
+                command, identity, self))
+
+    def _workerSeen(self, identity):
+        self.workers[identity] = self.reactor.seconds() + (
+            self.heartbeatInterval * self.heartbeatLiveness)
+
+    def _workerAvailable(self, identity, slots):
+        """
+        Give free worker slots to requests.
+        """
+        self._workerSeen(identity)
+        pending = self.pendingRequests
+        messages = []
+        while slots and pending:
+            messages.append([identity] + pending.popleft())
+            slots -= 1
+        if messages:
+            self.backend.sendMany(messages)
+            if len(pending) < self.maxQueuedRequests:
+                self.frontend.resumeReading()
+        self._available.extend([identity] * slots)
+
+    def _sendHeartbeats(self):
+        """
+        Send heartbeats to workers, forget the silent ones.
+        """
+        now = self.reactor.seconds()
+        dead = [identity for identity, deadline in self.workers.iteritems()
+                if deadline < now]
+        if dead:
+            for identity in dead:
+                log.msg("Worker %r is gone in %r" % (identity, self))
+                del self.workers[identity]
+            self._available = deque(
+                identity for identity in self._available
+                if identity in self.workers)
+        if self.workers:
+            self.backend.sendMany(
+                [[identity, HEARTBEAT] for identity in self.workers])
+
+
+class ZmqBrokerWorkerConnection(ZmqXREPConnection):
+    """
+    Worker handling requests passed by L{ZmqBroker}.
+
+    Requests are handled like by L{ZmqXREPConnection}.
+
+    @cvar capacity: number of requests handled at once
+    @type capacity: C{int}
+    @cvar heartbeatInterval: interval between heartbeats (in seconds),
+        should be the same as broker's
+    @type heartbeatInterval: C{float}
+    @cvar heartbeatLiveness: number of heartbeat intervals without word
+        from broker worker announces itself again after
+    @type heartbeatLiveness: C{int}
+    """
+    socketType = constants.XREQ
+    capacity = 1
+    heartbeatInterval = 1.0
+    heartbeatLiveness = 3
+
+    def __init__(self, *endpoints):
+        ZmqXREPConnection.__init__(self, *endpoints)
+        self._heartbeat = None
+        self._brokerSeen = None
+
+    def _connectOrBind(self, factory):
+        ZmqXREPConnection._connectOrBind(self, factory)
+        self._heartbeat = task.LoopingCall(self._sendHeartbeat)
+        self._heartbeat.clock = factory.reactor
+        self._heartbeat.start(self.heartbeatInterval, now=False)
+        self._ready()
+
+    def shutdown(self):
+        """
+        Shutdown connection and socket.
+        """
+        if self._heartbeat is not None and self._heartbeat.running:
+            self._heartbeat.stop()
+        ZmqXREPConnection.shutdown(self)
+
+    def _ready(self):
+        """
+        Announce worker to broker, with capacity not taken by requests
+        being handled.
+        """
+        self._brokerSeen = self.factory.reactor.seconds()
+        self.send([READY, str(self.capacity - len(self._routing_info))])
+
+    def _sendHeartbeat(self):
+        silence = self.factory.reactor.seconds() - self._brokerSeen
+        if silence > self.heartbeatInterval * self.heartbeatLiveness:
+            log.msg("Broker is silent for %.1f seconds in %r" % (
+                silence, self))
+            self._ready()
+        else:
+            self.send(HEARTBEAT)
+
+    def _splitPayload(self, message):
+        """
+        Heartbeats have no payload.
+        """
+        if len(message) == 1:
+            return message, []
+        return ZmqXREPConnection._splitPayload(self, message)
+
+    def messageReceived(self, message):
+        """
+        Called on incoming message from ZeroMQ.
+
+        @param message: message data
+        """
+        self._brokerSeen = self.factory.reactor.seconds()
+        if len(message) > 1:
+            ZmqXREPConnection.messageReceived(self, message)
@@ -0,0 +1,136 @@
+"""
+Codecs for message payload serialization.
+"""
+import cPickle
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from txzmq import exceptions, util
+
+
+class Codec(object):
+    """
+    Message payload codec.
+
+    Codec encodes objects to C{str}s sent as message parts and decodes
+    received message parts back.
+
+    @cvar name: codec name
+    @type name: C{str}
+    """
+    name = None
+
+    def encode(self, obj):
+        """
+        Encode object.
+
+        @param obj: object to encode
+        @return: encoded data
+        @rtype: C{str}
+        """
+        raise NotImplementedError(self)
+
+    def decode(self, data):
+        """
+        Decode message part.
+
+        @param data: message part
+        @type data: C{str}, L{Frame} or C{memoryview}
+        @return: decoded object
+        """
+        raise NotImplementedError(self)
+
+    def decodeMany(self, parts):
+        """
+        Decode batch of message parts.
+
+        Codecs could override this to decode whole batch faster than
+        part by part.
+
+        @param parts: message parts
+        @type parts: C{list}
+        @return: decoded objects
+        @rtype: C{list}
+        """
+        return map(self.decode, parts)
+
+
+class JSONCodec(Codec):
+    """
+    JSON codec.
+
+    Batches are decoded part by part with C{raw_decode}, skipping
+    whitespace handling of L{decode} unless part needs it.
+    """
+    name = "json"
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(separators=(',', ':'))
+        self._decoder = json.JSONDecoder()
+
+    def encode(self, obj):
+        return self._encoder.encode(obj)
+
+    def decode(self, data):
+        return self._decoder.decode(util.toBytes(data))
+
+    def decodeMany(self, parts):
+        raw_decode = self._decoder.raw_decode
+        result = []
+        for i, part in enumerate(parts):
+            part = util.toBytes(part)
+            try:
+                obj, end = raw_decode(part)
+            except ValueError:
+                # leading whitespace, or broken part
+                result.append(self.decode(part))
+                continue
+            if end != len(part) and part[end:].strip():
+                raise exceptions.CodecError(
+                    "message part %d is not a single object" % (i,))
+            result.append(obj)
+        return result
+
+
+class PickleCodec(Codec):
+    """
+    Pickle codec, using highest pickle protocol available.
+
+    Never use it to decode messages from untrusted peers.
+    """
+    name = "pickle"
+
+    def encode(self, obj):
+        return cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return cPickle.loads(util.toBytes(data))
+
+
+class MsgpackCodec(Codec):
+    """
+    MessagePack codec, requires C{msgpack} package.
+    """
+    name = "msgpack"
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("msgpack package is required for %s" % (
+                self.__class__.__name__,))
+
+    def encode(self, obj):
+        return msgpack.packb(obj)
+
+    def decode(self, data):
+        return msgpack.unpackb(data)
+
+    def decodeMany(self, parts):
+        try:
+            return map(msgpack.unpackb, parts)
+        except ValueError, err:
+            # truncated part or more than one object in part
+            raise exceptions.CodecError(str(err))
@@ -0,0 +1,161 @@
+"""
+Compression of message payload.
+
+Each compressed payload part is prefixed with one byte flag, identifying
+compression algorithm, so receiver doesn't need to know which algorithm
+sender uses. Parts which are too small (or don't compress well) are sent
+as is, with L{STORED} flag.
+"""
+import zlib
+
+try:
+    import lz4.block as lz4
+except ImportError:
+    try:
+        import lz4
+    except ImportError:
+        lz4 = None
+
+from zmq.core.message import Frame
+
+from txzmq import exceptions, util
+
+
+STORED = '\x00'
+
+
+class Compressor(object):
+    """
+    Message payload compressor.
+
+    @cvar name: compression algorithm name
+    @type name: C{str}
+    @cvar flag: flag byte identifying compression algorithm
+    @type flag: C{str}
+    @ivar threshold: parts smaller than this (in bytes) are not compressed
+    @type threshold: C{int}
+    """
+    name = None
+    flag = None
+
+    def __init__(self, threshold=1024):
+        """
+        Constructor.
+
+        @param threshold: parts smaller than this (in bytes) are not
+            compressed
+        @type threshold: C{int}
+        """
+        self.threshold = threshold
+
+    def compress(self, data):
+        """
+        Compress data.
+
+        @param data: data to compress
+        @type data: C{str}
+        @rtype: C{str}
+        """
+        raise NotImplementedError(self)
+
+    @classmethod
+    def decompress(cls, data):
+        """
+        Decompress data.
+
+        @param data: data to decompress
+        @type data: C{buffer} or C{memoryview}
+        @rtype: C{str}
+        """
+        raise NotImplementedError(cls)
+
+    def pack(self, data):
+        """
+        Compress data (if it is large enough) and prefix it with flag.
+
+        @param data: message part
+        @type data: C{str}
+        @return: message part to send
+        @rtype: C{str}
+        """
+        if len(data) >= self.threshold:
+            compressed = self.compress(data)
+            if len(compressed) < len(data):
+                return self.flag + compressed
+        return STORED + data
+
+
+class ZlibCompressor(Compressor):
+    """
+    Compressor using zlib.
+
+    @ivar level: compression level, from 1 (fastest) to 9 (best)
+    @type level: C{int}
+    """
+    name = "zlib"
+    flag = '\x01'
+
+    def __init__(self, threshold=1024, level=6):
+        Compressor.__init__(self, threshold)
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    @classmethod
+    def decompress(cls, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return zlib.decompress(data)
+
+
+class LZ4Compressor(Compressor):
+    """
+    Compressor using LZ4, requires C{lz4} package.
+
+    LZ4 compresses worse than zlib, but is much faster.
+    """
+    name = "lz4"
+    flag = '\x02'
+
+    def __init__(self, threshold=1024):
+        if lz4 is None:
+            raise ImportError("lz4 package is required for %s" % (
+                self.__class__.__name__,))
+        Compressor.__init__(self, threshold)
+
+    def compress(self, data):
+        return lz4.compress(data)
+
+    @classmethod
+    def decompress(cls, data):
+        return lz4.decompress(data)
+
+
+_compressors = dict((compressor.flag, compressor)
+                    for compressor in (ZlibCompressor, LZ4Compressor))
+
+
+def unpack(part):
+    """
+    Decompress message part packed by L{Compressor.pack}.
+
+    Parts sent as is are returned without copying, if they are L{Frame}s
+    or C{memoryview}s.
+
+    @param part: message part
+    @type part: C{str}, L{Frame} or C{memoryview}
+    @return: original message part
+    """
+    if isinstance(part, str):
+        flag, data = part[:1], buffer(part, 1)
+    else:
+        if isinstance(part, Frame):
+            part = util.frameBuffer(part)
+        flag, data = part[:1].tobytes(), part[1:]
+    if flag == STORED:
+        return str(data) if isinstance(data, buffer) else data
+    compressor = _compressors.get(flag)
+    if compressor is None:
+        raise exceptions.CodecError("unknown compression flag %r" % (flag,))
+    return compressor.decompress(data)
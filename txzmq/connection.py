@@ -4,15 +4,20 @@ ZeroMQ connection.
 from collections import deque, namedtuple
 
 from zmq.core import constants, error
+from zmq.core.version import zmq_version
+from zmq.core.message import MessageTracker
 from zmq.core.socket import Socket
 
 from zope.interface import implements
 
-from twisted.internet import defer
-from twisted.internet.interfaces import IFileDescriptor, IReadDescriptor
+from twisted.internet import defer, threads
+from twisted.internet.error import ConnectionDone
+from twisted.internet.interfaces import (
+    IConsumer, IFileDescriptor, IReadDescriptor)
 from twisted.python import log
 
-from txzmq import exceptions, util
+from txzmq import compression, exceptions, util
+from txzmq.executor import KeyedSerializer, ThreadExecutor
 
 
 class ZmqEndpointType(object):
@@ -26,6 +31,18 @@ class ZmqEndpointType(object):
 ZmqEndpoint = namedtuple('ZmqEndpoint', ['type', 'address'])
 
 
+class ZmqQueuePolicy(object):
+    """
+    What to do with new message when outgoing queue is full.
+
+    Message could be queued anyway (with registered producer paused),
+    dropped silently or rejected with L{exceptions.QueueFullError}.
+    """
+    block = "block"
+    drop = "drop"
+    fail = "fail"
+
+
 class ZmqConnection(object):
     """
     Connection through ZeroMQ, wraps up ZeroMQ socket.
@@ -38,6 +55,72 @@ class ZmqConnection(object):
     @cvar highWaterMark: hard limit on the maximum number of outstanding
         messages 0MQ shall queue in memory for any single peer
     @type highWaterMark: C{int}
+    @cvar socketOptions: ZeroMQ socket options, by option name (like
+        C{'SNDBUF'}, C{'RECOVERY_IVL'}) or constant; they override
+        L{ZmqFactory.socketOptions} and attributes above. Options not
+        supported by installed libzmq (like C{'SNDHWM'} before 3.0) make
+        connect fail
+    @type socketOptions: C{dict}
+    @cvar ioThreadAffinity: numbers of ZeroMQ IO threads (see
+        L{ZmqFactory.ioThreads}) handling connections of socket, C{None}
+        for any thread
+    @type ioThreadAffinity: C{list}
+    @cvar readMessageBudget: maximum number of messages read on single
+        reactor wakeup, C{None} for no limit
+    @type readMessageBudget: C{int}
+    @cvar readByteBudget: maximum number of bytes read on single reactor
+        wakeup, C{None} for no limit
+    @type readByteBudget: C{int}
+    @cvar readTimeBudget: maximum time (in seconds) spent reading on single
+        reactor wakeup, C{None} for no limit
+    @type readTimeBudget: C{float}
+    @cvar zeroCopyReceive: if True, messages are received without copying,
+        L{messageReceived} gets L{Frame}s instead of C{str}s
+    @type zeroCopyReceive: C{boolean}
+    @cvar receiveBuffers: if True (and L{zeroCopyReceive} is set),
+        L{messageReceived} gets C{memoryview}s pointing into ZeroMQ
+        message buffers instead of L{Frame}s
+    @type receiveBuffers: C{boolean}
+    @cvar trackerPollInterval: how often (in seconds) to check whether
+        ZeroMQ has released buffers of messages sent with C{track=True}
+    @type trackerPollInterval: C{float}
+    @cvar queueHighMessages: number of messages in outgoing queue when
+        queue is considered full, C{None} for no limit
+    @type queueHighMessages: C{int}
+    @cvar queueLowMessages: number of messages in outgoing queue to
+        resume paused producer at, defaults to half of L{queueHighMessages}
+    @type queueLowMessages: C{int}
+    @cvar queueHighBytes: size of messages in outgoing queue when queue
+        is considered full, C{None} for no limit
+    @type queueHighBytes: C{int}
+    @cvar queueLowBytes: size of messages in outgoing queue to resume
+        paused producer at, defaults to half of L{queueHighBytes}
+    @type queueLowBytes: C{int}
+    @cvar queueOverflowPolicy: what to do with messages sent when outgoing
+        queue is full
+    @type queueOverflowPolicy: L{ZmqQueuePolicy}
+    @cvar codec: codec for message payload, C{None} for raw C{str}s
+    @type codec: L{txzmq.codec.Codec}
+    @cvar compression: compressor for sent message payload, C{None} for
+        no compression; if set, received payload is decompressed as well
+    @type compression: L{txzmq.compression.Compressor}
+    @cvar threadedDecodeSize: batches with payload at least this size (in
+        bytes) are decompressed and decoded in reactor thread pool,
+        C{None} to always decode in reactor thread
+    @type threadedDecodeSize: C{int}
+    @cvar threadedCompressionSize: payload at least this size (in bytes)
+        is compressed in reactor thread pool, C{None} to always compress
+        in reactor thread
+    @type threadedCompressionSize: C{int}
+    @cvar executor: executor running message handlers (C{gotMessage} of
+        L{txzmq.pubsub.ZmqSubConnection} and
+        L{txzmq.xreq_xrep.ZmqXREPConnection}) off the reactor thread,
+        C{None} to run them in reactor thread; handlers are bound methods,
+        so they can't be run by L{txzmq.executor.ProcessExecutor}
+    @type executor: L{txzmq.executor.ThreadExecutor}
+    @cvar executorOrdering: with L{executor}, run handlers for messages
+        with the same key (tag, peer identity) one after another
+    @type executorOrdering: C{boolean}
 
     @ivar factory: ZeroMQ Twisted factory reference
     @type factory: L{ZmqFactory}
@@ -47,20 +130,47 @@ class ZmqConnection(object):
     @type endpoints: C{list} of L{ZmqEndpoint}
     @ivar fd: file descriptor of zmq mailbox
     @type fd: C{int}
-    @ivar queue: output message queue
+    @ivar queue: output message queue of C{(parts, size, tracked)}
     @type queue: C{deque}
+    @ivar queuedMessages: number of messages in output queue
+    @type queuedMessages: C{int}
+    @ivar queuedBytes: size of messages in output queue
+    @type queuedBytes: C{int}
+    @ivar droppedMessages: number of messages dropped because of full
+        output queue
+    @type droppedMessages: C{int}
+    @ivar producer: producer registered via L{registerProducer}
     @ivar isConnected: True if the connect() method called without error
     @type isConnected: C{lbool}
     @ivar isListening: True if the listen() method called without error
     @type isListening: C{lbool}
     """
-    implements(IReadDescriptor, IFileDescriptor)
+    implements(IReadDescriptor, IFileDescriptor, IConsumer)
 
     socketType = None
     allowLoopbackMulticast = False
     multicastRate = 100
     highWaterMark = 0
     identity = None
+    socketOptions = {}
+    ioThreadAffinity = None
+    readMessageBudget = None
+    readByteBudget = None
+    readTimeBudget = None
+    zeroCopyReceive = False
+    receiveBuffers = False
+    trackerPollInterval = 0.01
+    queueHighMessages = None
+    queueLowMessages = None
+    queueHighBytes = None
+    queueLowBytes = None
+    queueOverflowPolicy = ZmqQueuePolicy.block
+    codec = None
+    compression = None
+    threadedDecodeSize = None
+    threadedCompressionSize = None
+    executor = None
+    executorOrdering = False
 
     def __init__(self, *endpoints):
         """
@@ -72,10 +182,26 @@ class ZmqConnection(object):
         self.factory = None
         self.endpoints = endpoints
         self.queue = deque()
-        self.recv_parts = []
+        self.queuedMessages = 0
+        self.queuedBytes = 0
+        self.droppedMessages = 0
+        self.producer = None
+        self.streamingProducer = False
+        self._producerPaused = False
         self.fd = None
         self.isListening = False
         self.isConnected = False
+        self._readScheduled = None
+        self._readPaused = False
+        self._sendOffset = 0
+        self._sendTrackers = []
+        self._trackers = []
+        self._trackersCheck = None
+        self._decoding = None
+        self._decodingBatches = 0
+        self._encoding = None
+        self._encodingMessages = 0
+        self._serializer = None
 
     def __repr__(self):
         return "%s(%r, %r)" % (
@@ -94,8 +220,36 @@ class ZmqConnection(object):
         socket.setsockopt(constants.HWM, self.highWaterMark)
         if self.identity is not None:
             socket.setsockopt(constants.IDENTITY, self.identity)
+        if self.ioThreadAffinity is not None:
+            socket.setsockopt(constants.AFFINITY, sum(
+                1 << thread for thread in set(self.ioThreadAffinity)))
+        options = dict(factory.socketOptions)
+        options.update(self.socketOptions)
+        try:
+            for option, value in options.iteritems():
+                socket.setsockopt(self._socketOption(option), value)
+        except Exception:
+            socket.close()
+            raise
         return socket
 
+    def _socketOption(self, option):
+        """
+        Find ZeroMQ socket option constant.
+
+        @param option: option name or constant
+        @type option: C{str} or C{int}
+        @rtype: C{int}
+        @raise ValueError: option is not supported by libzmq
+        """
+        if isinstance(option, (int, long)):
+            return option
+        constant = getattr(constants, option.upper(), None)
+        if constant is None:
+            raise ValueError("socket option %s is not supported by "
+                             "libzmq %s" % (option, zmq_version()))
+        return constant
+
     def _connectOrBind(self, factory):
         """
         Connect and/or bind socket to endpoints.
@@ -113,6 +267,8 @@ class ZmqConnection(object):
         factory.connections.add(self)
         factory.reactor.addReader(self)
         self.factory = factory
+        # events could have happened before reader was added
+        self._scheduleRead()
 
     def connect(self, factory):
         """
@@ -169,7 +325,15 @@ class ZmqConnection(object):
     def shutdown(self):
         """
         Shutdown connection and socket.
+
+        Tracked messages still queued fail with L{ConnectionDone}.
         """
+        if self._readScheduled is not None:
+            self._readScheduled.cancel()
+            self._readScheduled = None
+        if self.producer is not None:
+            self.producer.stopProducing()
+            self.unregisterProducer()
         self.factory.reactor.removeReader(self)
         self.factory.connections.discard(self)
         self.socket.close()
@@ -177,6 +341,11 @@ class ZmqConnection(object):
         self.isListening = False
         self.socket = None
         self.factory = None
+        tracked = [d for _, _, d in self.queue if d is not None]
+        self.queue.clear()
+        self.queuedMessages = self.queuedBytes = 0
+        for d in tracked:
+            d.errback(ConnectionDone("connection shut down"))
 
     def fileno(self):
         """
@@ -200,12 +369,107 @@ class ZmqConnection(object):
         """
         Read multipart in non-blocking manner, returns with ready message
         or raising exception (in case of no more messages available).
+
+        ZeroMQ delivers multipart messages atomically, so all the parts
+        are received at once.
+
+        Note: with pyzmq 2.x C{recv_multipart} is itself implemented as
+        C{recv} + C{getsockopt(RCVMORE)} per frame, so it saves no ZeroMQ
+        calls compared to looping here, only some Python overhead.
+        """
+        if not self.zeroCopyReceive:
+            return self.socket.recv_multipart(constants.NOBLOCK)
+        message = self.socket.recv_multipart(constants.NOBLOCK, copy=False)
+        if self.receiveBuffers:
+            return map(util.frameBuffer, message)
+        return message
+
+    def pauseReading(self):
         """
+        Stop reading incoming messages until L{resumeReading} is called.
+
+        Messages are left in ZeroMQ queues meanwhile, so peers are
+        throttled by high water mark. Sending is not affected.
+        """
+        self._readPaused = True
+
+    def resumeReading(self):
+        """
+        Resume reading incoming messages after L{pauseReading}.
+        """
+        if not self._readPaused:
+            return
+        self._readPaused = False
+        if self.factory is not None:
+            self._scheduleRead()
+
+    def _scheduleRead(self):
+        """
+        Schedule another L{doRead} on next reactor iteration.
+
+        ZeroMQ file descriptor is edge-triggered: it won't signal again
+        while there are messages left unread (when read budget is
+        exhausted), and after send it won't signal until events are
+        checked again, so we have to come back on our own. Pending
+        outgoing messages are flushed by L{doRead} as soon as socket
+        reports C{POLLOUT}.
+        """
+        if self._readScheduled is None:
+            self._readScheduled = self.factory.reactor.callLater(
+                0, self.doRead)
+
+    def _readLimit(self):
+        """
+        Maximum number of messages to read in next batch, on top of read
+        budget.
+
+        Reading is paused (see L{pauseReading}) only once the batch is
+        delivered, so connections which pause when some number of
+        messages is reached should return number of messages left.
+
+        @return: number of messages, C{None} for no limit
+        @rtype: C{int}
+        """
+        return None
+
+    def _readBatch(self, batch):
+        """
+        Read messages into L{batch} until there are no more messages
+        available or read budget is exhausted.
+
+        @param batch: list to append messages to
+        @type batch: C{list}
+        """
+        messageBudget = self.readMessageBudget
+        limit = self._readLimit()
+        if limit is not None and (
+                messageBudget is None or limit < messageBudget):
+            messageBudget = max(1, limit)
+        byteBudget = self.readByteBudget
+        deadline = None
+        if self.readTimeBudget is not None:
+            seconds = self.factory.reactor.seconds
+            deadline = seconds() + self.readTimeBudget
+        size = 0
+
         while True:
-            self.recv_parts.append(self.socket.recv(constants.NOBLOCK))
-            if not self.socket.getsockopt(constants.RCVMORE):
-                result, self.recv_parts = self.recv_parts, []
-                return result
+            try:
+                message = self._readMultipart()
+            except error.ZMQError as e:
+                if e.errno == constants.EAGAIN:
+                    return
+                raise e
+            batch.append(message)
+            if messageBudget is not None and len(batch) >= messageBudget:
+                break
+            if byteBudget is not None:
+                size += sum(len(part) for part in message)
+                if size >= byteBudget:
+                    break
+            if deadline is not None and seconds() >= deadline:
+                break
+
+        self._scheduleRead()
 
     def doRead(self):
         """
@@ -215,53 +479,567 @@ class ZmqConnection(object):
 
         Part of L{IReadDescriptor}.
         """
+        if self._readScheduled is not None:
+            if self._readScheduled.active():
+                self._readScheduled.cancel()
+            self._readScheduled = None
+        if self.factory is None:  # disconnected
+            return
+
         events = self.socket.getsockopt(constants.EVENTS)
-        if (events & constants.POLLIN) == constants.POLLIN:
-            while True:
-                if self.factory is None:  # disconnected
-                    return
-                try:
-                    message = self._readMultipart()
-                except error.ZMQError as e:
-                    if e.errno == constants.EAGAIN:
-                        break
-                    raise e
-                log.callWithLogger(self, self.messageReceived, message)
+        if ((events & constants.POLLIN) == constants.POLLIN and
+                not self._readPaused):
+            batch = []
+            try:
+                self._readBatch(batch)
+            finally:
+                if batch:
+                    self._deliver(batch)
+        if self.factory is None:  # disconnected
+            return
         if (events & constants.POLLOUT) == constants.POLLOUT:
             self._startWriting()
 
+    def _deliver(self, batch):
+        """
+        Decompress and decode (if L{compression} or L{codec} is set) and
+        deliver batch of messages to L{messagesReceived}.
+
+        Batches are delivered in order they were read, even when some of
+        them are decoded in thread pool.
+
+        @param batch: list of messages
+        @type batch: C{list}
+        """
+        if self.codec is None and self.compression is None:
+            log.callWithLogger(self, self.messagesReceived, batch)
+            return
+
+        threaded = False
+        if self.threadedDecodeSize is not None:
+            size = sum(len(part) for message in batch for part in message)
+            threaded = size >= self.threadedDecodeSize
+        if self._decoding is None and not threaded:
+            self._deliverDecoded(self._decodeMessages(batch))
+            return
+
+        if self._decoding is None:
+            self._decoding = defer.succeed(None)
+        self._decodingBatches += 1
+        if threaded:
+            reactor = self.factory.reactor
+            self._decoding.addCallback(
+                lambda _: threads.deferToThreadPool(
+                    reactor, reactor.getThreadPool(),
+                    self._decodeMessages, batch))
+        else:
+            self._decoding.addCallback(
+                lambda _: self._decodeMessages(batch))
+        self._decoding.addCallback(self._deliverDecoded)
+        self._decoding.addErrback(log.err, "Failed to decode messages")
+        self._decoding.addCallback(self._decodedBatch)
+
+    def _decodedBatch(self, _):
+        """
+        Called when batch decoded in order is delivered.
+        """
+        self._decodingBatches -= 1
+        if self._decodingBatches == 0:
+            self._decoding = None
+
+    def _decodePayload(self, parts):
+        """
+        Decompress and decode payload parts.
+
+        @param parts: payload parts
+        @type parts: C{list}
+        @rtype: C{list}
+        """
+        if self.compression is not None:
+            parts = map(compression.unpack, parts)
+        if self.codec is not None:
+            parts = self.codec.decodeMany(parts)
+        return parts
+
+    def _decodeMessages(self, batch):
+        """
+        Decompress and decode payload of messages.
+
+        Messages failing to decode are logged and dropped. This could be
+        run outside of reactor thread.
+
+        @param batch: list of messages
+        @type batch: C{list}
+        @return: list of decoded messages
+        @rtype: C{list}
+        """
+        try:
+            splits = map(self._splitPayload, batch)
+            decoded = iter(self._decodePayload(
+                [part for _, payload in splits for part in payload]))
+            return [envelope + [decoded.next() for _ in payload]
+                    for envelope, payload in splits]
+        except Exception:
+            pass
+
+        # some of messages are broken, decode them one by one
+        result = []
+        for message in batch:
+            try:
+                envelope, payload = self._splitPayload(message)
+                result.append(envelope + self._decodePayload(payload))
+            except Exception:
+                log.err(None, "Failed to decode message in %r" % (self,))
+        return result
+
+    def _deliverDecoded(self, batch):
+        """
+        Deliver batch of decoded messages.
+
+        @param batch: list of messages
+        @type batch: C{list}
+        """
+        if batch and self.factory is not None:
+            log.callWithLogger(self, self.messagesReceived, batch)
+
+    def _splitPayload(self, message):
+        """
+        Split message into envelope parts and payload parts, only
+        the latter are encoded with L{codec}.
+
+        By default, all the message parts are payload.
+
+        @param message: message data
+        @type message: C{list}
+        @return: C{(envelope, payload)}, lists of message parts
+        @rtype: C{tuple}
+        """
+        return [], message
+
+    def _sendPayloads(self, envelopes, payloads, build):
+        """
+        Encode and compress payloads, send messages built of them.
+
+        Large payloads are compressed in reactor thread pool (see
+        L{threadedCompressionSize}), messages are sent in order anyway.
+
+        @param envelopes: envelope for each message, passed to L{build}
+        @type envelopes: C{list}
+        @param payloads: payload parts for each message
+        @type payloads: C{list} of C{list}s
+        @param build: callable building message out of envelope and list
+            of encoded payload parts
+        @return: C{None} if messages were sent right away, otherwise
+            deferred firing when messages are sent
+        @rtype: L{Deferred}
+        """
+        if self.codec is not None:
+            encode = self.codec.encode
+            payloads = [map(encode, parts) for parts in payloads]
+        compressor = self.compression
+        if compressor is None:
+            self._sendBuilt(envelopes, payloads, build)
+            return None
+
+        threaded = False
+        if self.threadedCompressionSize is not None:
+            size = sum(len(part) for parts in payloads for part in parts)
+            threaded = size >= self.threadedCompressionSize
+        if self._encoding is None and not threaded:
+            self._sendBuilt(
+                envelopes, self._packPayloads(compressor, payloads), build)
+            return None
+
+        if self._encoding is None:
+            self._encoding = defer.succeed(None)
+        self._encodingMessages += 1
+        if threaded:
+            reactor = self.factory.reactor
+            self._encoding.addCallback(
+                lambda _: threads.deferToThreadPool(
+                    reactor, reactor.getThreadPool(),
+                    self._packPayloads, compressor, payloads))
+        else:
+            self._encoding.addCallback(
+                lambda _: self._packPayloads(compressor, payloads))
+        self._encoding.addCallback(
+            lambda packed: self._sendBuilt(envelopes, packed, build))
+        d = defer.Deferred()
+        self._encoding.addCallbacks(d.callback, d.errback)
+        self._encoding.addCallback(self._encodedMessage)
+        return d
+
+    def _packPayloads(self, compressor, payloads):
+        """
+        Compress payloads.
+
+        @param compressor: compressor
+        @type compressor: L{txzmq.compression.Compressor}
+        @param payloads: payload parts for each message
+        @type payloads: C{list} of C{list}s
+        """
+        return [map(compressor.pack, parts) for parts in payloads]
+
+    def _sendBuilt(self, envelopes, payloads, build):
+        """
+        Build messages out of envelopes and encoded payloads and send them.
+
+        @param envelopes: envelope for each message, passed to L{build}
+        @type envelopes: C{list}
+        @param payloads: encoded payload parts for each message
+        @type payloads: C{list} of C{list}s
+        @param build: callable building message out of envelope and list
+            of encoded payload parts
+        """
+        if len(envelopes) == 1:
+            self.send(build(envelopes[0], list(payloads[0])))
+        else:
+            self.sendMany(map(build, envelopes, payloads))
+
+    def _encodedMessage(self, _):
+        """
+        Called when messages compressed in order are sent.
+        """
+        self._encodingMessages -= 1
+        if self._encodingMessages == 0:
+            self._encoding = None
+
     def _startWriting(self):
         """
         Start delivering messages from the queue.
         """
         while self.queue:
+            parts, _, tracked = self.queue[0]
             try:
-                self.socket.send(
-                    self.queue[0][1], constants.NOBLOCK | self.queue[0][0])
+                if tracked is None:
+                    self._sendParts(parts)
+                else:
+                    self._sendTrackedParts(parts)
             except error.ZMQError as e:
                 if e.errno == constants.EAGAIN:
                     break
-                self.queue.popleft()
-                raise e
-            self.queue.popleft()
+                self._dequeue()
+                if tracked is None:
+                    raise e
+                self._sendTrackers = []
+                tracked.errback(e)
+                continue
+            self._dequeue()
+            if tracked is not None:
+                self._track(MessageTracker(*self._sendTrackers), tracked)
+                self._sendTrackers = []
+        self._checkProducer()
+
+    def _sendParts(self, parts):
+        """
+        Send message parts, resuming after parts already sent.
+
+        @param parts: message parts
+        @type parts: C{list}
+        """
+        send = self.socket.send
+        last = len(parts) - 1
+        while self._sendOffset < last:
+            send(parts[self._sendOffset],
+                 constants.NOBLOCK | constants.SNDMORE)
+            self._sendOffset += 1
+        send(parts[last], constants.NOBLOCK)
+
+    def _sendTrackedParts(self, parts):
+        """
+        Send message parts without copying, resuming after parts
+        already sent.
+
+        @param parts: message parts
+        @type parts: C{list}
+        """
+        send = self.socket.send
+        last = len(parts) - 1
+        while self._sendOffset < last:
+            self._sendTrackers.append(send(
+                parts[self._sendOffset], constants.NOBLOCK | constants.SNDMORE,
+                copy=False, track=True))
+            self._sendOffset += 1
+        self._sendTrackers.append(send(
+            parts[last], constants.NOBLOCK, copy=False, track=True))
+
+    def _dequeue(self):
+        """
+        Remove first message from the output queue.
+        """
+        _, size, _ = self.queue.popleft()
+        self._sendOffset = 0
+        self.queuedBytes -= size
+        self.queuedMessages -= 1
+
+    def _track(self, tracker, tracked):
+        """
+        Fire L{tracked} when ZeroMQ is done with the message.
+
+        @param tracker: message tracker returned by ZeroMQ
+        @type tracker: L{MessageTracker}
+        @param tracked: deferred to fire
+        @type tracked: L{Deferred}
+        """
+        self._trackers.append((tracker, tracked))
+        if self._trackersCheck is None:
+            reactor = self.factory.reactor
+            self._trackersCheck = reactor.callLater(
+                self.trackerPollInterval, self._checkTrackers, reactor)
+
+    def _checkTrackers(self, reactor):
+        """
+        Fire deferreds of tracked messages whose buffers were released.
+
+        ZeroMQ doesn't signal message release on its file descriptor, so
+        trackers are polled while there are any pending. This goes on
+        after L{shutdown}, as buffers are released only when ZeroMQ
+        actually sends or drops the messages.
+
+        @param reactor: reactor to schedule next check with
+        """
+        self._trackersCheck = None
+        pending = []
+        for tracker, tracked in self._trackers:
+            if tracker.done:
+                tracked.callback(self)
+            else:
+                pending.append((tracker, tracked))
+        self._trackers = pending
+        if pending:
+            self._trackersCheck = reactor.callLater(
+                self.trackerPollInterval, self._checkTrackers, reactor)
+
+    def _queueFull(self):
+        """
+        Is output queue over high watermark?
+        """
+        return ((self.queueHighMessages is not None and
+                 self.queuedMessages >= self.queueHighMessages) or
+                (self.queueHighBytes is not None and
+                 self.queuedBytes >= self.queueHighBytes))
+
+    def _queueDrained(self):
+        """
+        Is output queue under low watermark?
+        """
+        low = self.queueLowMessages
+        if low is None and self.queueHighMessages is not None:
+            low = self.queueHighMessages // 2
+        if low is not None and self.queuedMessages > low:
+            return False
+        low = self.queueLowBytes
+        if low is None and self.queueHighBytes is not None:
+            low = self.queueHighBytes // 2
+        if low is not None and self.queuedBytes > low:
+            return False
+        return True
+
+    def _checkProducer(self):
+        """
+        Pause or resume registered producer according to output queue
+        watermarks.
+        """
+        if self.producer is None:
+            return
+        if not self._producerPaused:
+            if self._queueFull():
+                self._producerPaused = True
+                if self.streamingProducer:
+                    self.producer.pauseProducing()
+        elif self._queueDrained():
+            self._producerPaused = False
+            if self.streamingProducer:
+                self.producer.resumeProducing()
+            else:
+                # pull producer is writing from resumeProducing(),
+                # don't recurse into it
+                self.factory.reactor.callLater(0, self._resumePullProducer)
+
+    def _resumePullProducer(self):
+        """
+        Ask pull producer for more data.
+        """
+        if self.producer is not None and not self.streamingProducer:
+            self.producer.resumeProducing()
+
+    def registerProducer(self, producer, streaming):
+        """
+        Register to receive data from a producer.
+
+        Producer is paused when output queue grows over high watermark
+        and resumed when queue is drained below low watermark.
+
+        Part of L{IConsumer}.
+
+        @param producer: producer
+        @type producer: L{IPushProducer} or L{IPullProducer}
+        @param streaming: True if producer is L{IPushProducer}
+        @type streaming: C{boolean}
+        """
+        if self.producer is not None:
+            raise RuntimeError(
+                "Cannot register producer %s, because producer %s was never "
+                "unregistered." % (producer, self.producer))
+        self.producer = producer
+        self.streamingProducer = streaming
+        self._producerPaused = False
+        if not streaming:
+            producer.resumeProducing()
+
+    def unregisterProducer(self):
+        """
+        Stop consuming data from a producer.
+
+        Part of L{IConsumer}.
+        """
+        self.producer = None
+        self._producerPaused = False
 
-    def send(self, message):
+    def write(self, data):
+        """
+        Send data written by producer as a message.
+
+        Part of L{IConsumer}.
+
+        @param data: message data
+        """
+        if self.producer is not None and not self.streamingProducer:
+            # pull producer waits for resumeProducing() on each write
+            self._producerPaused = True
+        self.send(data)
+
+    def send(self, message, track=False):
         """
         Send message via ZeroMQ.
 
-        @param message: message data
+        If output queue is full, message is handled according to
+        L{queueOverflowPolicy}.
+
+        With L{track} set, message parts are sent without copying, so they
+        could be any objects providing buffer interface (C{buffer},
+        C{memoryview}, C{mmap}, ...). Parts shouldn't be modified until
+        returned deferred fires.
+
+        Multipart message list is queued as is, without copying, so it
+        shouldn't be modified after the call.
+
+        @param message: message data, C{str} or list of parts
+        @param track: send message without copying and track when ZeroMQ
+            releases its buffers
+        @type track: C{boolean}
+        @return: if L{track} is set, deferred firing when message buffers
+            could be reused (failing with L{ConnectionDone} if connection
+            is shut down before message is sent)
+        @rtype: L{Deferred}
+        """
+        tracked = defer.Deferred() if track else None
+        if not self._enqueue(message, tracked):
+            return defer.succeed(self) if track else None
+        self._flush()
+        return tracked
+
+    def sendMany(self, messages):
         """
+        Send several messages via ZeroMQ.
+
+        Messages are queued all at once and then flushed, which is
+        cheaper than calling L{send} for each of them.
+
+        If L{queueOverflowPolicy} is L{ZmqQueuePolicy.fail} and output
+        queue gets full, messages queued so far are sent anyway.
+
+        @param messages: list of messages, each is C{str} or list of parts
+        @type messages: C{list}
+        """
+        count = 0
+        try:
+            for message in messages:
+                self._enqueue(message, None)
+                count += 1
+        except exceptions.QueueFullError, err:
+            raise exceptions.QueueFullError(
+                "%s, %d of %d messages queued" % (
+                    err.args[0], count, len(messages)))
+        finally:
+            self._flush()
+
+    def _enqueue(self, message, tracked):
+        """
+        Put message to output queue, unless queue is full.
+
+        @param message: message data, C{str} or list of parts
+        @param tracked: deferred for tracked message, or C{None}
+        @type tracked: L{Deferred}
+        @return: whether message was queued
+        @rtype: C{boolean}
+        """
+        if (self.queueOverflowPolicy != ZmqQueuePolicy.block and
+                self._queueFull()):
+            if self.queueOverflowPolicy == ZmqQueuePolicy.fail:
+                raise exceptions.QueueFullError(
+                    "%d messages (%d bytes) queued" % (
+                        self.queuedMessages, self.queuedBytes))
+            self.droppedMessages += 1
+            return False
+
         if not hasattr(message, '__iter__'):
-            self.queue.append((0, message))
+            size = len(message)
+            message = (message,)
         else:
-            self.queue.extend([(constants.SNDMORE, m) for m in message[:-1]])
-            self.queue.append((0, message[-1]))
-
-        # this is crazy hack: if we make such call, zeromq happily signals
-        # available events on other connections
-        self.socket.getsockopt(constants.EVENTS)
+            size = sum(len(m) for m in message)
+        self.queue.append((message, size, tracked))
+        self.queuedBytes += size
+        self.queuedMessages += 1
+        return True
 
+    def _flush(self):
+        """
+        Send as much of queued messages as possible.
+        """
         self._startWriting()
+        # sending changes socket state without signalling file descriptor,
+        # so events have to be re-checked (once per reactor iteration)
+        self._scheduleRead()
+
+    def messagesReceived(self, messages):
+        """
+        Called on batch of incoming messages read on single reactor
+        wakeup.
+
+        Default implementation calls L{messageReceived} for each message.
+        Override it to process whole batch in one call.
+
+        @param messages: list of messages
+        @type messages: C{list}
+        """
+        for message in messages:
+            if self.factory is None:  # disconnected
+                return
+            self.messageReceived(message)
+
+    def _callHandler(self, key, f, *args):
+        """
+        Call message handler in L{executor}, or in reactor thread if it is
+        not set.
+
+        @param key: ordering key, used if L{executorOrdering} is set
+        @param f: message handler
+        @return: deferred firing with handler result
+        @rtype: L{Deferred}
+        """
+        if self.executor is None:
+            return defer.maybeDeferred(f, *args)
+        if not isinstance(self.executor, ThreadExecutor):
+            # handlers are bound methods, other executors can't run them
+            return defer.fail(TypeError(
+                "%r can't run message handlers, use ThreadExecutor" % (
+                    self.executor,)))
+        if not self.executorOrdering:
+            return self.executor.submit(f, *args)
+        if self._serializer is None:
+            self._serializer = KeyedSerializer()
+        return self._serializer.run(key, self.executor.submit, f, *args)
 
     def messageReceived(self, message):
         """
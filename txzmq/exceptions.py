@@ -32,3 +32,34 @@ class PublishingError(ZmqError):
     """
     Raised when there is an issue publishing.
     """
+
+
+class QueueFullError(ZmqError):
+    """
+    Raised when outgoing message queue is full.
+    """
+
+
+class CodecError(ZmqError):
+    """
+    Raised when there is an issue encoding or decoding message payload.
+    """
+
+
+class RequestTimeoutError(ZmqError):
+    """
+    Raised when there is no reply to request in time.
+    """
+
+
+class ExecutorError(ZmqError):
+    """
+    Raised when function run in worker process fails with exception which
+    can't be passed back.
+    """
+
+
+class TransferAbortedError(ZmqError):
+    """
+    Raised when streaming transfer is aborted by either side.
+    """
@@ -0,0 +1,244 @@
+"""
+Executors running CPU-heavy message handlers off the reactor thread.
+"""
+import cPickle
+import multiprocessing
+import signal
+
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+from txzmq import exceptions, util
+
+
+class Executor(object):
+    """
+    Runs functions outside of reactor thread, results are delivered back
+    to reactor thread via deferreds.
+
+    @ivar reactor: Twisted reactor
+    """
+
+    def __init__(self, reactor=None):
+        """
+        Constructor.
+
+        @param reactor: Twisted reactor, global one by default
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self._running = False
+        self._shutdownTrigger = None
+
+    def submit(self, f, *args, **kwargs):
+        """
+        Run function, starting workers if needed.
+
+        @param f: function to run
+        @return: deferred firing with function result
+        @rtype: L{Deferred}
+        """
+        if not self._running:
+            self.start()
+        return self._submit(f, args, kwargs)
+
+    def start(self):
+        """
+        Start workers, they are stopped on reactor shutdown.
+        """
+        if self._running:
+            return
+        self._running = True
+        self._startWorkers()
+        if self._shutdownTrigger is None:
+            self._shutdownTrigger = self.reactor.addSystemEventTrigger(
+                'during', 'shutdown', self.stop)
+
+    def stop(self):
+        """
+        Stop workers.
+        """
+        if not self._running:
+            return
+        self._running = False
+        self._stopWorkers()
+
+    def _startWorkers(self):
+        raise NotImplementedError(self)
+
+    def _stopWorkers(self):
+        raise NotImplementedError(self)
+
+    def _submit(self, f, args, kwargs):
+        raise NotImplementedError(self)
+
+
+class ThreadExecutor(Executor):
+    """
+    Executor running functions in bounded pool of threads.
+
+    Functions share memory with reactor thread, but they shouldn't
+    touch connections directly: use returned deferreds or
+    C{reactor.callFromThread}.
+
+    @ivar pool: thread pool
+    @type pool: L{ThreadPool}
+    """
+
+    def __init__(self, maxThreads=4, reactor=None):
+        """
+        Constructor.
+
+        @param maxThreads: maximum number of threads
+        @type maxThreads: C{int}
+        @param reactor: Twisted reactor, global one by default
+        """
+        Executor.__init__(self, reactor)
+        self.pool = ThreadPool(0, maxThreads, "txzmq.executor")
+
+    def _startWorkers(self):
+        self.pool.start()
+
+    def _stopWorkers(self):
+        self.pool.stop()
+
+    def _submit(self, f, args, kwargs):
+        return threads.deferToThreadPool(
+            self.reactor, self.pool, f, *args, **kwargs)
+
+
+def _initWorker():
+    """
+    Restore signal handlers installed by reactor in parent process, so
+    worker could be terminated.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _call(f, args, kwargs):
+    """
+    Call function in worker process.
+
+    @return: C{(succeeded, result or exception)}
+    @rtype: C{tuple}
+    """
+    try:
+        result = f(*args, **kwargs)
+    except Exception, err:
+        try:
+            cPickle.dumps(err, cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            err = exceptions.ExecutorError(util.buildErrorMessage(err))
+        return False, err
+    try:
+        cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+    except Exception, err:
+        # pool would drop result it can't send back
+        return False, exceptions.ExecutorError(
+            "can't pickle result: %s" % (util.buildErrorMessage(err),))
+    return True, result
+
+
+class ProcessExecutor(Executor):
+    """
+    Executor running functions in pool of worker processes, so they could
+    use more than one CPU core.
+
+    Functions, their arguments and results should be picklable, otherwise
+    returned deferred fails with L{exceptions.ExecutorError}. Bound
+    methods (like message handlers of connections) can't be run here, so
+    connections don't accept it as their executor: handlers should submit
+    module-level functions themselves.
+
+    @ivar processes: number of worker processes, number of CPUs by
+        default
+    @type processes: C{int}
+    @ivar pool: process pool, created by L{start}
+    @type pool: L{multiprocessing.pool.Pool}
+    """
+
+    def __init__(self, processes=None, reactor=None):
+        """
+        Constructor.
+
+        @param processes: number of worker processes
+        @type processes: C{int}
+        @param reactor: Twisted reactor, global one by default
+        """
+        Executor.__init__(self, reactor)
+        self.processes = processes
+        self.pool = None
+
+    def _startWorkers(self):
+        self.pool = multiprocessing.Pool(self.processes, _initWorker)
+
+    def _stopWorkers(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+
+    def _submit(self, f, args, kwargs):
+        try:
+            # pool would drop task it can't send to worker
+            cPickle.dumps((f, args, kwargs), cPickle.HIGHEST_PROTOCOL)
+        except Exception, err:
+            return defer.fail(exceptions.ExecutorError(
+                "can't pickle task: %s" % (util.buildErrorMessage(err),)))
+        d = defer.Deferred()
+
+        def done(result):
+            # called in pool result handler thread
+            self.reactor.callFromThread(self._done, d, result)
+
+        self.pool.apply_async(_call, (f, args, kwargs), callback=done)
+        return d
+
+    def _done(self, d, result):
+        succeeded, value = result
+        if succeeded:
+            d.callback(value)
+        else:
+            d.errback(value)
+
+
+class KeyedSerializer(object):
+    """
+    Runs functions returning deferreds one after another for the same
+    key, functions for different keys run concurrently.
+    """
+
+    def __init__(self):
+        # key -> deferred firing when last function for key is done
+        self._tails = {}
+
+    def run(self, key, f, *args, **kwargs):
+        """
+        Run function after all the functions previously run for key.
+
+        @param key: ordering key
+        @param f: function returning deferred
+        @return: deferred firing with function result
+        @rtype: L{Deferred}
+        """
+        previous = self._tails.get(key)
+        if previous is None:
+            d = defer.maybeDeferred(f, *args, **kwargs)
+        else:
+            d = defer.Deferred()
+
+            def start(_):
+                defer.maybeDeferred(f, *args, **kwargs).chainDeferred(d)
+
+            previous.addCallback(start)
+        tail = self._tails[key] = defer.Deferred()
+
+        def done(result):
+            if self._tails.get(key) is tail:
+                del self._tails[key]
+            tail.callback(None)
+            return result
+
+        return d.addBoth(done)
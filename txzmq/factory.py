@@ -18,6 +18,10 @@ class ZmqFactory(object):
     @cvar: lingerPeriod: number of milliseconds to block when closing socket
         (terminating context), when there are some messages pending to be sent
     @type lingerPeriod: C{int}
+    @cvar socketOptions: ZeroMQ options set on all the sockets, by option
+        name (like C{'SNDBUF'}) or constant; connections could override
+        them with their own L{ZmqConnection.socketOptions}
+    @type socketOptions: C{dict}
 
     @ivar connections: set of instanciated L{ZmqConnection}s
     @type connections: C{set}
@@ -28,6 +32,7 @@ class ZmqFactory(object):
     reactor = reactor
     ioThreads = 1
     lingerPeriod = 100
+    socketOptions = {}
 
     def __init__(self):
         """
@@ -1,9 +1,13 @@
 """
 ZeroMQ PUB-SUB wrappers.
 """
+from collections import OrderedDict
+
 from zmq.core import constants
+from zmq.core.message import Frame
 
 from twisted.internet import defer
+from twisted.python import log
 
 from txzmq import exceptions, util
 from txzmq.connection import ZmqConnection
@@ -12,8 +16,14 @@ from txzmq.connection import ZmqConnection
 class ZmqPubConnection(ZmqConnection):
     """
     Publishing in broadcast manner.
+
+    @cvar multipartTags: if True, tag and message are sent as separate
+        parts of multipart message, otherwise they are joined as
+        C{tag + '\0' + message}; subscribers understand both formats
+    @type multipartTags: C{boolean}
     """
     socketType = constants.PUB
+    multipartTags = False
 
     def publish(self, message, tag=''):
         """
@@ -27,33 +37,201 @@ class ZmqPubConnection(ZmqConnection):
         @param tag: message tag
         @type tag: C{str}
         """
+        return self._publish([tag], [[message]])
+
+    def publishMany(self, messages):
+        """
+        Broadcast several messages at once.
+
+        This is cheaper than calling L{publish} for each message, messages
+        are queued in one pass and flushed once.
+
+        @param messages: C{(tag, message)} pairs
+        @type messages: iterable
+        @return: deferred firing when all the messages are published, or
+            failing with L{exceptions.PublishingError}
+        @rtype: L{Deferred}
+        """
+        tags, payloads = [], []
+        for tag, message in messages:
+            tags.append(tag)
+            payloads.append([message])
+        if not tags:
+            return defer.succeed(self)
+        return self._publish(tags, payloads)
+
+    def _publish(self, tags, payloads):
+        """
+        Publish messages with tags.
+
+        @param tags: message tags
+        @type tags: C{list}
+        @param payloads: list of single-item lists with messages
+        @type payloads: C{list}
+        """
+        if self.multipartTags:
+            def build(tag, parts):
+                return [tag, parts[0]]
+        else:
+            def build(tag, parts):
+                return tag + '\0' + parts[0]
         try:
-            self.send(tag + '\0' + message)
+            d = self._sendPayloads(tags, payloads, build)
         except Exception, err:
             msg = util.buildErrorMessage(err)
             return defer.fail(exceptions.PublishingError(msg))
-        else:
+        if d is None:
             return defer.succeed(self)
 
+        def failed(failure):
+            msg = util.buildErrorMessage(failure.value)
+            raise exceptions.PublishingError(msg)
+
+        return d.addCallbacks(lambda _: self, failed)
+
+
+class _TopicTrie(object):
+    """
+    Prefix trie mapping tag prefixes to handlers.
+
+    Lookup cost depends on tag length, not on number of prefixes.
+
+    @ivar handlers: handlers registered for prefix ending at this node
+    @type handlers: C{list}
+    @ivar children: child nodes by next character of prefix
+    @type children: C{dict}
+    """
+
+    def __init__(self):
+        self.handlers = []
+        self.children = {}
+
+    def add(self, prefix, handler):
+        """
+        Register handler for prefix.
+
+        @param prefix: tag prefix
+        @type prefix: C{str}
+        @param handler: callable
+        """
+        node = self
+        for char in prefix:
+            node = node.children.setdefault(char, _TopicTrie())
+        node.handlers.append(handler)
+
+    def remove(self, prefix, handler):
+        """
+        Unregister handler for prefix, pruning nodes left empty.
+
+        @param prefix: tag prefix
+        @type prefix: C{str}
+        @param handler: callable
+        @raise ValueError: handler is not registered for prefix
+        """
+        path = [self]
+        for char in prefix:
+            node = path[-1].children.get(char)
+            if node is None:
+                raise ValueError("no handlers for prefix %r" % (prefix,))
+            path.append(node)
+        path[-1].handlers.remove(handler)
+        for i in xrange(len(prefix), 0, -1):
+            if path[i].handlers or path[i].children:
+                break
+            del path[i - 1].children[prefix[i - 1]]
+
+    def match(self, tag):
+        """
+        Find handlers for all the prefixes of tag, shortest first.
+
+        @param tag: message tag
+        @type tag: C{str}
+        @rtype: C{list}
+        """
+        node = self
+        handlers = list(node.handlers)
+        for char in tag:
+            node = node.children.get(char)
+            if node is None:
+                break
+            handlers.extend(node.handlers)
+        return handlers
+
 
 class ZmqSubConnection(ZmqConnection):
     """
     Subscribing to messages.
+
+    Messages could be dispatched to handlers registered for tag prefixes
+    with L{addHandler}, messages not matching any handler are passed to
+    L{gotMessage}.
+
+    @cvar conflate: if True, only latest message per tag is delivered,
+        older messages received since last delivery are dropped
+    @type conflate: C{boolean}
+    @cvar conflateInterval: with L{conflate}, deliver messages every
+        that many seconds; if C{None}, deliver at the end of each batch
+        read on reactor wakeup
+    @type conflateInterval: C{float}
+    @cvar conflateMaxTags: with L{conflate}, deliver pending messages
+        right away when that many different tags are pending
+    @type conflateMaxTags: C{int}
+    @ivar conflatedMessages: number of messages dropped by conflation
+    @type conflatedMessages: C{int}
     """
     socketType = constants.SUB
+    conflate = False
+    conflateInterval = None
+    conflateMaxTags = 10000
+
+    def __init__(self, *endpoints):
+        ZmqConnection.__init__(self, *endpoints)
+        self._subscriptions = {}
+        self._handlers = _TopicTrie()
+        self._conflated = OrderedDict()
+        self._conflateCall = None
+        self.conflatedMessages = 0
+
+    def shutdown(self):
+        """
+        Shutdown connection and socket, dropping conflated messages.
+        """
+        if self._conflateCall is not None:
+            self._conflateCall.cancel()
+            self._conflateCall = None
+        self._conflated.clear()
+        ZmqConnection.shutdown(self)
 
     def subscribe(self, tag):
         """
         Subscribe to messages with specified tag (prefix).
 
+        Subscriptions are reference counted, socket is subscribed only
+        on first subscription to the tag.
+
         For notes about the use of deferred here, see the deffered comment in
         the docstring for ZmqConnection.connect.
 
         @param tag: message tag
         @type tag: C{str}
         """
+        return self.subscribeMany([tag])
+
+    def subscribeMany(self, tags):
+        """
+        Subscribe to messages with any of specified tags (prefixes).
+
+        Duplicate tags are subscribed once.
+
+        @param tags: message tags
+        @type tags: iterable
+        """
         try:
-            self.socket.setsockopt(constants.SUBSCRIBE, tag)
+            for tag in self._uniqueTags(tags):
+                count = self._subscriptions.get(tag, 0)
+                if count == 0:
+                    self.socket.setsockopt(constants.SUBSCRIBE, tag)
+                self._subscriptions[tag] = count + 1
         except Exception, err:
             msg = util.buildErrorMessage(err)
             return defer.fail(exceptions.SubscribingError(msg))
@@ -64,32 +242,216 @@ class ZmqSubConnection(ZmqConnection):
         """
         Unsubscribe from messages with specified tag (prefix).
 
+        Socket is unsubscribed only when last subscription to the tag is
+        dropped (or if tag wasn't subscribed via L{subscribe}).
+
         For notes about the use of deferred here, see the deffered comment in
         the docstring for ZmqConnection.connect.
 
         @param tag: message tag
         @type tag: C{str}
         """
+        return self.unsubscribeMany([tag])
+
+    def unsubscribeMany(self, tags):
+        """
+        Unsubscribe from messages with any of specified tags (prefixes).
+
+        Duplicate tags are unsubscribed once.
+
+        @param tags: message tags
+        @type tags: iterable
+        """
         try:
-            self.socket.setsockopt(constants.UNSUBSCRIBE, tag)
+            for tag in self._uniqueTags(tags):
+                count = self._subscriptions.get(tag, 1)
+                if count == 1:
+                    self.socket.setsockopt(constants.UNSUBSCRIBE, tag)
+                    self._subscriptions.pop(tag, None)
+                else:
+                    self._subscriptions[tag] = count - 1
         except Exception, err:
             msg = util.buildErrorMessage(err)
             return defer.fail(exceptions.UnsubscribingError(msg))
         else:
             return defer.succeed(self)
 
+    def _uniqueTags(self, tags):
+        """
+        Iterate over tags, skipping duplicates.
+
+        @param tags: message tags
+        @type tags: iterable
+        """
+        seen = set()
+        for tag in tags:
+            if tag not in seen:
+                seen.add(tag)
+                yield tag
+
+    def addHandler(self, prefix, handler):
+        """
+        Subscribe to messages with specified tag prefix and dispatch them
+        to handler.
+
+        Each registered handler holds its own subscription, so it should
+        be paired with L{removeHandler}.
+
+        @param prefix: message tag prefix
+        @type prefix: C{str}
+        @param handler: callable accepting C{(message, tag)}
+        """
+        d = self.subscribe(prefix)
+        d.addCallback(self._addedHandler, prefix, handler)
+        return d
+
+    def _addedHandler(self, result, prefix, handler):
+        """
+        Register handler after successful subscription.
+        """
+        self._handlers.add(prefix, handler)
+        return result
+
+    def removeHandler(self, prefix, handler):
+        """
+        Unregister handler added with L{addHandler} and drop its
+        subscription.
+
+        @param prefix: message tag prefix
+        @type prefix: C{str}
+        @param handler: callable passed to L{addHandler}
+        @raise ValueError: handler is not registered for prefix
+        """
+        self._handlers.remove(prefix, handler)
+        return self.unsubscribe(prefix)
+
+    def messagesReceived(self, messages):
+        """
+        Called on batch of incoming messages, conflates them if
+        L{conflate} is set.
+
+        @param messages: list of messages
+        @type messages: C{list}
+        """
+        if not self.conflate:
+            return ZmqConnection.messagesReceived(self, messages)
+
+        conflated = self._conflated
+        for message in messages:
+            tag, payload = self._splitMessage(message)
+            if tag in conflated:
+                self.conflatedMessages += 1
+            conflated[tag] = payload
+            if len(conflated) >= self.conflateMaxTags:
+                self._deliverConflated()
+        if not conflated:
+            return
+        if self.conflateInterval is None:
+            self._deliverConflated()
+        elif self._conflateCall is None:
+            self._conflateCall = self.factory.reactor.callLater(
+                self.conflateInterval, self._deliverConflated)
+
+    def _deliverConflated(self):
+        """
+        Deliver latest message for each tag conflated so far.
+        """
+        if self._conflateCall is not None:
+            if self._conflateCall.active():
+                self._conflateCall.cancel()
+            self._conflateCall = None
+        conflated = self._conflated.items()
+        self._conflated.clear()
+        for tag, payload in conflated:
+            if self.factory is None:  # disconnected
+                return
+            log.callWithLogger(self, self._dispatch, payload, tag)
+
     def messageReceived(self, message):
         """
         Called on incoming message from ZeroMQ.
 
         @param message: message data
         """
+        tag, payload = self._splitMessage(message)
+        self._dispatch(payload, tag)
+
+    def _splitMessage(self, message):
+        """
+        Split message into tag and payload.
+
+        @param message: message data
+        @type message: C{list}
+        @return: C{(tag, payload)}
+        @rtype: C{tuple}
+        """
         if len(message) == 2:
-            # compatibility receiving of tag as first part
-            # of multi-part message
-            self.gotMessage(message[1], message[0])
+            # tag as first part of multi-part message
+            return util.toBytes(message[0]), message[1]
+        return self._splitTag(message[0])
+
+    def _dispatch(self, payload, tag):
+        """
+        Pass message to handlers registered for its tag, or to
+        L{gotMessage} if there are none.
+
+        @param payload: message payload
+        @param tag: message tag
+        @type tag: C{str}
+        """
+        handlers = self._handlers.match(tag) or [self.gotMessage]
+        if self.executor is None:
+            self._callHandlers(handlers, payload, tag)
         else:
-            self.gotMessage(*reversed(message[0].split('\0', 1)))
+            d = self._callHandler(
+                tag, self._callHandlers, handlers, payload, tag)
+            d.addErrback(log.err, "Message handler failed in %r" % (self,))
+
+    def _callHandlers(self, handlers, payload, tag):
+        """
+        Pass message to handlers.
+
+        @param handlers: list of handlers
+        @type handlers: C{list}
+        @param payload: message payload
+        @param tag: message tag
+        @type tag: C{str}
+        """
+        for handler in handlers:
+            handler(payload, tag)
+
+    def _splitTag(self, part):
+        """
+        Split message part into tag and payload, joined by C{'\0'}.
+
+        Payload received without copying (as L{Frame} or C{memoryview}) is
+        returned as C{memoryview}, so it is not copied here either.
+
+        @param part: message part
+        @type part: C{str}, L{Frame} or C{memoryview}
+        @return: C{(tag, payload)}
+        @rtype: C{tuple}
+        """
+        if isinstance(part, str):
+            return part.split('\0', 1)
+        if isinstance(part, Frame):
+            part = util.frameBuffer(part)
+        i = 0
+        while part[i] != '\0':
+            i += 1
+        return part[:i].tobytes(), part[i + 1:]
+
+    def _splitPayload(self, message):
+        """
+        Split message into tag and payload.
+
+        @param message: message data
+        @type message: C{list}
+        """
+        if len(message) == 2:
+            return [message[0]], [message[1]]
+        tag, payload = self._splitTag(message[0])
+        return [tag], [payload]
 
     def gotMessage(self, message, tag):
         """
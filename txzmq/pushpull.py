@@ -0,0 +1,367 @@
+"""
+ZeroMQ PUSH-PULL wrappers and pipeline (ventilator, workers, sink).
+
+Plain PUSH socket distributes messages round-robin, so slow workers build
+up queues. L{ZmqVentilatorConnection} and L{ZmqWorkerConnection} use
+credit-based flow control instead: each worker grants ventilator credit
+for number of tasks it is ready to handle, and ventilator sends tasks only
+to workers with credit left.
+
+Workers send heartbeats to ventilator, and tell it credit they think it
+has left with every message: ventilator drops credit of workers it didn't
+hear from for L{ZmqVentilatorConnection.heartbeatLiveness} heartbeat
+intervals, and learns it again if worker turns out to be alive.
+"""
+import operator
+from collections import OrderedDict, deque
+
+from zmq.core import constants
+
+from twisted.internet import defer, task
+from twisted.python import log
+
+from txzmq import util
+from txzmq.connection import ZmqConnection
+
+
+CREDIT = 'CREDIT'
+HEARTBEAT = 'HEARTBEAT'
+
+
+class ZmqPushConnection(ZmqConnection):
+    """
+    Pushing messages to pullers, round-robin.
+    """
+    socketType = constants.PUSH
+
+    def push(self, *message_parts):
+        """
+        Push message.
+
+        @param message_parts: message data
+        @type message_parts: C{tuple}
+        """
+        self._sendPayloads([[]], [message_parts], operator.add)
+
+    def pushMany(self, messages):
+        """
+        Push several messages at once.
+
+        @param messages: list of messages, each is C{tuple} of parts
+        @type messages: C{list}
+        """
+        messages = map(list, messages)
+        if messages:
+            self._sendPayloads([[]] * len(messages), messages, operator.add)
+
+
+class ZmqPullConnection(ZmqConnection):
+    """
+    Pulling messages from pushers.
+    """
+    socketType = constants.PULL
+
+    def messageReceived(self, message):
+        """
+        Called on incoming message from ZeroMQ.
+
+        @param message: message data
+        """
+        self.gotMessage(*message)
+
+    def gotMessage(self, *message_parts):
+        """
+        Called on incoming message.
+
+        @param message_parts: message data
+        """
+        raise NotImplementedError(self)
+
+
+class ZmqVentilatorConnection(ZmqConnection):
+    """
+    Distributing tasks to L{ZmqWorkerConnection}s which have credit.
+
+    Tasks submitted when no worker has credit are queued. Tasks sent to
+    workers which went away are lost, their credit is dropped once they
+    miss heartbeats.
+
+    @cvar heartbeatInterval: interval between checks of worker heartbeats
+        (in seconds), should be the same as workers'
+    @type heartbeatInterval: C{float}
+    @cvar heartbeatLiveness: number of heartbeat intervals without word
+        from worker its credit is dropped after
+    @type heartbeatLiveness: C{int}
+
+    @ivar pendingTasks: tasks waiting for credit
+    @type pendingTasks: C{deque}
+    @ivar workers: identity -> time worker is forgotten at, for workers
+        alive
+    @type workers: C{dict}
+    """
+    socketType = constants.XREP
+    heartbeatInterval = 1.0
+    heartbeatLiveness = 3
+
+    def __init__(self, *endpoints):
+        ZmqConnection.__init__(self, *endpoints)
+        self.pendingTasks = deque()
+        self.workers = {}
+        # worker identity -> credit, in order of serving
+        self._credits = OrderedDict()
+        self._heartbeat = None
+
+    def _connectOrBind(self, factory):
+        ZmqConnection._connectOrBind(self, factory)
+        self._heartbeat = task.LoopingCall(self._expireWorkers)
+        self._heartbeat.clock = factory.reactor
+        self._heartbeat.start(self.heartbeatInterval, now=False)
+
+    def shutdown(self):
+        """
+        Shutdown connection and socket.
+        """
+        if self._heartbeat is not None and self._heartbeat.running:
+            self._heartbeat.stop()
+        ZmqConnection.shutdown(self)
+
+    def submit(self, *task_parts):
+        """
+        Send task to worker, or queue it.
+
+        @param task_parts: task message data
+        @type task_parts: C{tuple}
+        """
+        self.pendingTasks.append(list(task_parts))
+        self._dispatch()
+
+    def submitMany(self, tasks):
+        """
+        Send several tasks at once.
+
+        @param tasks: list of tasks, each is C{tuple} of parts
+        @type tasks: C{list}
+        """
+        self.pendingTasks.extend(map(list, tasks))
+        self._dispatch()
+
+    def _dispatch(self):
+        """
+        Send pending tasks to workers with credit, round-robin.
+        """
+        envelopes, payloads = [], []
+        credits = self._credits
+        while self.pendingTasks and credits:
+            identity, credit = credits.popitem(False)
+            envelopes.append([identity])
+            payloads.append(self.pendingTasks.popleft())
+            if credit > 1:
+                credits[identity] = credit - 1
+        if envelopes:
+            self._sendPayloads(envelopes, payloads, operator.add)
+
+    def _splitPayload(self, message):
+        """
+        Credit messages have no payload.
+        """
+        return message, []
+
+    def messageReceived(self, message):
+        """
+        Called on incoming message from ZeroMQ.
+
+        @param message: message data
+        """
+        identity, command = util.toBytes(message[0]), util.toBytes(message[1])
+        if command not in (CREDIT, HEARTBEAT):
+            log.msg("Unknown command %r from worker %r in %r" % (
+                command, identity, self))
+            return
+        known = identity in self.workers
+        self._workerSeen(identity)
+        if not known:
+            # new or forgotten worker: take its word on credit left
+            credit = int(util.toBytes(message[-1]))
+        elif command == CREDIT:
+            credit = (self._credits.get(identity, 0) +
+                      int(util.toBytes(message[2])))
+        else:
+            return
+        if credit > 0:
+            self._credits[identity] = credit
+        else:
+            self._credits.pop(identity, None)
+        self._dispatch()
+
+    def _workerSeen(self, identity):
+        self.workers[identity] = self.factory.reactor.seconds() + (
+            self.heartbeatInterval * self.heartbeatLiveness)
+
+    def _expireWorkers(self):
+        """
+        Drop credit of workers which are silent for too long.
+        """
+        now = self.factory.reactor.seconds()
+        dead = [identity for identity, deadline in self.workers.iteritems()
+                if deadline < now]
+        for identity in dead:
+            log.msg("Worker %r is gone in %r" % (identity, self))
+            del self.workers[identity]
+            self._credits.pop(identity, None)
+
+
+class ZmqWorkerConnection(ZmqConnection):
+    """
+    Handling tasks from L{ZmqVentilatorConnection}.
+
+    Worker grants L{credit} on connect and gives credit back as tasks
+    are done, so it never has more than L{credit} tasks queued.
+
+    @cvar credit: number of tasks worker handles at once
+    @type credit: C{int}
+    @cvar creditBatch: credit is given back in batches of this size (or
+        whatever is done once worker has no tasks left)
+    @type creditBatch: C{int}
+    @cvar heartbeatInterval: interval between heartbeats (in seconds),
+        should be the same as ventilator's
+    @type heartbeatInterval: C{float}
+    @ivar sink: connection results of tasks are pushed to, if set
+    @type sink: L{ZmqPushConnection}
+    """
+    socketType = constants.XREQ
+    credit = 10
+    creditBatch = 1
+    heartbeatInterval = 1.0
+
+    def __init__(self, *endpoints):
+        ZmqConnection.__init__(self, *endpoints)
+        self.sink = None
+        self._doneTasks = 0
+        self._runningTasks = 0
+        # credit granted, but not used by ventilator yet
+        self._unusedCredit = 0
+        self._heartbeat = None
+
+    def _connectOrBind(self, factory):
+        ZmqConnection._connectOrBind(self, factory)
+        self._grantCredit(self.credit)
+        self._heartbeat = task.LoopingCall(self._sendHeartbeat)
+        self._heartbeat.clock = factory.reactor
+        self._heartbeat.start(self.heartbeatInterval, now=False)
+
+    def shutdown(self):
+        """
+        Shutdown connection and socket.
+        """
+        if self._heartbeat is not None and self._heartbeat.running:
+            self._heartbeat.stop()
+        ZmqConnection.shutdown(self)
+
+    def _grantCredit(self, credit):
+        """
+        Send credit to ventilator.
+
+        @param credit: number of tasks
+        @type credit: C{int}
+        """
+        self._unusedCredit += credit
+        self.send([CREDIT, str(credit), str(self._unusedCredit)])
+
+    def _sendHeartbeat(self):
+        self.send([HEARTBEAT, str(self._unusedCredit)])
+
+    def messageReceived(self, message):
+        """
+        Called on incoming task from ZeroMQ.
+
+        @param message: message data
+        """
+        self._unusedCredit -= 1
+        self._runningTasks += 1
+        d = defer.maybeDeferred(self.gotMessage, *message)
+        d.addCallback(self._taskDone)
+        d.addErrback(log.err, "Task failed in %r" % (self,))
+        d.addBoth(self._taskFinished)
+
+    def _taskDone(self, result):
+        """
+        Push task result to L{sink}.
+        """
+        if result is None or self.sink is None:
+            return
+        if not isinstance(result, tuple):
+            result = (result,)
+        self.sink.push(*result)
+
+    def _taskFinished(self, _):
+        """
+        Give credit back to ventilator.
+        """
+        if self.factory is None:  # disconnected
+            return
+        self._runningTasks -= 1
+        self._doneTasks += 1
+        # ventilator might have no credit left to send more tasks
+        if self._doneTasks >= self.creditBatch or not self._runningTasks:
+            self._grantCredit(self._doneTasks)
+            self._doneTasks = 0
+
+    def gotMessage(self, *message_parts):
+        """
+        Called on incoming task.
+
+        @param message_parts: task data
+        @return: task result (tuple for multipart result) pushed to
+            L{sink}, or deferred firing with it
+        """
+        raise NotImplementedError(self)
+
+
+class ZmqSinkConnection(ZmqPullConnection):
+    """
+    Collecting results pushed by workers.
+
+    Results not yet collected with L{collect} are kept in
+    L{pendingResults}.
+
+    @ivar pendingResults: results received, but not collected
+    @type pendingResults: C{deque}
+    """
+
+    def __init__(self, *endpoints):
+        ZmqPullConnection.__init__(self, *endpoints)
+        self.pendingResults = deque()
+        self._collectors = deque()
+
+    def collect(self, count):
+        """
+        Collect results.
+
+        @param count: number of results
+        @type count: C{int}
+        @return: deferred firing with list of C{count} results, each is
+            list of message parts
+        @rtype: L{Deferred}
+        """
+        d = defer.Deferred()
+        self._collectors.append((count, [], d))
+        self._collect()
+        return d
+
+    def gotMessage(self, *message_parts):
+        self.pendingResults.append(list(message_parts))
+        self._collect()
+
+    def _collect(self):
+        """
+        Pass pending results to collectors.
+        """
+        while self._collectors and (
+                self.pendingResults or self._collectors[0][0] == 0):
+            count, results, d = self._collectors[0]
+            while self.pendingResults and len(results) < count:
+                results.append(self.pendingResults.popleft())
+            if len(results) < count:
+                return
+            self._collectors.popleft()
+            d.callback(results)
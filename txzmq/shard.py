@@ -0,0 +1,265 @@
+"""
+Running connections in several worker processes.
+
+Twisted runs single reactor per process, so Python-side message handling
+of one process is limited to one CPU core. L{ZmqShardedFactory} starts
+several worker processes (shards), each running its own reactor and
+L{ZmqFactory} with the same connections.
+
+Connect endpoints are connected from each shard as is, ZeroMQ balances
+load between shards itself. Bind endpoints are bound once, in this
+process, by ZeroMQ device forwarding messages to shards over IPC, so
+only socket types which balance load are supported for them: XREP
+(requests are balanced with XREQ socket) and PULL.
+
+Shards keep their standard input open to this process and stop once it
+is closed, so they don't outlive it even if it dies without shutting
+them down.
+"""
+import cPickle
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import zmq
+from zmq.core import constants, error
+from zmq.core.context import Context
+
+from twisted.internet import error as twisted_error
+from twisted.python import log
+
+from txzmq.connection import ZmqEndpoint, ZmqEndpointType
+from txzmq.factory import ZmqFactory
+
+
+# directory containing txzmq package, made absolute while working
+# directory is the same as when package was imported
+_packagePath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# socket type of bound connection -> (frontend, backend, device) types
+_devices = {
+    constants.XREP: (constants.XREP, constants.XREQ, zmq.QUEUE),
+    constants.PULL: (constants.PULL, constants.PUSH, zmq.STREAMER),
+}
+
+
+def _runDevice(deviceType, frontend, backend):
+    """
+    Run ZeroMQ device until context is terminated.
+    """
+    try:
+        zmq.device(deviceType, frontend, backend)
+    except error.ZMQError:
+        pass
+    finally:
+        frontend.close()
+        backend.close()
+
+
+class ZmqShardedFactory(object):
+    """
+    I run connections in several worker processes.
+
+    Connection classes (and setup functions) are passed to workers by
+    reference, so they should be importable, e.g. not defined in
+    C{__main__}.
+
+    @cvar ioThreads: number of IO threads of ZeroMQ context used by
+        devices in this process
+    @type ioThreads: C{int}
+    @cvar shutdownTimeout: time (in seconds) to wait for worker processes
+        to exit on shutdown before killing them
+    @type shutdownTimeout: C{float}
+
+    @ivar shards: number of worker processes
+    @type shards: C{int}
+    @ivar processes: running worker processes
+    @type processes: C{list} of L{subprocess.Popen}
+    """
+
+    ioThreads = 1
+    shutdownTimeout = 5.0
+
+    def __init__(self, shards=None):
+        """
+        Constructor.
+
+        @param shards: number of worker processes, number of CPUs by
+            default
+        @type shards: C{int}
+        """
+        self.shards = shards or multiprocessing.cpu_count()
+        self.processes = []
+        self._connections = []
+        self._devices = []
+        self._threads = []
+        self._context = None
+        self._ipcDir = None
+
+    def __repr__(self):
+        return "ZmqShardedFactory(%d)" % (self.shards,)
+
+    def addConnection(self, connectionClass, *endpoints, **kwargs):
+        """
+        Run connection in each shard, once they are started.
+
+        @param connectionClass: connection class, subclass of
+            L{ZmqConnection}
+        @param endpoints: ZeroMQ addresses for connect/bind
+        @type endpoints: C{list} of L{ZmqEndpoint}
+        @keyword setup: function called in shard with connection and
+            shard number, once connection is connected
+        @raise ValueError: bind endpoint with socket type which can't be
+            balanced between shards
+        """
+        setup = kwargs.pop('setup', None)
+        if kwargs:
+            raise TypeError("unexpected keyword arguments: %s" % (
+                ", ".join(kwargs),))
+        shardEndpoints = []
+        for endpoint in endpoints:
+            if endpoint.type == ZmqEndpointType.bind:
+                endpoint = self._addDevice(
+                    connectionClass.socketType, endpoint)
+            shardEndpoints.append(endpoint)
+        self._connections.append((connectionClass, shardEndpoints, setup))
+
+    def _addDevice(self, socketType, endpoint):
+        """
+        Bind device forwarding messages from endpoint to shards.
+
+        @return: endpoint shards should connect to
+        @rtype: L{ZmqEndpoint}
+        """
+        if socketType not in _devices:
+            raise ValueError(
+                "bound sockets of type %r can't be sharded" % (socketType,))
+        frontendType, backendType, deviceType = _devices[socketType]
+        if self._context is None:
+            self._context = Context(self.ioThreads)
+            self._ipcDir = tempfile.mkdtemp(prefix='txzmq-shard-')
+        address = "ipc://%s/%d" % (self._ipcDir, len(self._devices))
+        frontend = self._context.socket(frontendType)
+        backend = self._context.socket(backendType)
+        for socket in (frontend, backend):
+            socket.setsockopt(constants.LINGER, 0)
+        frontend.bind(endpoint.address)
+        backend.bind(address)
+        self._devices.append((deviceType, frontend, backend))
+        return ZmqEndpoint(ZmqEndpointType.connect, address)
+
+    def start(self):
+        """
+        Start devices and worker processes.
+        """
+        for device in self._devices:
+            thread = threading.Thread(target=_runDevice, args=device)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._devices = []
+
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [_packagePath] + map(os.path.abspath, sys.path)))
+        for shard in xrange(self.shards):
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'txzmq.shard'],
+                stdin=subprocess.PIPE, env=env)
+            cPickle.dump((shard, self._connections), process.stdin,
+                         cPickle.HIGHEST_PROTOCOL)
+            # stdin is left open, shard stops once it is closed
+            process.stdin.flush()
+            self.processes.append(process)
+
+    def shutdown(self):
+        """
+        Stop worker processes and devices.
+        """
+        for process in self.processes:
+            process.stdin.close()
+            if process.poll() is None:
+                process.terminate()
+        deadline = time.time() + self.shutdownTimeout
+        for process in self.processes:
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.01)
+            if process.poll() is None:
+                log.msg("Killing shard process %d in %r" % (
+                    process.pid, self))
+                process.kill()
+                process.wait()
+        self.processes = []
+
+        if self._context is not None:
+            self._context.term()
+            self._context = None
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+            shutil.rmtree(self._ipcDir, ignore_errors=True)
+
+    def registerForShutdown(self):
+        """
+        Register factory to be automatically shut down
+        on reactor shutdown.
+        """
+        from twisted.internet import reactor
+        reactor.addSystemEventTrigger('during', 'shutdown', self.shutdown)
+
+
+def _watchParent(reactor, stdin):
+    """
+    Stop reactor once parent process closes our standard input (or
+    dies).
+    """
+    stdin.read()
+
+    def stop():
+        log.msg("Parent process is gone, stopping shard")
+        try:
+            reactor.stop()
+        except twisted_error.ReactorNotRunning:
+            pass
+
+    reactor.callFromThread(stop)
+
+
+def runShard(shard, connections, stdin=None):
+    """
+    Run connections in worker process, until it is terminated or
+    L{stdin} is closed.
+
+    @param shard: shard number
+    @type shard: C{int}
+    @param connections: list of C{(connectionClass, endpoints, setup)}
+    @type connections: C{list}
+    @param stdin: pipe from parent process, if any
+    @type stdin: C{file}
+    """
+    from twisted.internet import reactor
+
+    if stdin is not None:
+        thread = threading.Thread(target=_watchParent, args=(reactor, stdin))
+        thread.daemon = True
+        thread.start()
+
+    factory = ZmqFactory()
+    factory.registerForShutdown()
+    for connectionClass, endpoints, setup in connections:
+        d = connectionClass(*endpoints).connect(factory)
+        if setup is not None:
+            d.addCallback(setup, shard)
+        d.addErrback(log.err, "Failed to start connection in shard %d" % (
+            shard,))
+    reactor.run()
+
+
+if __name__ == '__main__':
+    log.startLogging(sys.stderr, setStdout=False)
+    shard, connections = cPickle.load(sys.stdin)
+    runShard(shard, connections, sys.stdin)
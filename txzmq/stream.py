@@ -0,0 +1,565 @@
+"""
+Chunked streaming transfers over XREQ/XREP with credit-based flow control.
+
+Sender splits transfer into chunks and never has more chunks in flight
+than receiver granted credit for; receiver grants credit back as chunks
+are consumed. So memory used by transfer is bounded by credit window on
+both ends, whatever size of transfer is.
+
+Sender side of transfer (L{OutgoingTransfer}) is L{IConsumer} data
+producer (e.g. L{FileSender}) writes to, producer is paused while sender
+is out of credit. Receiver side (L{IncomingTransfer}) is L{IPushProducer}
+writing to consumer returned by
+L{ZmqStreamReceiverConnection.gotTransfer}, no credit is granted while
+consumer keeps it paused.
+
+Stream messages bypass L{ZmqConnection.codec} and compression, chunks
+are sent as is.
+"""
+import itertools
+from collections import deque
+
+from zmq.core import constants
+from zope.interface import implements
+
+from twisted.internet import defer
+from twisted.internet.interfaces import IConsumer, IPushProducer
+from twisted.protocols.basic import FileSender
+from twisted.python import log
+
+from txzmq import exceptions, util
+from txzmq.connection import ZmqConnection
+
+
+# sender -> receiver
+OPEN = 'OPEN'
+DATA = 'DATA'
+END = 'END'
+# receiver -> sender
+CREDIT = 'CREDIT'
+DONE = 'DONE'
+# both ways
+ABORT = 'ABORT'
+
+
+class OutgoingTransfer(object):
+    """
+    Sender side of transfer.
+
+    Data written is split into chunks of L{ZmqStreamSenderConnection.
+    chunkSize} and sent as receiver grants credit, the rest is buffered
+    with registered producer paused.
+
+    @ivar transferId: transfer id, unique for sender connection
+    @type transferId: C{str}
+    @ivar done: deferred firing with transfer once receiver got all the
+        data, or failing with L{exceptions.TransferAbortedError}
+    @type done: L{Deferred}
+    @ivar credit: number of chunks which could be sent now
+    @type credit: C{int}
+    @ivar sentChunks: number of chunks sent
+    @type sentChunks: C{int}
+    @ivar sentBytes: number of bytes sent
+    @type sentBytes: C{int}
+    @ivar producer: producer registered via L{registerProducer}
+    """
+    implements(IConsumer)
+
+    def __init__(self, connection, transferId):
+        self.connection = connection
+        self.transferId = transferId
+        self.done = defer.Deferred()
+        self.credit = 0
+        self.sentChunks = 0
+        self.sentBytes = 0
+        self.producer = None
+        self.streamingProducer = False
+        self._producerPaused = False
+        self._chunks = deque()
+        self._finishing = False
+        self._finished = False
+
+    def __repr__(self):
+        return "OutgoingTransfer(%r)" % (self.transferId,)
+
+    def registerProducer(self, producer, streaming):
+        """
+        Register to receive data from a producer.
+
+        Part of L{IConsumer}.
+
+        @param producer: producer
+        @type producer: L{IPushProducer} or L{IPullProducer}
+        @param streaming: True if producer is L{IPushProducer}
+        @type streaming: C{boolean}
+        """
+        if self.producer is not None:
+            raise RuntimeError(
+                "Cannot register producer %s, because producer %s was never "
+                "unregistered." % (producer, self.producer))
+        self.producer = producer
+        self.streamingProducer = streaming
+        # pull producer is "paused" until asked for data
+        self._producerPaused = not streaming
+        self._checkProducer()
+
+    def unregisterProducer(self):
+        """
+        Stop consuming data from a producer.
+
+        Part of L{IConsumer}.
+        """
+        self.producer = None
+        self._producerPaused = False
+
+    def write(self, data):
+        """
+        Send data, as credit allows.
+
+        Part of L{IConsumer}.
+
+        @param data: transfer data
+        @type data: C{str}
+        """
+        if self._finishing:
+            raise RuntimeError("%r is already finished" % (self,))
+        if self._finished:  # aborted
+            return
+        size = self.connection.chunkSize
+        if len(data) <= size:
+            self._chunks.append(data)
+        else:
+            self._chunks.extend(
+                data[offset:offset + size]
+                for offset in xrange(0, len(data), size))
+        if self.producer is not None and not self.streamingProducer:
+            # pull producer waits for resumeProducing() on each write
+            self._producerPaused = True
+        self._flush()
+
+    def finish(self):
+        """
+        Finish transfer once data written so far is sent.
+
+        @return: L{done}
+        @rtype: L{Deferred}
+        """
+        if not self._finishing and not self._finished:
+            self._finishing = True
+            self._flush()
+        return self.done
+
+    def abort(self, reason="aborted by sender"):
+        """
+        Abort transfer, notifying receiver.
+
+        @param reason: reason passed to receiver
+        @type reason: C{str}
+        """
+        if self.done.called:
+            return
+        self.connection.send([self.transferId, ABORT, reason])
+        self._aborted(reason)
+
+    def _flush(self):
+        """
+        Send buffered chunks receiver has credit for.
+        """
+        if self._finished:
+            return
+        chunks = self._chunks
+        count = min(self.credit, len(chunks))
+        if count:
+            messages = []
+            for _ in xrange(count):
+                chunk = chunks.popleft()
+                self.sentBytes += len(chunk)
+                messages.append([self.transferId, DATA, chunk])
+            self.credit -= count
+            self.sentChunks += count
+            self.connection.sendMany(messages)
+        if self._finishing and not chunks:
+            self._finished = True
+            self.connection.send([self.transferId, END])
+        self._checkProducer()
+
+    def _checkProducer(self):
+        """
+        Pause producer while there is no credit, resume it when there is.
+        """
+        if self.producer is None or self._finished:
+            return
+        blocked = bool(self._chunks) or not self.credit
+        if blocked and not self._producerPaused:
+            self._producerPaused = True
+            if self.streamingProducer:
+                self.producer.pauseProducing()
+        elif not blocked and self._producerPaused:
+            self._producerPaused = False
+            if self.streamingProducer:
+                self.producer.resumeProducing()
+            else:
+                # pull producer might be writing from resumeProducing(),
+                # don't recurse into it
+                self.connection.factory.reactor.callLater(
+                    0, self._resumePullProducer)
+
+    def _resumePullProducer(self):
+        """
+        Ask pull producer for more data.
+        """
+        if (self.producer is not None and not self.streamingProducer and
+                not self._producerPaused):
+            self.producer.resumeProducing()
+
+    def _creditGranted(self, credit):
+        """
+        Called when receiver grants credit.
+        """
+        self.credit += credit
+        self._flush()
+
+    def _completed(self):
+        """
+        Called when receiver got all the data.
+        """
+        self.connection._transfers.pop(self.transferId, None)
+        self.done.callback(self)
+
+    def _aborted(self, reason):
+        """
+        Called when transfer is aborted by either side.
+        """
+        self._finished = True
+        self._chunks.clear()
+        self.connection._transfers.pop(self.transferId, None)
+        if not self.done.called:
+            self.done.errback(exceptions.TransferAbortedError(reason))
+        if self.producer is not None:
+            producer = self.producer
+            self.unregisterProducer()
+            producer.stopProducing()
+
+
+class ZmqStreamSenderConnection(ZmqConnection):
+    """
+    Sending streaming transfers to L{ZmqStreamReceiverConnection}.
+
+    Connection has single endpoint: XREQ socket passes messages to
+    endpoints round-robin, so chunks of one transfer would be spread over
+    several receivers.
+
+    @cvar chunkSize: maximum size of chunk in bytes
+    @type chunkSize: C{int}
+    """
+    socketType = constants.XREQ
+    chunkSize = 65536
+
+    def __init__(self, *endpoints):
+        """
+        Constructor.
+
+        @param endpoints: ZeroMQ address of receiver
+        @type endpoints: single L{ZmqEndpoint}
+        @raise ValueError: more than one endpoint is given
+        """
+        if len(endpoints) > 1:
+            raise ValueError(
+                "%s supports single endpoint, got %d" % (
+                    self.__class__.__name__, len(endpoints)))
+        ZmqConnection.__init__(self, *endpoints)
+        self._transfers = {}
+        self._transferIds = itertools.count()
+
+    def shutdown(self):
+        """
+        Shutdown connection and socket, aborting transfers in progress.
+        """
+        for transfer in self._transfers.values():
+            transfer._aborted("connection shut down")
+        ZmqConnection.shutdown(self)
+
+    def startTransfer(self, *metadata):
+        """
+        Start transfer.
+
+        @param metadata: message parts passed to receiver along with
+            transfer (file name, etc.)
+        @return: transfer, data should be written to it (or by producer
+            registered with it) and then it should be finished
+        @rtype: L{OutgoingTransfer}
+        """
+        transferId = str(next(self._transferIds))
+        transfer = self._transfers[transferId] = OutgoingTransfer(
+            self, transferId)
+        self.send([transferId, OPEN] + list(metadata))
+        return transfer
+
+    def sendFile(self, fileObj, *metadata):
+        """
+        Transfer contents of file.
+
+        @param fileObj: file opened for reading
+        @param metadata: message parts passed to receiver along with
+            transfer
+        @return: L{OutgoingTransfer.done}
+        @rtype: L{Deferred}
+        """
+        transfer = self.startTransfer(*metadata)
+
+        def failed(failure):
+            if not transfer.done.called:
+                transfer.abort(util.buildErrorMessage(failure.value))
+            return transfer.done
+
+        sender = FileSender()
+        sender.CHUNK_SIZE = self.chunkSize
+        d = sender.beginFileTransfer(fileObj, transfer)
+        return d.addCallbacks(lambda _: transfer.finish(), failed)
+
+    def _splitPayload(self, message):
+        """
+        Stream messages have no payload.
+        """
+        return message, []
+
+    def messageReceived(self, message):
+        """
+        Called on incoming message from ZeroMQ.
+
+        @param message: message data
+        """
+        transferId, command = util.toBytes(message[0]), util.toBytes(message[1])
+        transfer = self._transfers.get(transferId)
+        if transfer is None:
+            log.msg("Message %r for unknown transfer %r in %r" % (
+                command, transferId, self))
+        elif command == CREDIT:
+            transfer._creditGranted(int(util.toBytes(message[2])))
+        elif command == DONE:
+            transfer._completed()
+        elif command == ABORT:
+            transfer._aborted(util.toBytes(message[2]))
+        else:
+            log.msg("Unknown command %r for transfer %r in %r" % (
+                command, transferId, self))
+
+
+class IncomingTransfer(object):
+    """
+    Receiver side of transfer.
+
+    Chunks are written to consumer as they arrive, consumer could pause
+    transfer to stop granting credit to sender.
+
+    @ivar transferId: transfer id, unique for sender connection
+    @type transferId: C{str}
+    @ivar metadata: message parts passed by sender
+    @type metadata: C{list}
+    @ivar consumer: consumer data is written to
+    @ivar done: deferred firing with transfer once all the data is
+        written, or failing with L{exceptions.TransferAbortedError}
+    @type done: L{Deferred}
+    @ivar paused: is transfer paused by consumer?
+    @type paused: C{boolean}
+    @ivar receivedChunks: number of chunks received
+    @type receivedChunks: C{int}
+    @ivar receivedBytes: number of bytes received
+    @type receivedBytes: C{int}
+    """
+    implements(IPushProducer)
+
+    def __init__(self, connection, identity, transferId, metadata):
+        self.connection = connection
+        self.identity = identity
+        self.transferId = transferId
+        self.metadata = metadata
+        self.consumer = None
+        self.done = defer.Deferred()
+        self.paused = False
+        self.receivedChunks = 0
+        self.receivedBytes = 0
+        self._consumed = 0
+        self._finished = False
+
+    def __repr__(self):
+        return "IncomingTransfer(%r, %r)" % (self.identity, self.transferId)
+
+    def pauseProducing(self):
+        """
+        Stop granting credit to sender.
+
+        Part of L{IPushProducer}.
+        """
+        self.paused = True
+
+    def resumeProducing(self):
+        """
+        Grant credit for chunks consumed while paused.
+
+        Part of L{IPushProducer}.
+        """
+        self.paused = False
+        if self._consumed:
+            self._grantCredit()
+
+    def stopProducing(self):
+        """
+        Abort transfer.
+
+        Part of L{IPushProducer}.
+        """
+        self.abort("stopped by receiver")
+
+    def abort(self, reason="aborted by receiver"):
+        """
+        Abort transfer, notifying sender.
+
+        @param reason: reason passed to sender
+        @type reason: C{str}
+        """
+        if self._finished:
+            return
+        self._send(ABORT, reason)
+        self._aborted(reason)
+
+    def _send(self, command, *args):
+        self.connection.send(
+            [self.identity, self.transferId, command] + list(args))
+
+    def _start(self, consumer):
+        """
+        Start receiving data to consumer.
+        """
+        self.consumer = consumer
+        if hasattr(consumer, 'registerProducer'):
+            consumer.registerProducer(self, True)
+        if not self._finished:
+            self._send(CREDIT, str(self.connection.window))
+
+    def _grantCredit(self):
+        self._send(CREDIT, str(self._consumed))
+        self._consumed = 0
+
+    def _chunkReceived(self, chunk):
+        """
+        Called on incoming chunk.
+        """
+        self.receivedChunks += 1
+        self.receivedBytes += len(chunk)
+        try:
+            self.consumer.write(chunk)
+        except Exception, err:
+            log.err(None, "Consumer of %r failed" % (self,))
+            self.abort(util.buildErrorMessage(err))
+            return
+        self._consumed += 1
+        if not self.paused and self._consumed >= self.connection.creditBatch:
+            self._grantCredit()
+
+    def _completed(self):
+        """
+        Called when sender finished transfer.
+        """
+        self._finish()
+        self._send(DONE)
+        self.done.callback(self)
+
+    def _aborted(self, reason):
+        """
+        Called when transfer is aborted by either side.
+        """
+        self._finish()
+        self.done.errback(exceptions.TransferAbortedError(reason))
+
+    def _finish(self):
+        self._finished = True
+        self.connection._transfers.pop(
+            (self.identity, self.transferId), None)
+        if hasattr(self.consumer, 'unregisterProducer'):
+            self.consumer.unregisterProducer()
+
+
+class ZmqStreamReceiverConnection(ZmqConnection):
+    """
+    Receiving streaming transfers from L{ZmqStreamSenderConnection}s.
+
+    @cvar window: maximum number of chunks in flight per transfer
+    @type window: C{int}
+    @cvar creditBatch: credit is granted back in batches of this size
+        (number of chunks), should be less than L{window}
+    @type creditBatch: C{int}
+    """
+    socketType = constants.XREP
+    window = 16
+    creditBatch = 4
+
+    def __init__(self, *endpoints):
+        ZmqConnection.__init__(self, *endpoints)
+        # (sender identity, transfer id) -> transfer
+        self._transfers = {}
+
+    def shutdown(self):
+        """
+        Shutdown connection and socket, aborting transfers in progress.
+        """
+        for transfer in self._transfers.values():
+            transfer._aborted("connection shut down")
+        ZmqConnection.shutdown(self)
+
+    def _splitPayload(self, message):
+        """
+        Stream messages have no payload.
+        """
+        return message, []
+
+    def messageReceived(self, message):
+        """
+        Called on incoming message from ZeroMQ.
+
+        @param message: message data
+        """
+        identity, transferId, command = map(util.toBytes, message[:3])
+        key = (identity, transferId)
+        if command == OPEN:
+            metadata = map(util.toBytes, message[3:])
+            transfer = self._transfers[key] = IncomingTransfer(
+                self, identity, transferId, metadata)
+            try:
+                consumer = self.gotTransfer(transfer, *metadata)
+            except Exception, err:
+                log.err(None, "Failed to accept %r" % (transfer,))
+                # not started, so just let sender know
+                transfer._send(ABORT, util.buildErrorMessage(err))
+                transfer._finish()
+            else:
+                transfer._start(consumer)
+            return
+        transfer = self._transfers.get(key)
+        if transfer is None:
+            log.msg("Message %r for unknown transfer %r from %r in %r" % (
+                command, transferId, identity, self))
+        elif command == DATA:
+            transfer._chunkReceived(util.toBytes(message[3]))
+        elif command == END:
+            transfer._completed()
+        elif command == ABORT:
+            transfer._aborted(util.toBytes(message[3]))
+        else:
+            log.msg("Unknown command %r for %r in %r" % (
+                command, transfer, self))
+
+    def gotTransfer(self, transfer, *metadata):
+        """
+        Called on incoming transfer.
+
+        Transfer is rejected if this method raises exception.
+
+        @param transfer: incoming transfer
+        @type transfer: L{IncomingTransfer}
+        @param metadata: message parts passed by sender
+        @return: consumer transfer data is written to, object with
+            C{write} method or L{IConsumer} (transfer is registered with
+            it as producer)
+        """
+        raise NotImplementedError(self)
@@ -0,0 +1,141 @@
+"""
+Tests for L{txzmq.broker}.
+"""
+import shutil
+import tempfile
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from txzmq.broker import ZmqBroker, ZmqBrokerWorkerConnection
+from txzmq.connection import ZmqEndpoint, ZmqEndpointType
+from txzmq.factory import ZmqFactory
+from txzmq.test import _wait
+from txzmq.xreq_xrep import ZmqXREQConnection
+
+
+class ZmqTestWorkerConnection(ZmqBrokerWorkerConnection):
+    autoReply = True
+    heartbeatInterval = 0.05
+
+    def gotMessage(self, message_id, *message_parts):
+        return message_parts + (self.name,)
+
+
+class ZmqTestBroker(ZmqBroker):
+    heartbeatInterval = 0.05
+
+
+class ZmqBrokerTestCase(unittest.TestCase):
+    """
+    Test case for L{txzmq.broker.ZmqBroker}.
+    """
+
+    def setUp(self):
+        self.factory = ZmqFactory()
+        self.tempDir = tempfile.mkdtemp()
+        self.frontend = "ipc://%s/frontend" % (self.tempDir,)
+        self.backend = "ipc://%s/backend" % (self.tempDir,)
+        self.broker = self.makeBroker()
+        self.client = ZmqXREQConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, self.frontend))
+        self.client.connect(self.factory)
+
+    def tearDown(self):
+        self.broker.shutdown()
+        self.factory.shutdown()
+        shutil.rmtree(self.tempDir)
+
+    def makeBroker(self):
+        broker = ZmqTestBroker(
+            [ZmqEndpoint(ZmqEndpointType.bind, self.frontend)],
+            [ZmqEndpoint(ZmqEndpointType.bind, self.backend)])
+        self.successResultOf(broker.listen(self.factory))
+        return broker
+
+    def makeWorker(self, name):
+        worker = ZmqTestWorkerConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, self.backend))
+        worker.name = name
+        worker.identity = name
+        worker.connect(self.factory)
+        return worker
+
+    def request(self, count):
+        d = defer.DeferredList(
+            [self.client.sendMsg(str(i)) for i in range(count)],
+            fireOnOneErrback=True)
+        return d.addCallback(lambda results: [reply for _, reply in results])
+
+    def test_requests(self):
+        self.makeWorker('w1')
+        self.makeWorker('w2')
+
+        def check(replies):
+            self.assertEqual([reply[0] for reply in replies],
+                             [str(i) for i in range(10)])
+            self.assertEqual(set(reply[1] for reply in replies),
+                             set(['w1', 'w2']))
+            self.assertEqual(sorted(self.broker.workers), ['w1', 'w2'])
+            self.assertEqual(len(self.broker.pendingRequests), 0)
+
+        d = _wait(0.01).addCallback(lambda _: self.request(10))
+        return d.addCallback(check)
+
+    def test_queued_requests(self):
+        d = self.request(3)
+
+        def connectWorker(ignore):
+            self.assertEqual(len(self.broker.pendingRequests), 3)
+            self.makeWorker('w1')
+            return d
+
+        def check(replies):
+            self.assertEqual(replies, [[str(i), 'w1'] for i in range(3)])
+
+        return _wait(0.05).addCallback(connectWorker).addCallback(check)
+
+    def test_max_queued_requests(self):
+        self.broker.maxQueuedRequests = 10
+        d = self.request(50)
+
+        def connectWorker(ignore):
+            # the rest is left in ZeroMQ queues
+            self.assertEqual(len(self.broker.pendingRequests), 10)
+            self.makeWorker('w1')
+            return d
+
+        def check(replies):
+            self.assertEqual(replies, [[str(i), 'w1'] for i in range(50)])
+
+        return _wait(0.05).addCallback(connectWorker).addCallback(check)
+
+    def test_worker_expired(self):
+        worker = self.makeWorker('w1')
+
+        def stopWorker(ignore):
+            self.assertEqual(self.broker.workers.keys(), ['w1'])
+            worker.shutdown()
+            return _wait(0.3)
+
+        def check(ignore):
+            self.assertEqual(self.broker.workers, {})
+            self.assertEqual(len(self.broker._available), 0)
+
+        d = _wait(0.1).addCallback(stopWorker)
+        return d.addCallback(check)
+
+    def test_worker_ready_again(self):
+        worker = self.makeWorker('w1')
+
+        def silence(ignore):
+            self.assertEqual(list(self.broker._available), ['w1'])
+            # broker is silent for too long, worker announces itself again
+            worker._brokerSeen -= 10
+            worker._sendHeartbeat()
+            return _wait(0.05)
+
+        def check(ignore):
+            self.assertEqual(list(self.broker._available), ['w1'])
+
+        return _wait(0.05).addCallback(silence).addCallback(check)
@@ -0,0 +1,78 @@
+"""
+Tests for L{txzmq.codec}.
+"""
+from twisted.trial import unittest
+
+from txzmq import codec, exceptions
+
+
+class CodecTestMixin(object):
+    """
+    Tests common for all the codecs.
+    """
+    objects = [{'symbol': 'ABC', 'price': 1.5, 'size': [100, 200]},
+               u'unicode', 42, None, [], {}]
+
+    def test_roundtrip(self):
+        for obj in self.objects:
+            self.assertEqual(self.codec.decode(self.codec.encode(obj)), obj)
+
+    def test_decode_many(self):
+        parts = map(self.codec.encode, self.objects)
+        self.assertEqual(self.codec.decodeMany(parts), self.objects)
+
+    def test_decode_buffers(self):
+        parts = [memoryview(self.codec.encode(obj)) for obj in self.objects]
+        self.assertEqual(self.codec.decodeMany(parts), self.objects)
+
+
+class JSONCodecTestCase(CodecTestMixin, unittest.TestCase):
+    """
+    Test case for L{txzmq.codec.JSONCodec}.
+    """
+
+    def setUp(self):
+        self.codec = codec.JSONCodec()
+
+    def test_decode_many_broken(self):
+        self.assertRaises(
+            exceptions.CodecError, self.codec.decodeMany, ['1, 2'])
+
+    def test_decode_many_boundaries(self):
+        self.assertRaises(
+            exceptions.CodecError, self.codec.decodeMany,
+            ['1,2,[0', '5', '0]'])
+
+
+class PickleCodecTestCase(CodecTestMixin, unittest.TestCase):
+    """
+    Test case for L{txzmq.codec.PickleCodec}.
+    """
+
+    def setUp(self):
+        self.codec = codec.PickleCodec()
+
+
+class MsgpackCodecTestCase(CodecTestMixin, unittest.TestCase):
+    """
+    Test case for L{txzmq.codec.MsgpackCodec}.
+    """
+    objects = [{'symbol': 'ABC', 'price': 1.5, 'size': [100, 200]},
+               'str', 42, None, [], {}]
+
+    if codec.msgpack is None:
+        skip = "msgpack is not installed"
+
+    def setUp(self):
+        self.codec = codec.MsgpackCodec()
+
+    def test_decode_many_broken(self):
+        self.assertRaises(
+            exceptions.CodecError, self.codec.decodeMany,
+            [self.codec.encode(1) + self.codec.encode(2)])
+
+    def test_decode_many_boundaries(self):
+        packed = self.codec.encode([1, 2])
+        self.assertRaises(
+            exceptions.CodecError, self.codec.decodeMany,
+            [packed[:1], packed[1:2], packed[2:]])
@@ -0,0 +1,71 @@
+"""
+Tests for L{txzmq.compression}.
+"""
+import os
+
+from twisted.trial import unittest
+
+from txzmq import compression, exceptions
+
+
+class CompressorTestMixin(object):
+    """
+    Tests common for all the compressors.
+    """
+
+    def test_roundtrip(self):
+        data = "0123456789" * 1000
+        packed = self.compressor.pack(data)
+        self.assertEqual(packed[0], self.compressor.flag)
+        self.failUnless(len(packed) < len(data))
+        self.assertEqual(compression.unpack(packed), data)
+
+    def test_roundtrip_buffer(self):
+        data = "0123456789" * 1000
+        packed = memoryview(self.compressor.pack(data))
+        self.assertEqual(compression.unpack(packed), data)
+
+    def test_below_threshold(self):
+        packed = self.compressor.pack("0" * 100)
+        self.assertEqual(packed, compression.STORED + "0" * 100)
+        self.assertEqual(compression.unpack(packed), "0" * 100)
+
+    def test_incompressible(self):
+        data = os.urandom(2000)
+        packed = self.compressor.pack(data)
+        self.assertEqual(packed, compression.STORED + data)
+
+
+class ZlibCompressorTestCase(CompressorTestMixin, unittest.TestCase):
+    """
+    Test case for L{txzmq.compression.ZlibCompressor}.
+    """
+
+    def setUp(self):
+        self.compressor = compression.ZlibCompressor(level=1)
+
+
+class LZ4CompressorTestCase(CompressorTestMixin, unittest.TestCase):
+    """
+    Test case for L{txzmq.compression.LZ4Compressor}.
+    """
+    if compression.lz4 is None:
+        skip = "lz4 is not installed"
+
+    def setUp(self):
+        self.compressor = compression.LZ4Compressor()
+
+
+class UnpackTestCase(unittest.TestCase):
+    """
+    Test case for L{txzmq.compression.unpack}.
+    """
+
+    def test_stored_buffer(self):
+        data = memoryview(compression.STORED + "abcd")
+        result = compression.unpack(data)
+        self.failUnless(isinstance(result, memoryview))
+        self.assertEqual(result.tobytes(), "abcd")
+
+    def test_unknown_flag(self):
+        self.assertRaises(exceptions.CodecError, compression.unpack, "\xffabc")
@@ -1,15 +1,19 @@
 """
 Tests for L{txzmq.connection}.
 """
-from zmq.core import constants
+from zmq.core import constants, error
+from zmq.core.message import Frame
 
-from zope.interface import verify as ziv
+from zope.interface import implements, verify as ziv
 
-from twisted.internet.interfaces import IFileDescriptor, IReadDescriptor
+from twisted.internet.error import ConnectionDone
+from twisted.internet.interfaces import (
+    IConsumer, IFileDescriptor, IPushProducer, IReadDescriptor)
 from twisted.trial import unittest
 
-from txzmq import exceptions
-from txzmq.connection import ZmqConnection, ZmqEndpoint, ZmqEndpointType
+from txzmq import codec, exceptions
+from txzmq.connection import (
+    ZmqConnection, ZmqEndpoint, ZmqEndpointType, ZmqQueuePolicy)
 from txzmq.factory import ZmqFactory
 from txzmq.test import _wait
 
@@ -28,6 +32,64 @@ class ZmqTestReceiver(ZmqConnection):
         self.messages.append(message)
 
 
+class ZmqTestBatchReceiver(ZmqConnection):
+    socketType = constants.PULL
+
+    def messagesReceived(self, messages):
+        if not hasattr(self, 'batches'):
+            self.batches = []
+
+        self.batches.append(messages)
+
+
+class FakeSocket(object):
+    """
+    Socket accepting only some number of parts before returning EAGAIN.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.sent = []
+
+    def send(self, data, flags=0):
+        if len(self.sent) >= self.capacity:
+            raise error.ZMQError(constants.EAGAIN)
+        self.sent.append((data, flags & constants.SNDMORE))
+
+
+class FakeClockReactor(object):
+    """
+    Reactor whose clock advances by a second each time it's read.
+    """
+
+    def __init__(self, reactor):
+        self._reactor = reactor
+        self.now = 0
+
+    def seconds(self):
+        self.now += 1
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(self._reactor, name)
+
+
+class FakeProducer(object):
+    implements(IPushProducer)
+
+    def __init__(self):
+        self.events = []
+
+    def pauseProducing(self):
+        self.events.append('pause')
+
+    def resumeProducing(self):
+        self.events.append('resume')
+
+    def stopProducing(self):
+        self.events.append('stop')
+
+
 class ZmqConnectionTestCase(unittest.TestCase):
     """
     Test case for L{zmq.twisted.connection.Connection}.
@@ -42,6 +104,7 @@ class ZmqConnectionTestCase(unittest.TestCase):
     def test_interfaces(self):
         ziv.verifyClass(IReadDescriptor, ZmqConnection)
         ziv.verifyClass(IFileDescriptor, ZmqConnection)
+        ziv.verifyClass(IConsumer, ZmqConnection)
 
     def test_init(self):
         receiver = ZmqTestReceiver(
@@ -58,6 +121,26 @@ class ZmqConnectionTestCase(unittest.TestCase):
         r.connect(self.factory)
         self.failUnlessEqual(expected, repr(r))
 
+    def test_socket_options(self):
+        self.factory.socketOptions = {'SNDBUF': 1024, 'RECOVERY_IVL': 5}
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        s.socketOptions = {'sndbuf': 65536, constants.RCVBUF: 131072}
+        s.ioThreadAffinity = [0, 2]
+        s.listen(self.factory)
+
+        self.assertEqual(s.socket.getsockopt(constants.SNDBUF), 65536)
+        self.assertEqual(s.socket.getsockopt(constants.RCVBUF), 131072)
+        self.assertEqual(s.socket.getsockopt(constants.RECOVERY_IVL), 5)
+        self.assertEqual(s.socket.getsockopt(constants.AFFINITY), 5)
+
+    def test_socket_options_unsupported(self):
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        s.socketOptions = {'NO_SUCH_OPTION': 1}
+        d = s.listen(self.factory)
+        return self.assertFailure(d, exceptions.ListenError)
+
     def test_send_recv(self):
         r = ZmqTestReceiver(
             ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
@@ -76,6 +159,27 @@ class ZmqConnectionTestCase(unittest.TestCase):
 
         return _wait(0.01).addCallback(check)
 
+    def test_pause_resume_reading(self):
+        r = ZmqTestReceiver(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.listen(self.factory)
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        r.pauseReading()
+        s.send('abcd')
+
+        def check(ignore):
+            self.assertFalse(hasattr(r, 'messages'))
+            r.resumeReading()
+            return _wait(0.01)
+
+        def checkResumed(ignore):
+            self.assertEqual(r.messages, [['abcd']])
+
+        return _wait(0.01).addCallback(check).addCallback(checkResumed)
+
     def test_send_recv_tcp(self):
         r = ZmqTestReceiver(
             ZmqEndpoint(ZmqEndpointType.bind, "tcp://127.0.0.1:5555"))
@@ -173,3 +277,312 @@ class ZmqConnectionTestCase(unittest.TestCase):
         d = self.assertFailure(failure, exceptions.ListenError)
         d.addCallback(check)
         return d
+
+    def test_read_message_budget(self):
+        r = ZmqTestBatchReceiver(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.readMessageBudget = 7
+        r.listen(self.factory)
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        for i in xrange(100):
+            s.send(str(i))
+
+        def check(ignore):
+            batches = getattr(r, 'batches', [])
+            self.failUnless(len(batches) > 1)
+            self.failUnless(max(map(len, batches)) <= 7)
+            result = [message for batch in batches for message in batch]
+            expected = map(lambda i: [str(i)], xrange(100))
+            self.failUnlessEqual(
+                result, expected, "Messages should have been received")
+
+        return _wait(0.01).addCallback(check)
+
+    def test_read_byte_budget(self):
+        r = ZmqTestBatchReceiver(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.readByteBudget = 20
+        r.listen(self.factory)
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        for i in xrange(100):
+            s.send("0123456789")
+
+        def check(ignore):
+            batches = getattr(r, 'batches', [])
+            self.failUnless(len(batches) > 1)
+            self.failUnless(max(map(len, batches)) <= 2)
+            result = [message for batch in batches for message in batch]
+            expected = [["0123456789"]] * 100
+            self.failUnlessEqual(
+                result, expected, "Messages should have been received")
+
+        return _wait(0.05).addCallback(check)
+
+    def test_read_time_budget(self):
+        self.factory.reactor = FakeClockReactor(self.factory.reactor)
+        r = ZmqTestBatchReceiver(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.readTimeBudget = 2.5
+        r.listen(self.factory)
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        for i in xrange(100):
+            s.send(str(i))
+
+        def check(ignore):
+            batches = getattr(r, 'batches', [])
+            self.failUnless(len(batches) > 1)
+            # clock advances by a second each time it's read: deadline
+            # is reached after third message
+            self.failUnless(max(map(len, batches)) <= 3)
+            result = [message for batch in batches for message in batch]
+            expected = map(lambda i: [str(i)], xrange(100))
+            self.failUnlessEqual(
+                result, expected, "Messages should have been received")
+
+        return _wait(0.05).addCallback(check)
+
+    def test_send_recv_zero_copy(self):
+        r = ZmqTestReceiver(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.zeroCopyReceive = True
+        r.listen(self.factory)
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        s.send(["abcd", "0" * 10000])
+
+        def check(ignore):
+            result = getattr(r, 'messages', [])
+            self.failUnlessEqual(len(result), 1)
+            self.failUnless(isinstance(result[0][0], Frame))
+            self.failUnlessEqual(
+                [frame.bytes for frame in result[0]], ["abcd", "0" * 10000])
+
+        return _wait(0.01).addCallback(check)
+
+    def test_send_recv_buffers(self):
+        r = ZmqTestReceiver(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.zeroCopyReceive = True
+        r.receiveBuffers = True
+        r.listen(self.factory)
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        s.send(["abcd", "efgh"])
+
+        def check(ignore):
+            result = getattr(r, 'messages', [])
+            self.failUnlessEqual(len(result), 1)
+            self.failUnless(isinstance(result[0][0], memoryview))
+            self.failUnlessEqual(map(len, result[0]), [4, 4])
+            self.failUnlessEqual(
+                [buf.tobytes() for buf in result[0]], ["abcd", "efgh"])
+
+        return _wait(0.01).addCallback(check)
+
+    def test_send_tracked(self):
+        r = ZmqTestReceiver(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.listen(self.factory)
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        payload = bytearray("0" * 100000)
+        d = s.send(["abcd", memoryview(payload)], track=True)
+
+        def check(result):
+            self.assertIdentical(result, s)
+            self.failUnlessEqual(
+                getattr(r, 'messages', []), [["abcd", "0" * 100000]])
+
+        return d.addCallback(check)
+
+    def test_send_tracked_shutdown(self):
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        s.listen(self.factory)
+
+        # no peer, message stays queued
+        d = s.send([memoryview(bytearray("0" * 100))], track=True)
+        self.assertEqual(s.queuedMessages, 1)
+        s.shutdown()
+        self.assertEqual(len(s.queue), 0)
+        return self.assertFailure(d, ConnectionDone)
+
+    def test_send_untracked(self):
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        s.listen(self.factory)
+
+        self.assertIdentical(s.send("abcd"), None)
+
+    def test_queue_overflow_fail(self):
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        s.queueHighMessages = 2
+        s.queueOverflowPolicy = ZmqQueuePolicy.fail
+        s.listen(self.factory)
+
+        s.send("abcd")
+        s.send(["ef", "gh"])
+        self.assertEqual(s.queuedMessages, 2)
+        self.assertEqual(s.queuedBytes, 8)
+        self.assertRaises(exceptions.QueueFullError, s.send, "ijkl")
+
+    def test_send_many(self):
+        r = ZmqTestReceiver(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.listen(self.factory)
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        s.sendMany(['abcd', ['ef', 'gh'], 'ijkl'])
+
+        def check(ignore):
+            result = getattr(r, 'messages', [])
+            expected = [['abcd'], ['ef', 'gh'], ['ijkl']]
+            self.failUnlessEqual(
+                result, expected, "Messages should have been received")
+
+        return _wait(0.01).addCallback(check)
+
+    def test_send_many_overflow_fail(self):
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        s.queueHighMessages = 2
+        s.queueOverflowPolicy = ZmqQueuePolicy.fail
+        s.listen(self.factory)
+
+        err = self.assertRaises(
+            exceptions.QueueFullError, s.sendMany, ["ab", "cd", "ef"])
+        self.assertIn("2 of 3 messages queued", str(err))
+        self.assertEqual(s.queuedMessages, 2)
+
+    def test_queue_overflow_drop(self):
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        s.queueHighBytes = 10
+        s.queueOverflowPolicy = ZmqQueuePolicy.drop
+        s.listen(self.factory)
+
+        for i in xrange(5):
+            s.send("abcd")
+        self.assertEqual(s.queuedMessages, 3)
+        self.assertEqual(s.droppedMessages, 2)
+
+    def test_queue_backpressure(self):
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        s.queueHighMessages = 4
+        s.listen(self.factory)
+        producer = FakeProducer()
+        s.registerProducer(producer, True)
+
+        for i in xrange(10):
+            s.write(str(i))
+        self.assertEqual(producer.events, ['pause'])
+        self.assertEqual(s.queuedMessages, 10)
+
+        r = ZmqTestReceiver(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        r.connect(self.factory)
+
+        def check(ignore):
+            self.assertEqual(producer.events, ['pause', 'resume'])
+            self.assertEqual(s.queuedMessages, 0)
+            self.failUnlessEqual(
+                getattr(r, 'messages', []), [[str(i)] for i in xrange(10)])
+
+        return _wait(0.05).addCallback(check)
+
+    def test_send_flush_on_writable(self):
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        s.listen(self.factory)
+
+        for i in xrange(100):
+            s.send(str(i))
+        self.assertEqual(s.queuedMessages, 100)
+
+        r = ZmqTestReceiver(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        r.connect(self.factory)
+
+        def check(ignore):
+            self.assertEqual(s.queuedMessages, 0)
+            self.failUnlessEqual(
+                getattr(r, 'messages', []), [[str(i)] for i in xrange(100)])
+
+        return _wait(0.05).addCallback(check)
+
+    def test_send_resume_partial(self):
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.socket = FakeSocket(4)
+        s.queue.append((["a", "b", "c"], 3, None))
+        s.queue.append((["d", "e", "f"], 3, None))
+        s.queuedMessages = 2
+
+        s._startWriting()
+        self.assertEqual(s.queuedMessages, 1)
+        s.socket.capacity = 10
+        s._startWriting()
+        self.assertEqual(s.queuedMessages, 0)
+        self.assertEqual(
+            s.socket.sent,
+            [("a", constants.SNDMORE), ("b", constants.SNDMORE), ("c", 0),
+             ("d", constants.SNDMORE), ("e", constants.SNDMORE), ("f", 0)])
+
+    def test_send_recv_codec(self):
+        r = ZmqTestReceiver(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.codec = codec.JSONCodec()
+        r.listen(self.factory)
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        s.send(['{"a":1}', '[1,2]'])
+        s.send('broken')
+        s.send('"abcd"')
+
+        def check(ignore):
+            self.flushLoggedErrors(ValueError)
+            self.failUnlessEqual(
+                getattr(r, 'messages', []), [[{'a': 1}, [1, 2]], ['abcd']])
+
+        return _wait(0.01).addCallback(check)
+
+    def test_send_recv_codec_threaded(self):
+        r = ZmqTestReceiver(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.codec = codec.PickleCodec()
+        r.threadedDecodeSize = 1000
+        r.listen(self.factory)
+        s = ZmqTestSender(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        s.send(r.codec.encode("0" * 10000))
+        s.send(r.codec.encode(1))
+
+        def check(ignore):
+            self.failUnlessEqual(
+                getattr(r, 'messages', []), [["0" * 10000], [1]])
+            self.assertIdentical(r._decoding, None)
+
+        return _wait(0.05).addCallback(check)
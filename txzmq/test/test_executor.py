@@ -0,0 +1,206 @@
+"""
+Tests for L{txzmq.executor}.
+"""
+import os
+import threading
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from txzmq import exceptions
+from txzmq.connection import ZmqEndpoint, ZmqEndpointType
+from txzmq.executor import KeyedSerializer, ProcessExecutor, ThreadExecutor
+from txzmq.factory import ZmqFactory
+from txzmq.pubsub import ZmqPubConnection, ZmqSubConnection
+from txzmq.test import _wait
+from txzmq.xreq_xrep import ZmqXREPConnection, ZmqXREQConnection
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+class Unpicklable(Exception):
+
+    def __reduce__(self):
+        raise TypeError("can't pickle")
+
+
+def failUnpicklable():
+    raise Unpicklable("ohnoz!")
+
+
+def returnUnpicklable():
+    return threading.Lock()
+
+
+class ZmqTestSubConnection(ZmqSubConnection):
+
+    def gotMessage(self, message, tag):
+        if not hasattr(self, 'messages'):
+            self.messages = []
+        self.messages.append([tag, message, threading.current_thread()])
+
+
+class ZmqTestXREPConnection(ZmqXREPConnection):
+    autoReply = True
+
+    def gotMessage(self, message_id, *message_parts):
+        return message_parts + (threading.current_thread().name,)
+
+
+class ThreadExecutorTestCase(unittest.TestCase):
+    """
+    Test case for L{txzmq.executor.ThreadExecutor}.
+    """
+
+    def setUp(self):
+        self.executor = ThreadExecutor(maxThreads=2)
+
+    def tearDown(self):
+        self.executor.stop()
+
+    def test_submit(self):
+        d = self.executor.submit(threading.current_thread)
+
+        def check(thread):
+            self.assertNotIdentical(thread, threading.current_thread())
+
+        return d.addCallback(check)
+
+    def test_submit_fail(self):
+        d = self.executor.submit(fail, "ohnoz!")
+        return self.assertFailure(d, ValueError)
+
+
+class ProcessExecutorTestCase(unittest.TestCase):
+    """
+    Test case for L{txzmq.executor.ProcessExecutor}.
+    """
+
+    def setUp(self):
+        self.executor = ProcessExecutor(processes=2)
+
+    def tearDown(self):
+        self.executor.stop()
+
+    def test_submit(self):
+        d = self.executor.submit(os.getpid)
+
+        def check(pid):
+            self.assertNotEqual(pid, os.getpid())
+
+        return d.addCallback(check)
+
+    def test_submit_fail(self):
+        d = self.executor.submit(fail, "ohnoz!")
+
+        def check(error):
+            self.assertEqual(str(error), "ohnoz!")
+
+        return self.assertFailure(d, ValueError).addCallback(check)
+
+    def test_submit_fail_unpicklable(self):
+        d = self.executor.submit(failUnpicklable)
+        return self.assertFailure(d, exceptions.ExecutorError)
+
+    def test_submit_unpicklable_argument(self):
+        d = self.executor.submit(len, threading.Lock())
+        return self.assertFailure(d, exceptions.ExecutorError)
+
+    def test_submit_unpicklable_result(self):
+        d = self.executor.submit(returnUnpicklable)
+        return self.assertFailure(d, exceptions.ExecutorError)
+
+
+class KeyedSerializerTestCase(unittest.TestCase):
+    """
+    Test case for L{txzmq.executor.KeyedSerializer}.
+    """
+
+    def test_ordering(self):
+        serializer = KeyedSerializer()
+        started = []
+        pending = {}
+
+        def run(name):
+            started.append(name)
+            pending[name] = defer.Deferred()
+            return pending[name]
+
+        a1 = serializer.run('a', run, 'a1')
+        a2 = serializer.run('a', run, 'a2')
+        serializer.run('b', run, 'b1')
+        self.assertEqual(started, ['a1', 'b1'])
+
+        pending['a1'].callback('r1')
+        self.assertEqual(started, ['a1', 'b1', 'a2'])
+        self.assertEqual(self.successResultOf(a1), 'r1')
+        self.assertNoResult(a2)
+
+        pending['a2'].errback(ValueError())
+        self.failureResultOf(a2, ValueError)
+        pending['b1'].callback(None)
+        self.assertEqual(serializer._tails, {})
+
+
+class ZmqConnectionExecutorTestCase(unittest.TestCase):
+    """
+    Test case for running message handlers in executor.
+    """
+
+    def setUp(self):
+        self.factory = ZmqFactory()
+        self.executor = ThreadExecutor(maxThreads=2)
+
+    def tearDown(self):
+        self.executor.stop()
+        self.factory.shutdown()
+
+    def test_sub(self):
+        r = ZmqTestSubConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.executor = self.executor
+        r.executorOrdering = True
+        r.listen(self.factory)
+        s = ZmqPubConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        r.subscribe('tag')
+        s.publishMany([('tag1', str(i)) for i in range(10)])
+
+        def check(ignore):
+            result = getattr(r, 'messages', [])
+            self.assertEqual([message for _, message, _ in result],
+                             [str(i) for i in range(10)])
+            for _, _, thread in result:
+                self.assertNotIdentical(thread, threading.current_thread())
+
+        return _wait(0.05).addCallback(check)
+
+    def test_xrep(self):
+        r = ZmqTestXREPConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.executor = self.executor
+        r.listen(self.factory)
+        s = ZmqXREQConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        d = s.sendMsg('aaa')
+
+        def check(reply):
+            self.assertEqual(reply[0], 'aaa')
+            self.assertNotEqual(reply[1], threading.current_thread().name)
+
+        return d.addCallback(check)
+
+    def test_process_executor_rejected(self):
+        r = ZmqTestXREPConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.executor = ProcessExecutor(processes=1)
+        r.listen(self.factory)
+
+        d = r._callHandler(None, r.gotMessage, 'id', 'aaa')
+        return self.assertFailure(d, TypeError)
@@ -4,12 +4,13 @@ Tests for L{txzmq.pubsub}.
 from zmq.core import constants
 from zmq.core.socket import Socket
 
+from twisted.internet import defer, task
 from twisted.trial import unittest
 
-from txzmq import exceptions
+from txzmq import codec, compression, exceptions
 from txzmq.connection import ZmqEndpoint, ZmqEndpointType
 from txzmq.factory import ZmqFactory
-from txzmq.pubsub import ZmqPubConnection, ZmqSubConnection
+from txzmq.pubsub import ZmqPubConnection, ZmqSubConnection, _TopicTrie
 from txzmq.test import _wait
 
 
@@ -49,6 +50,13 @@ class TestSocketFailure(TweakedSocket):
         self.setFailure()
 
 
+class TestSocketRecording(TweakedSocket):
+
+    def setsockopt(self, optInt, optVal):
+        super(TestSocketRecording, self).setsockopt(optInt, optVal)
+        self.factory.testOptions.append((optInt, optVal))
+
+
 def createTweakedSocket(factory):
     socket = factory.socketClass(
         factory.context, factory.connection.socketType)
@@ -151,6 +159,128 @@ class ZmqSubConnectionTestCase(BaseTestCase):
         d.addCallback(checkConnect)
         return d
 
+    def test_subscribe_refcount(self):
+        self.factory.testOptions = options = []
+
+        def checkConnect(client):
+            client.subscribe("tag")
+            client.subscribe("tag")
+            client.unsubscribe("tag")
+            self.assertEqual(options, [(constants.SUBSCRIBE, "tag")])
+            client.unsubscribe("tag")
+            self.assertEqual(options, [(constants.SUBSCRIBE, "tag"),
+                                       (constants.UNSUBSCRIBE, "tag")])
+
+        s = ZmqSubConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "tcp://127.0.0.1:5556"))
+        self.patchSocket(TestSocketRecording, s)
+        d = s.connect(self.factory)
+        d.addCallback(checkConnect)
+        return d
+
+    def test_subscribe_many(self):
+        self.factory.testOptions = options = []
+
+        def checkConnect(client):
+            client.subscribe("a")
+            d = client.subscribeMany(["a", "b", "b", "c"])
+            self.assertEqual(options, [(constants.SUBSCRIBE, "a"),
+                                       (constants.SUBSCRIBE, "b"),
+                                       (constants.SUBSCRIBE, "c")])
+            del options[:]
+            client.unsubscribeMany(["a", "b", "b", "c"])
+            self.assertEqual(options, [(constants.UNSUBSCRIBE, "b"),
+                                       (constants.UNSUBSCRIBE, "c")])
+            return d
+
+        s = ZmqSubConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "tcp://127.0.0.1:5556"))
+        self.patchSocket(TestSocketRecording, s)
+        d = s.connect(self.factory)
+        d.addCallback(checkConnect)
+        return d
+
+    def test_subscribe_many_fail(self):
+
+        def checkConnect(client):
+            failure = client.subscribeMany(["a", "b"])
+            return self.assertFailure(failure, exceptions.SubscribingError)
+
+        s = ZmqSubConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "tcp://127.0.0.1:5556"))
+        self.patchSocket(TestSocketFailure, s)
+        d = s.connect(self.factory)
+        d.addCallback(checkConnect)
+        return d
+
+
+class TopicTrieTestCase(unittest.TestCase):
+    """
+    Test case for L{txzmq.pubsub._TopicTrie}.
+    """
+    def test_match(self):
+        trie = _TopicTrie()
+        trie.add("", "all")
+        trie.add("ab", "ab")
+        trie.add("abc", "abc")
+        trie.add("abc", "abc2")
+        trie.add("b", "b")
+
+        self.assertEqual(trie.match("abcd"), ["all", "ab", "abc", "abc2"])
+        self.assertEqual(trie.match("a"), ["all"])
+        self.assertEqual(trie.match("bc"), ["all", "b"])
+
+    def test_remove(self):
+        trie = _TopicTrie()
+        trie.add("ab", "ab")
+        trie.add("abcd", "abcd")
+
+        trie.remove("abcd", "abcd")
+        self.assertEqual(trie.match("abcd"), ["ab"])
+        self.assertEqual(trie.children["a"].children["b"].children, {})
+        trie.remove("ab", "ab")
+        self.assertEqual(trie.children, {})
+        self.assertRaises(ValueError, trie.remove, "ab", "ab")
+
+
+class ZmqSubConflationTestCase(unittest.TestCase):
+    """
+    Test case for conflation in L{txzmq.pubsub.ZmqSubConnection}.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.conn = ZmqTestSubConnection()
+        self.conn.factory = self
+        self.conn.conflate = True
+        self.reactor = self.clock
+
+    def test_batch(self):
+        self.conn.messagesReceived(
+            [["a\x001"], ["b\x001"], ["a\x002"], ["a", "3"]])
+
+        self.assertEqual(self.conn.messages, [["a", "3"], ["b", "1"]])
+        self.assertEqual(self.conn.conflatedMessages, 2)
+
+    def test_interval(self):
+        self.conn.conflateInterval = 1.0
+        self.conn.messagesReceived([["a\x001"], ["b\x001"]])
+        self.conn.messagesReceived([["a\x002"]])
+        self.assertFalse(hasattr(self.conn, 'messages'))
+
+        self.clock.advance(1.0)
+        self.assertEqual(self.conn.messages, [["a", "2"], ["b", "1"]])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_max_tags(self):
+        self.conn.conflateInterval = 1.0
+        self.conn.conflateMaxTags = 2
+        self.conn.messagesReceived([["a\x001"], ["b\x001"], ["c\x001"]])
+
+        self.assertEqual(self.conn.messages, [["a", "1"], ["b", "1"]])
+        self.clock.advance(1.0)
+        self.assertEqual(
+            self.conn.messages, [["a", "1"], ["b", "1"], ["c", "1"]])
+
 
 class ZmqPubConnectionTestCase(BaseTestCase):
     """
@@ -177,6 +307,52 @@ class ZmqPubConnectionTestCase(BaseTestCase):
         d.addCallback(checkListen)
         return d
 
+    def test_publish_multipart_tags(self):
+
+        def fakeSend(message):
+            self.factory.testMessage = message
+
+        def checkPublish(server):
+            expected = ["tag", "a really special message"]
+            self.assertEqual(self.factory.testMessage, expected)
+
+        def checkListen(server):
+            d = server.publish("a really special message", "tag")
+            d.addCallback(checkPublish)
+
+        s = ZmqPubConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        s.multipartTags = True
+        self.patch(s, 'send', fakeSend)
+        d = s.listen(self.factory)
+        d.addCallback(checkListen)
+        return d
+
+    def test_publish_many(self):
+        sent = []
+
+        def checkPublish(server):
+            self.assertEqual(sent, [["tag1\x00abc", "tag2\x00def"]])
+
+        s = ZmqPubConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        self.patch(s, 'sendMany', sent.append)
+        s.listen(self.factory)
+        d = s.publishMany([("tag1", "abc"), ("tag2", "def")])
+        return d.addCallback(checkPublish)
+
+    def test_publish_many_fail(self):
+
+        def fakeSendMany(messages):
+            raise Exception("ohnoz!")
+
+        s = ZmqPubConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        self.patch(s, 'sendMany', fakeSendMany)
+        s.listen(self.factory)
+        d = s.publishMany([("tag1", "abc"), ("tag2", "def")])
+        return self.assertFailure(d, exceptions.PublishingError)
+
     def test_publish_fail(self):
 
         def fakeSend(factory):
@@ -268,3 +444,165 @@ class ZmqPubSubConnectionsTestCase(BaseTestCase):
                 result, expected, "Message should have been received")
 
         return _wait(0.2).addCallback(check)
+
+    def test_send_recv_codec(self):
+        r = ZmqTestSubConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.codec = codec.JSONCodec()
+        r.listen(self.factory)
+        s = ZmqPubConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.codec = codec.JSONCodec()
+        s.connect(self.factory)
+
+        r.subscribe('tag')
+        s.publish({'price': 1.5}, 'tag1')
+        s.publish([1, 2], 'tag2')
+
+        def check(ignore):
+            result = getattr(r, 'messages', [])
+            expected = [['tag1', {'price': 1.5}], ['tag2', [1, 2]]]
+            self.failUnlessEqual(
+                result, expected, "Message should have been received")
+
+        return _wait(0.01).addCallback(check)
+
+    def test_send_recv_compressed(self):
+        r = ZmqTestSubConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.compression = compression.ZlibCompressor()
+        r.listen(self.factory)
+        s = ZmqPubConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.compression = compression.ZlibCompressor(threshold=100)
+        s.threadedCompressionSize = 10000
+        s.connect(self.factory)
+
+        r.subscribe('tag')
+        d1 = s.publish('0' * 100000, 'tag1')
+        d2 = s.publish('abcd', 'tag2')
+        self.assertNotIdentical(s._encoding, None)
+
+        def check(ignore):
+            self.assertIdentical(s._encoding, None)
+            result = getattr(r, 'messages', [])
+            expected = [['tag1', '0' * 100000], ['tag2', 'abcd']]
+            self.failUnlessEqual(
+                result, expected, "Message should have been received")
+
+        return defer.gatherResults([d1, d2]).addCallback(
+            lambda _: _wait(0.01)).addCallback(check)
+
+    def test_send_recv_multipart_tags(self):
+        r = ZmqTestSubConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.listen(self.factory)
+        s = ZmqPubConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.multipartTags = True
+        s.connect(self.factory)
+
+        r.subscribe('tag')
+        s.publish('xyz', 'different-tag')
+        s.publish('abcd', 'tag1')
+        s.publish('', 'tag2')
+
+        def check(ignore):
+            result = getattr(r, 'messages', [])
+            expected = [['tag1', 'abcd'], ['tag2', '']]
+            self.failUnlessEqual(
+                result, expected, "Message should have been received")
+
+        return _wait(0.01).addCallback(check)
+
+    def test_send_recv_many(self):
+        r = ZmqTestSubConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.listen(self.factory)
+        s = ZmqPubConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        r.subscribe('tag')
+        s.publishMany([('different-tag', 'xyz'), ('tag1', 'abcd'),
+                       ('tag2', 'efgh')])
+
+        def check(ignore):
+            result = getattr(r, 'messages', [])
+            expected = [['tag1', 'abcd'], ['tag2', 'efgh']]
+            self.failUnlessEqual(
+                result, expected, "Messages should have been received")
+
+        return _wait(0.01).addCallback(check)
+
+    def test_send_recv_handlers(self):
+        r = ZmqTestSubConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.listen(self.factory)
+        s = ZmqPubConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        handled = []
+
+        def handler(message, tag):
+            handled.append([tag, message])
+
+        def other(message, tag):
+            self.fail("should have been removed")
+
+        r.subscribe('x')
+        r.addHandler('tag', handler)
+        r.addHandler('tag2', other)
+        r.removeHandler('tag2', other)
+        s.publish('abcd', 'tag1')
+        s.publish('efgh', 'tag2')
+        s.publish('ijkl', 'xyz')
+
+        def check(ignore):
+            self.assertEqual(handled, [['tag1', 'abcd'], ['tag2', 'efgh']])
+            self.assertEqual(getattr(r, 'messages', []), [['xyz', 'ijkl']])
+
+        return _wait(0.01).addCallback(check)
+
+    def test_send_recv_conflated(self):
+        r = ZmqTestSubConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.conflate = True
+        r.listen(self.factory)
+        s = ZmqPubConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        r.subscribe('tag')
+        s.publishMany([('tag1', '1'), ('tag2', '1'), ('tag1', '2'),
+                       ('tag1', '3')])
+
+        def check(ignore):
+            result = getattr(r, 'messages', [])
+            expected = [['tag1', '3'], ['tag2', '1']]
+            self.failUnlessEqual(
+                result, expected, "Latest messages should have been received")
+
+        return _wait(0.01).addCallback(check)
+
+    def test_send_recv_zero_copy(self):
+        r = ZmqTestSubConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.zeroCopyReceive = True
+        r.listen(self.factory)
+        s = ZmqPubConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        r.subscribe('tag')
+        s.publish('abcd', 'tag1')
+
+        def check(ignore):
+            result = getattr(r, 'messages', [])
+            self.assertEqual(len(result), 1)
+            self.assertEqual(result[0][0], 'tag1')
+            self.failUnless(isinstance(result[0][1], memoryview))
+            self.assertEqual(result[0][1].tobytes(), 'abcd')
+
+        return _wait(0.01).addCallback(check)
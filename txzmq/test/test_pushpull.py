@@ -0,0 +1,193 @@
+"""
+Tests for L{txzmq.pushpull}.
+"""
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from txzmq import codec
+from txzmq.connection import ZmqEndpoint, ZmqEndpointType
+from txzmq.factory import ZmqFactory
+from txzmq.pushpull import (
+    ZmqPullConnection, ZmqPushConnection, ZmqSinkConnection,
+    ZmqVentilatorConnection, ZmqWorkerConnection)
+from txzmq.test import _wait
+
+
+class ZmqTestPullConnection(ZmqPullConnection):
+
+    def gotMessage(self, *message_parts):
+        if not hasattr(self, 'messages'):
+            self.messages = []
+        self.messages.append(list(message_parts))
+
+
+class ZmqTestWorkerConnection(ZmqWorkerConnection):
+    credit = 2
+    heartbeatInterval = 0.05
+
+    def gotMessage(self, *message_parts):
+        if not hasattr(self, 'tasks'):
+            self.tasks = []
+        self.tasks.append(list(message_parts))
+        return self.handler(*message_parts)
+
+
+class ZmqPushPullTestCase(unittest.TestCase):
+    """
+    Test case for L{txzmq.pushpull.ZmqPushConnection} and
+    L{txzmq.pushpull.ZmqPullConnection}.
+    """
+
+    def setUp(self):
+        self.factory = ZmqFactory()
+
+    def tearDown(self):
+        self.factory.shutdown()
+
+    def test_send_recv(self):
+        r = ZmqTestPullConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.listen(self.factory)
+        s = ZmqPushConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.connect(self.factory)
+
+        s.push('abcd', 'efgh')
+        s.pushMany([('ijkl',), ('mnop',)])
+
+        def check(ignore):
+            result = getattr(r, 'messages', [])
+            expected = [['abcd', 'efgh'], ['ijkl'], ['mnop']]
+            self.failUnlessEqual(
+                result, expected, "Messages should have been received")
+
+        return _wait(0.01).addCallback(check)
+
+    def test_send_recv_codec(self):
+        r = ZmqTestPullConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        r.codec = codec.JSONCodec()
+        r.listen(self.factory)
+        s = ZmqPushConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        s.codec = codec.JSONCodec()
+        s.connect(self.factory)
+
+        s.push({'a': 1}, [2])
+
+        def check(ignore):
+            self.assertEqual(r.messages, [[{'a': 1}, [2]]])
+
+        return _wait(0.01).addCallback(check)
+
+
+class ZmqPipelineTestCase(unittest.TestCase):
+    """
+    Test case for ventilator, workers and sink.
+    """
+
+    def setUp(self):
+        self.factory = ZmqFactory()
+        self.ventilator = ZmqVentilatorConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://ventilator"))
+        self.ventilator.heartbeatInterval = 0.05
+        self.ventilator.listen(self.factory)
+        self.sink = ZmqSinkConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://sink"))
+        self.sink.listen(self.factory)
+
+    def tearDown(self):
+        self.factory.shutdown()
+
+    def makeWorker(self, handler, creditBatch=1):
+        worker = ZmqTestWorkerConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://ventilator"))
+        worker.handler = handler
+        worker.creditBatch = creditBatch
+        worker.connect(self.factory)
+        worker.sink = ZmqPushConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://sink"))
+        worker.sink.connect(self.factory)
+        return worker
+
+    def test_pipeline(self):
+        self.makeWorker(lambda task: task + '!')
+        self.makeWorker(lambda task: (task, 'done'))
+        self.ventilator.submitMany([(str(i),) for i in range(20)])
+
+        def check(results):
+            tasks = sorted(int(result[0].rstrip('!')) for result in results)
+            self.assertEqual(tasks, range(20))
+            self.assertEqual(len(self.ventilator.pendingTasks), 0)
+
+        return self.sink.collect(20).addCallback(check)
+
+    def test_slow_worker(self):
+        slow = self.makeWorker(lambda task: defer.Deferred())
+        fast = self.makeWorker(lambda task: task)
+
+        def submit(ignore):
+            for i in range(10):
+                self.ventilator.submit(str(i))
+            return self.sink.collect(8)
+
+        def check(results):
+            self.assertEqual(len(slow.tasks), 2)
+            self.assertEqual(len(fast.tasks), 8)
+            self.assertEqual(len(results), 8)
+
+        # let both workers grant credit
+        return _wait(0.01).addCallback(submit).addCallback(check)
+
+    def test_credit_batch(self):
+        # batch larger than credit: worker returns credit when it runs dry
+        self.makeWorker(lambda task: task, creditBatch=5)
+        self.ventilator.submitMany([(str(i),) for i in range(10)])
+
+        def check(results):
+            self.assertEqual(sorted(int(result[0]) for result in results),
+                             range(10))
+
+        return self.sink.collect(10).addCallback(check)
+
+    def test_worker_expired(self):
+        worker = self.makeWorker(lambda task: task)
+
+        def stop(ignore):
+            self.assertEqual(self.ventilator._credits.values(), [2])
+            self.assertEqual(len(self.ventilator.workers), 1)
+            worker.shutdown()
+            return _wait(0.3)
+
+        def check(ignore):
+            self.assertEqual(self.ventilator._credits, {})
+            self.assertEqual(self.ventilator.workers, {})
+
+        return _wait(0.02).addCallback(stop).addCallback(check)
+
+    def test_worker_seen_again(self):
+        self.makeWorker(lambda task: task)
+
+        def forget(ignore):
+            self.ventilator.workers.clear()
+            self.ventilator._credits.clear()
+            return _wait(0.1)
+
+        def check(ignore):
+            self.assertEqual(self.ventilator._credits.values(), [2])
+            self.assertEqual(len(self.ventilator.workers), 1)
+
+        return _wait(0.02).addCallback(forget).addCallback(check)
+
+    def test_collect_pending(self):
+        self.sink.gotMessage('a')
+        self.sink.gotMessage('b')
+        self.sink.gotMessage('c')
+
+        d1 = self.sink.collect(2)
+        d2 = self.sink.collect(2)
+        self.assertEqual(self.successResultOf(d1), [['a'], ['b']])
+        self.assertNoResult(d2)
+        self.sink.gotMessage('d')
+        self.assertEqual(self.successResultOf(d2), [['c'], ['d']])
+        self.assertEqual(self.successResultOf(self.sink.collect(0)), [])
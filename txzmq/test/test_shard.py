@@ -0,0 +1,83 @@
+"""
+Tests for L{txzmq.shard}.
+"""
+import os
+import tempfile
+import time
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from txzmq.connection import ZmqEndpoint, ZmqEndpointType
+from txzmq.factory import ZmqFactory
+from txzmq.pubsub import ZmqSubConnection
+from txzmq.shard import ZmqShardedFactory
+from txzmq.test import _wait
+from txzmq.xreq_xrep import ZmqXREPConnection, ZmqXREQConnection
+
+
+class ZmqShardEchoConnection(ZmqXREPConnection):
+    autoReply = True
+
+    def gotMessage(self, message_id, *message_parts):
+        return message_parts + (str(os.getpid()),)
+
+
+class ZmqShardedFactoryTestCase(unittest.TestCase):
+    """
+    Test case for L{txzmq.shard.ZmqShardedFactory}.
+    """
+
+    def setUp(self):
+        self.factory = ZmqFactory()
+        self.sharded = ZmqShardedFactory(2)
+        self.address = "ipc://%s/front" % (tempfile.mkdtemp(),)
+
+    def tearDown(self):
+        self.sharded.shutdown()
+        self.factory.shutdown()
+
+    def test_requests(self):
+        self.sharded.addConnection(
+            ZmqShardEchoConnection,
+            ZmqEndpoint(ZmqEndpointType.bind, self.address))
+        self.sharded.start()
+        self.assertEqual(len(self.sharded.processes), 2)
+
+        s = ZmqXREQConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, self.address))
+        s.connect(self.factory)
+
+        def check(results):
+            replies = [result for _, result in results]
+            self.assertEqual([reply[0] for reply in replies], ['aaa'] * 10)
+            pids = set(reply[1] for reply in replies)
+            self.assertNotIn(str(os.getpid()), pids)
+
+        d = defer.DeferredList([s.sendMsg('aaa') for i in range(10)])
+        return d.addCallback(check)
+
+    def test_parent_gone(self):
+        self.sharded.addConnection(
+            ZmqShardEchoConnection,
+            ZmqEndpoint(ZmqEndpointType.bind, self.address))
+        self.sharded.start()
+        # parent dying closes its end of the pipe just the same
+        for process in self.sharded.processes:
+            process.stdin.close()
+        deadline = time.time() + 10
+
+        def check():
+            exited = [process.poll() is not None
+                      for process in self.sharded.processes]
+            if all(exited) or time.time() > deadline:
+                self.assertTrue(all(exited))
+                return
+            return _wait(0.05).addCallback(lambda _: check())
+
+        return check()
+
+    def test_bind_unsupported(self):
+        self.assertRaises(
+            ValueError, self.sharded.addConnection, ZmqSubConnection,
+            ZmqEndpoint(ZmqEndpointType.bind, self.address))
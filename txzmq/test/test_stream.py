@@ -0,0 +1,133 @@
+"""
+Tests for L{txzmq.stream}.
+"""
+from cStringIO import StringIO
+
+from twisted.trial import unittest
+
+from txzmq import exceptions
+from txzmq.connection import ZmqEndpoint, ZmqEndpointType
+from txzmq.factory import ZmqFactory
+from txzmq.stream import (
+    ZmqStreamReceiverConnection, ZmqStreamSenderConnection)
+from txzmq.test import _wait
+
+
+class Consumer(object):
+
+    def __init__(self):
+        self.data = []
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.data.append(data)
+
+
+class ZmqTestReceiverConnection(ZmqStreamReceiverConnection):
+    window = 4
+    creditBatch = 2
+
+    def gotTransfer(self, transfer, *metadata):
+        if metadata == ('reject',):
+            raise ValueError("rejected")
+        self.transfer = transfer
+        self.consumer = Consumer()
+        return self.consumer
+
+
+class ZmqStreamTestCase(unittest.TestCase):
+    """
+    Test case for L{txzmq.stream}.
+    """
+
+    def setUp(self):
+        self.factory = ZmqFactory()
+        self.receiver = ZmqTestReceiverConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#1"))
+        self.receiver.listen(self.factory)
+        self.sender = ZmqStreamSenderConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"))
+        self.sender.chunkSize = 1000
+        self.sender.connect(self.factory)
+
+    def tearDown(self):
+        self.factory.shutdown()
+
+    def test_single_endpoint(self):
+        self.assertRaises(
+            ValueError, ZmqStreamSenderConnection,
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#1"),
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#2"))
+
+    def test_send_file(self):
+        data = ''.join(chr(i % 256) for i in xrange(100500))
+        d = self.sender.sendFile(StringIO(data), 'name', 'size')
+
+        def check(transfer):
+            self.assertEqual(transfer.sentBytes, len(data))
+            incoming = self.receiver.transfer
+            self.assertEqual(incoming.metadata, ['name', 'size'])
+            self.assertEqual(''.join(self.receiver.consumer.data), data)
+            self.assertEqual(incoming.receivedChunks, transfer.sentChunks)
+            self.assertTrue(incoming.done.called)
+            self.assertIdentical(self.receiver.consumer.producer, None)
+            self.assertEqual(self.sender._transfers, {})
+            self.assertEqual(self.receiver._transfers, {})
+
+        return d.addCallback(check)
+
+    def test_window(self):
+        transfer = self.sender.startTransfer()
+        transfer.write('x' * 10000)
+        d = transfer.finish()
+        self.assertEqual(transfer.sentChunks, 0)
+
+        def pause(ignore):
+            self.receiver.transfer.pauseProducing()
+            return _wait(0.05)
+
+        def paused(ignore):
+            # chunks granted before pause plus initial window
+            self.assertTrue(transfer.sentChunks <= 6)
+            self.assertEqual(transfer.sentChunks,
+                             self.receiver.transfer.receivedChunks)
+            self.assertFalse(d.called)
+            self.receiver.transfer.resumeProducing()
+            return d
+
+        def check(ignore):
+            self.assertEqual(''.join(self.receiver.consumer.data),
+                             'x' * 10000)
+
+        d1 = _wait(0).addCallback(pause).addCallback(paused)
+        return d1.addCallback(check)
+
+    def test_reject(self):
+        d = self.sender.sendFile(StringIO('abc'), 'reject')
+
+        def check(error):
+            self.assertEqual(str(error), "exceptions.ValueError: rejected")
+            self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+        d = self.assertFailure(d, exceptions.TransferAbortedError)
+        return d.addCallback(check)
+
+    def test_abort(self):
+        transfer = self.sender.startTransfer()
+        transfer.write('x' * 10000)
+
+        def abort(ignore):
+            incoming = self.receiver.transfer
+            self.assertFailure(incoming.done, exceptions.TransferAbortedError)
+            transfer.abort("cancelled")
+            self.assertEqual(self.sender._transfers, {})
+            return incoming.done
+
+        d = self.assertFailure(transfer.done, exceptions.TransferAbortedError)
+        return _wait(0.01).addCallback(abort).addCallback(lambda _: d)
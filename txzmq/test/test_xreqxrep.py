@@ -1,9 +1,13 @@
 """
 Tests for L{txzmq.xreq_xrep}.
 """
-from twisted.internet import defer
+import math
+import random
+
+from twisted.internet import defer, error, reactor, task
 from twisted.trial import unittest
 
+from txzmq import codec, compression, exceptions
 from txzmq.connection import ZmqEndpoint, ZmqEndpointType
 from txzmq.factory import ZmqFactory
 from txzmq.test import _wait
@@ -20,6 +24,74 @@ class ZmqTestXREPConnection(ZmqXREPConnection):
         self.reply(message_id, *message_parts)
 
 
+class ZmqTestSilentXREPConnection(ZmqXREPConnection):
+
+    def gotMessage(self, message_id, *message_parts):
+        if not hasattr(self, 'messages'):
+            self.messages = []
+        self.messages.append([message_id, message_parts])
+
+
+class ZmqTestAutoReplyXREPConnection(ZmqXREPConnection):
+    autoReply = True
+
+    def gotMessage(self, message_id, *message_parts):
+        if not hasattr(self, 'messages'):
+            self.messages = []
+        self.messages.append([message_id, message_parts])
+        return self.handler(*message_parts)
+
+
+class ZmqTestDelayXREPConnection(ZmqXREPConnection):
+    autoReply = True
+
+    def getDelay(self, message_id):
+        return 0
+
+    def gotMessage(self, message_id, *message_parts):
+        if not hasattr(self, 'messages'):
+            self.messages = []
+        self.messages.append(message_id)
+        delay = self.getDelay(message_id)
+        if delay is None:
+            return None
+        reply = message_parts + (self.name,)
+        if not delay:
+            return reply
+        return task.deferLater(reactor, delay, lambda: reply)
+
+
+def firstTime(first, then):
+    """
+    Return delay function giving C{first} delay to first copy of request
+    and C{then} to others.
+    """
+    seen = set()
+
+    def getDelay(message_id):
+        if message_id in seen:
+            return then
+        seen.add(message_id)
+        return first
+
+    return getDelay
+
+
+class ClockReactor(object):
+    """
+    Reactor with time (and delayed calls) driven by L{task.Clock}.
+    """
+
+    def __init__(self, reactor, clock):
+        self._reactor = reactor
+        self.clock = clock
+        self.seconds = clock.seconds
+        self.callLater = clock.callLater
+
+    def __getattr__(self, name):
+        return getattr(self._reactor, name)
+
+
 class ZmqConnectionTestCase(unittest.TestCase):
     """
     Test case for L{zmq.twisted.connection.Connection}.
@@ -86,3 +158,601 @@ class ZmqConnectionTestCase(unittest.TestCase):
             self.assertEqual(self.s._requests, {})
 
         return self.s.sendMsg('aaa').addCallback(check)
+
+    def test_send_recv_zero_copy(self):
+        self.r.zeroCopyReceive = True
+        d = self.s.sendMsg('aaa', 'bbb')
+
+        def check_response(response):
+            self.assertEqual(response, ['aaa', 'bbb'])
+            self.assertEqual(
+                [part.bytes for part in self.r.messages[0][1]],
+                ['aaa', 'bbb'])
+
+        d.addCallback(check_response)
+        return d
+
+    def test_send_recv_reply_codec(self):
+        self.r.codec = codec.PickleCodec()
+        self.s.codec = codec.PickleCodec()
+        d = self.s.sendMsg({'a': 1}, 0, [])
+
+        def check_response(response):
+            self.assertEqual(response, [{'a': 1}, 0, []])
+            self.assertEqual(self.r.messages, [['msg_id_1', ({'a': 1}, 0, [])]])
+
+        d.addCallback(check_response)
+        return d
+
+    def test_send_recv_reply_compressed(self):
+        self.r.compression = compression.ZlibCompressor()
+        self.r.codec = codec.PickleCodec()
+        self.s.compression = compression.ZlibCompressor()
+        self.s.codec = codec.PickleCodec()
+        self.s.threadedCompressionSize = 1000
+        d = self.s.sendMsg(['0'] * 10000, 'abcd')
+
+        def check_response(response):
+            self.assertEqual(response, [['0'] * 10000, 'abcd'])
+
+        d.addCallback(check_response)
+        return d
+
+    def test_max_pending_requests(self):
+        self.s.maxPendingRequests = 2
+        deferreds = [self.s.sendMsg(str(i)) for i in range(5)]
+        self.assertEqual(len(self.s._requests), 2)
+        self.assertEqual(len(self.s._waiting), 3)
+
+        def check(results):
+            self.assertEqual(
+                [result for _, result in results],
+                [[str(i)] for i in range(5)])
+            self.assertEqual(self.s._requests, {})
+
+        return defer.DeferredList(deferreds).addCallback(check)
+
+    def test_max_waiting_requests(self):
+        self.s.maxPendingRequests = 1
+        self.s.maxWaitingRequests = 2
+        deferreds = [self.s.sendMsg(str(i)) for i in range(3)]
+        self.assertRaises(exceptions.QueueFullError, self.s.sendMsg, '3')
+        self.assertEqual(len(self.s._waiting), 2)
+        return defer.gatherResults(deferreds)
+
+    def test_default_ids(self):
+        s = ZmqXREQConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "ipc://#3"))
+        s.identity = 'client2'
+        s.connect(self.factory)
+        other = ZmqXREQConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "ipc://#3"))
+
+        ids = [s._getNextId() for i in range(3)]
+        self.assertEqual(len(set(ids)), 3)
+        self.assertEqual(map(len, ids), [16] * 3)
+        self.assertNotEqual(ids[0], other._getNextId())
+
+        d = s.sendMsg('aaa')
+        d.addCallback(self.assertEqual, ['aaa'])
+        return d
+
+    def test_routing_info_cleanup(self):
+        d = self.s.sendMsg('aaa')
+
+        def check(ignore):
+            self.assertEqual(self.r._routing_info, {})
+
+        return d.addCallback(check)
+
+    def test_unknown_reply(self):
+        self.s.messageReceived(['unknown', '', 'aaa'])
+        self.assertEqual(self.s._requests, {})
+
+
+class ZmqRoutingTableTestCase(unittest.TestCase):
+    """
+    Test case for limits of XREP routing table.
+    """
+
+    def setUp(self):
+        self.reactor = task.Clock()
+        self.r = ZmqTestSilentXREPConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#5"))
+        self.r.factory = self
+
+    def receive(self, *message_ids):
+        for message_id in message_ids:
+            self.r.messageReceived(['peer', message_id, '', 'aaa'])
+
+    def test_timeout(self):
+        self.r.routingTimeout = 10
+        self.receive('id1', 'id2')
+        self.reactor.advance(5)
+        self.receive('id3')
+        self.reactor.advance(5)
+        self.receive('id4')
+
+        self.assertEqual(self.r._routing_info.keys(), ['id3', 'id4'])
+        self.assertEqual(self.r._routing_info['id4'], (('peer',), 10))
+        self.assertEqual(self.r.expiredReplies, 2)
+
+    def test_max_pending(self):
+        self.r.maxPendingReplies = 2
+        self.receive('id1', 'id2', 'id1', 'id3')
+
+        self.assertEqual(self.r._routing_info.keys(), ['id1', 'id3'])
+        self.assertEqual(self.r.evictedReplies, 1)
+
+    def test_reply_unknown(self):
+        self.r.reply('id1', 'aaa')
+
+
+class ZmqAutoReplyTestCase(unittest.TestCase):
+    """
+    Test case for XREP replying with handler results.
+    """
+
+    def setUp(self):
+        self.factory = ZmqFactory()
+        self.r = ZmqTestAutoReplyXREPConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#6"))
+        self.r.listen(self.factory)
+        self.s = ZmqXREQConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#6"))
+        self.s.connect(self.factory)
+
+    def tearDown(self):
+        self.factory.shutdown()
+
+    def test_reply_value(self):
+        self.r.handler = lambda *parts: parts + ('ccc',)
+        d = self.s.sendMsg('aaa', 'bbb')
+        d.addCallback(self.assertEqual, ['aaa', 'bbb', 'ccc'])
+        return d
+
+    def test_reply_deferred(self):
+        self.r.handler = lambda part: task.deferLater(
+            self.factory.reactor, 0.01, lambda: part * 2)
+        d = self.s.sendMsg('aaa')
+        d.addCallback(self.assertEqual, ['aaaaaa'])
+        return d
+
+    def test_reply_error(self):
+
+        def handler(part):
+            raise ValueError("ohnoz!")
+
+        self.r.handler = handler
+        d = self.s.sendMsg('aaa')
+
+        def check(reply):
+            self.assertEqual(
+                reply, ['ERROR', 'exceptions.ValueError: ohnoz!'])
+            self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+        return d.addCallback(check)
+
+    def test_max_in_flight(self):
+        self.r.maxInFlight = 2
+        pending = []
+
+        def handler(part):
+            pending.append(defer.Deferred())
+            return pending[-1].addCallback(lambda _: part)
+
+        self.r.handler = handler
+        deferreds = [self.s.sendMsg(str(i)) for i in range(5)]
+
+        def check(ignore):
+            self.assertEqual(len(pending), 2)
+            self.assertTrue(self.r._readPaused)
+            self.r.handler = lambda part: part
+            for d in pending:
+                d.callback(None)
+            return defer.DeferredList(deferreds)
+
+        def checkReplies(results):
+            self.assertEqual(
+                [result for _, result in results],
+                [[str(i)] for i in range(5)])
+            self.assertFalse(self.r._readPaused)
+
+        d = _wait(0.01).addCallback(check)
+        return d.addCallback(checkReplies)
+
+    def test_max_in_flight_backlog(self):
+        self.r.maxInFlight = 2
+        self.r.handler = lambda part: defer.Deferred()
+        for i in range(100):
+            self.s.sendMsg(str(i)).addErrback(
+                lambda f: f.trap(error.ConnectionDone))
+
+        def check(ignore):
+            # the rest is left in ZeroMQ queues
+            self.assertEqual(len(self.r._backlog), 0)
+            self.assertEqual(len(self.r._routing_info), 2)
+
+        return _wait(0.05).addCallback(check)
+
+
+class ZmqRequestTimeoutTestCase(unittest.TestCase):
+    """
+    Test case for timeouts and cancellation of XREQ requests.
+    """
+
+    def setUp(self):
+        self.factory = ZmqFactory()
+        self.r = ZmqTestSilentXREPConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#4"))
+        self.r.listen(self.factory)
+        self.s = ZmqXREQConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#4"))
+        self.s.connect(self.factory)
+        self.count = 0
+
+        def get_next_id():
+            self.count += 1
+            return 'msg_id_%d' % (self.count,)
+
+        self.s._getNextId = get_next_id
+
+    def tearDown(self):
+        self.factory.shutdown()
+
+    def test_timeout(self):
+        failed = []
+        d1 = self.s.sendMsg('aaa', timeout=0.05)
+        d2 = self.s.sendMsg('bbb', timeout=0.01)
+        d1.addErrback(lambda f: failed.append(('msg_id_1', f)))
+        d2.addErrback(lambda f: failed.append(('msg_id_2', f)))
+
+        def check(ignore):
+            self.assertEqual([msg_id for msg_id, _ in failed],
+                             ['msg_id_2', 'msg_id_1'])
+            for _, failure in failed:
+                failure.trap(exceptions.RequestTimeoutError)
+            self.assertEqual(self.s._requests, {})
+            self.assertIdentical(self.s._timeoutCall, None)
+
+        return _wait(0.1).addCallback(check)
+
+    def test_default_timeout(self):
+        self.s.requestTimeout = 0.01
+        d = self.s.sendMsg('aaa')
+        return self.assertFailure(d, exceptions.RequestTimeoutError)
+
+    def test_cancel(self):
+        self.s.requestTimeout = 0.01
+        d = self.s.sendMsg('aaa')
+        d.cancel()
+        self.assertEqual(self.s._requests, {})
+        self.assertEqual(self.s._deadlines, {})
+
+        def reply(ignore):
+            self.r.reply(self.r.messages[0][0], 'aaa')
+            return _wait(0.01)
+
+        d = self.assertFailure(d, defer.CancelledError)
+        return d.addCallback(lambda _: _wait(0.01)).addCallback(reply)
+
+    def test_cancel_waiting(self):
+        self.s.maxPendingRequests = 1
+        self.s.sendMsg('aaa').addErrback(
+            lambda f: f.trap(error.ConnectionDone))
+        d = self.s.sendMsg('bbb')
+        self.assertEqual(len(self.s._waiting), 1)
+        d.cancel()
+        self.assertEqual(len(self.s._waiting), 0)
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_shutdown(self):
+        self.s.maxPendingRequests = 1
+        self.s.requestTimeout = 10
+        self.s.retries = 1
+        d1 = self.s.sendMsg('aaa')
+        d2 = self.s.sendMsg('bbb')
+        self.s.shutdown()
+        self.assertEqual(self.s._requests, {})
+        self.assertEqual(len(self.s._waiting), 0)
+        self.assertEqual(self.s._deadlines, {})
+        self.assertEqual(self.s._timeouts, [])
+        self.assertEqual(self.s._retrying, {})
+        self.assertEqual(self.s._retryDeadlines, {})
+        self.assertIdentical(self.s._timeoutCall, None)
+        return defer.DeferredList([
+            self.assertFailure(d1, error.ConnectionDone),
+            self.assertFailure(d2, error.ConnectionDone)])
+
+
+class ZmqRetryTestCase(unittest.TestCase):
+    """
+    Test case for retrying and hedging of XREQ requests.
+    """
+
+    def setUp(self):
+        self.factory = ZmqFactory()
+        self.a = ZmqTestDelayXREPConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#5"))
+        self.a.name = 'a'
+        self.a.listen(self.factory)
+        self.b = ZmqTestDelayXREPConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#6"))
+        self.b.name = 'b'
+        self.b.listen(self.factory)
+
+    def tearDown(self):
+        self.factory.shutdown()
+
+    def makeClient(self, *addresses):
+        s = ZmqXREQConnection(*[
+            ZmqEndpoint(ZmqEndpointType.connect, address)
+            for address in addresses])
+        s.retryBackoff = 1
+        s.connect(self.factory)
+        return s
+
+    def test_retry(self):
+        self.a.getDelay = firstTime(None, 0)
+        s = self.makeClient("inproc://#5")
+        s.retries = 2
+        s.retryTimeout = 0.05
+
+        def check(reply):
+            self.assertEqual(reply, ['aaa', 'a'])
+            self.assertEqual(s.retriedRequests, 1)
+            self.assertEqual(len(self.a.messages), 2)
+            self.assertEqual(len(set(self.a.messages)), 1)
+            self.assertEqual(s._retrying, {})
+            self.assertEqual(s._retryDeadlines, {})
+
+        return s.sendMsg('aaa').addCallback(check)
+
+    def test_retries_exhausted(self):
+        self.a.getDelay = lambda message_id: None
+        s = self.makeClient("inproc://#5")
+        s.retries = 1
+        s.retryTimeout = 0.02
+
+        def check(ignore):
+            self.assertEqual(len(self.a.messages), 2)
+            self.assertEqual(s._requests, {})
+            self.assertEqual(s._retrying, {})
+
+        d = self.assertFailure(
+            s.sendMsg('aaa'), exceptions.RequestTimeoutError)
+        return d.addCallback(check)
+
+    def test_reroute(self):
+        self.a.getDelay = lambda message_id: None
+        s = self.makeClient("inproc://#5", "inproc://#6")
+        s.retries = 3
+        s.retryTimeout = 0.05
+
+        def send(ignore):
+            return defer.gatherResults([s.sendMsg('aaa'), s.sendMsg('bbb')])
+
+        def check(replies):
+            self.assertEqual(replies, [['aaa', 'b'], ['bbb', 'b']])
+            self.assertTrue(s.retriedRequests >= 1)
+
+        return _wait(0.01).addCallback(send).addCallback(check)
+
+    def test_duplicate_reply(self):
+        self.a.getDelay = lambda message_id: 0.15
+        s = self.makeClient("inproc://#5", "inproc://#6")
+        s.retries = 3
+        s.retryTimeout = 0.05
+
+        def send(ignore):
+            return defer.gatherResults([s.sendMsg('aaa'), s.sendMsg('bbb')])
+
+        def check(replies):
+            self.assertEqual(replies, [['aaa', 'b'], ['bbb', 'b']])
+            return _wait(0.2)
+
+        def checkDuplicates(ignore):
+            self.assertEqual(s.duplicateReplies, 1)
+            self.assertEqual(len(s._duplicates), 1)
+
+        d = _wait(0.01).addCallback(send).addCallback(check)
+        return d.addCallback(checkDuplicates)
+
+    def test_hedge(self):
+        s = self.makeClient("inproc://#5")
+        s.hedgeQuantile = 0.9
+        s.hedgeMinSamples = 5
+
+        def slow(replies):
+            self.assertEqual(len(replies), 10)
+            self.assertNotIdentical(s._hedgeDelay, None)
+            self.a.getDelay = firstTime(0.3, 0)
+            self.started = reactor.seconds()
+            return s.sendMsg('slow')
+
+        def check(reply):
+            self.assertEqual(reply, ['slow', 'a'])
+            self.assertTrue(reactor.seconds() - self.started < 0.25)
+            self.assertEqual(s.hedgedRequests, 1)
+            self.assertEqual(s.retriedRequests, 0)
+            # slow copy isn't replied, as routing info is already used
+            return _wait(0.35)
+
+        d = defer.gatherResults([s.sendMsg(str(i)) for i in range(10)])
+        return d.addCallback(slow).addCallback(check)
+
+    def test_hedge_delay(self):
+        self.a.getDelay = lambda message_id: None
+        clock = task.Clock()
+        self.factory.reactor = ClockReactor(self.factory.reactor, clock)
+        s = self.makeClient("inproc://#5")
+        s.hedgeQuantile = 0.95
+        s.latencyWindow = 500
+
+        rng = random.Random(0)
+        latencies = []
+        for i in xrange(2000):
+            d = s.sendMsg('aaa')
+            message_id, = s._requests.keys()
+            # median of 10ms, 95th percentile of about 23ms
+            latency = rng.lognormvariate(math.log(0.01), 0.5)
+            latencies.append(latency)
+            clock.advance(latency)
+            s.messageReceived([message_id, '', 'aaa'])
+            self.assertEqual(self.successResultOf(d), ['aaa'])
+
+        recent = sorted(latencies[-s.latencyWindow:])
+        expected = recent[int(len(recent) * 0.95)]
+        self.assertTrue(abs(s._hedgeDelay - expected) < 0.2 * expected,
+                        (s._hedgeDelay, expected))
+        self.assertTrue(s.hedgedRequests < 0.1 * len(latencies),
+                        s.hedgedRequests)
+
+    def test_hedge_without_retries(self):
+        s = self.makeClient("inproc://#5")
+        s.hedgeQuantile = 0.9
+        s.hedgeMinSamples = 5
+        s.retryTimeout = 0.05
+
+        def slow(ignore):
+            # both before and after hedging starts, slow requests wait
+            # for reply longer than retryTimeout
+            self.a.getDelay = lambda message_id: 0.15
+            return s.sendMsg('slow')
+
+        def hedged(reply):
+            self.assertEqual(reply, ['slow', 'a'])
+            self.assertEqual(s.hedgedRequests, 0)
+            self.a.getDelay = lambda message_id: 0
+            return defer.gatherResults(
+                [s.sendMsg(str(i)) for i in range(10)])
+
+        def check(reply):
+            self.assertEqual(reply, ['slow', 'a'])
+            self.assertEqual(s.hedgedRequests, 1)
+            self.assertEqual(s.retriedRequests, 0)
+            self.assertEqual(s._retrying, {})
+            return _wait(0.2)
+
+        d = slow(None).addCallback(hedged).addCallback(slow)
+        return d.addCallback(check)
+
+
+class ZmqReplyCacheTestCase(unittest.TestCase):
+    """
+    Test case for caching and coalescing of XREP replies.
+    """
+
+    def setUp(self):
+        self.factory = ZmqFactory()
+        self.r = ZmqTestAutoReplyXREPConnection(
+            ZmqEndpoint(ZmqEndpointType.bind, "inproc://#7"))
+        self.r.replyCacheSize = 10
+        self.r.handler = self.handler
+        self.r.listen(self.factory)
+        self.s = ZmqXREQConnection(
+            ZmqEndpoint(ZmqEndpointType.connect, "inproc://#7"))
+        self.s.connect(self.factory)
+        self.calls = []
+        self.delay = 0
+
+    def tearDown(self):
+        self.factory.shutdown()
+
+    def handler(self, *parts):
+        self.calls.append(parts)
+        reply = parts + (str(len(self.calls)),)
+        if parts == ('none',):
+            reply = None
+        if not self.delay:
+            return reply
+        return task.deferLater(self.factory.reactor, self.delay, lambda: reply)
+
+    @defer.inlineCallbacks
+    def test_cache_hit(self):
+        reply = yield self.s.sendMsg('aaa', 'bbb')
+        self.assertEqual(reply, ['aaa', 'bbb', '1'])
+        reply = yield self.s.sendMsg('aaa', 'bbb')
+        self.assertEqual(reply, ['aaa', 'bbb', '1'])
+        reply = yield self.s.sendMsg('aaa')
+        self.assertEqual(reply, ['aaa', '2'])
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual((self.r.cacheHits, self.r.cacheMisses), (1, 2))
+
+    @defer.inlineCallbacks
+    def test_coalesce(self):
+        self.delay = 0.02
+        replies = yield defer.gatherResults(
+            [self.s.sendMsg('aaa') for i in range(3)] +
+            [self.s.sendMsg('bbb')])
+        self.assertEqual(replies,
+                         [['aaa', '1'], ['aaa', '1'], ['aaa', '1'],
+                          ['bbb', '2']])
+        self.assertEqual(self.calls, [('aaa',), ('bbb',)])
+        self.assertEqual(self.r.coalescedRequests, 2)
+        self.assertEqual(self.r._coalesced, {})
+
+    @defer.inlineCallbacks
+    def test_no_reply(self):
+        self.delay = 0.02
+        requests = [self.s.sendMsg('none', timeout=0.1) for i in range(3)]
+        yield defer.DeferredList([
+            self.assertFailure(d, exceptions.RequestTimeoutError)
+            for d in requests])
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.r._routing_info, {})
+        # cached empty reply
+        yield self.assertFailure(
+            self.s.sendMsg('none', timeout=0.05),
+            exceptions.RequestTimeoutError)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.r.cacheHits, 1)
+        self.assertEqual(self.r._routing_info, {})
+
+    @defer.inlineCallbacks
+    def test_coalesce_only(self):
+        self.r.replyCacheSize = 0
+        yield self.s.sendMsg('aaa')
+        yield self.s.sendMsg('aaa')
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(len(self.r._replyCache), 0)
+
+    @defer.inlineCallbacks
+    def test_eviction(self):
+        self.r.replyCacheSize = 2
+        for part in ['aaa', 'bbb', 'aaa', 'ccc', 'bbb']:
+            yield self.s.sendMsg(part)
+        self.assertEqual(self.calls, [('aaa',), ('bbb',), ('ccc',), ('bbb',)])
+        self.assertEqual(self.r.cacheHits, 1)
+        self.assertEqual(self.r.cacheEvictions, 2)
+        self.assertEqual(self.r._replyCache.keys(), [('ccc',), ('bbb',)])
+
+    @defer.inlineCallbacks
+    def test_ttl(self):
+        self.r.replyCacheTTL = 0.05
+        yield self.s.sendMsg('aaa')
+        yield self.s.sendMsg('aaa')
+        yield _wait(0.1)
+        reply = yield self.s.sendMsg('aaa')
+        self.assertEqual(reply, ['aaa', '2'])
+        self.assertEqual(self.r.cacheHits, 1)
+
+    @defer.inlineCallbacks
+    def test_error_not_cached(self):
+
+        def handler(part):
+            self.calls.append(part)
+            raise ValueError("ohnoz!")
+
+        self.r.handler = handler
+        for i in range(2):
+            reply = yield self.s.sendMsg('aaa')
+            self.assertEqual(
+                reply, ['ERROR', 'exceptions.ValueError: ohnoz!'])
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 2)
+
+    def test_codec_key(self):
+        self.r.codec = codec.JSONCodec()
+        self.assertEqual(self.r.cacheKey([{'a': 1}, [2]]),
+                         ('{"a":1}', '[2]'))
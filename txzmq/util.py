@@ -1,4 +1,5 @@
 from zmq.core import constants
+from zmq.core.message import Frame
 
 
 def getSocketType(socketNumber):
@@ -29,3 +30,31 @@ def buildErrorMessage(err):
     if len(err.args) > 0:
         message = err.args[0]
     return "%s: %s" % (getDottedClassName(err), message)
+
+
+def toBytes(part):
+    """
+    Return contents of message part as C{str}.
+
+    @param part: message part, as received by L{ZmqConnection}
+    @type part: C{str}, L{Frame} or C{memoryview}
+    """
+    if isinstance(part, str):
+        return part
+    if isinstance(part, Frame):
+        return part.bytes
+    return part.tobytes()
+
+
+def frameBuffer(frame):
+    """
+    Return C{memoryview} of L{Frame} contents, without copying.
+
+    L{Frame.buffer} of received frames is broken (zero-dimensional) in some
+    pyzmq versions, so view is made through old-style C{buffer}.
+
+    @param frame: message frame
+    @type frame: L{Frame}
+    @rtype: C{memoryview}
+    """
+    return memoryview(buffer(frame))
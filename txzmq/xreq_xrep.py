@@ -1,74 +1,590 @@
 """
 ZeroMQ PUB-SUB wrappers.
 """
+import heapq
+import itertools
+import operator
+import os
+import struct
+from collections import OrderedDict, deque
+
 from zmq.core import constants
 
-from twisted.internet import defer
+from twisted.internet import defer, error
+from twisted.python import log
 
+from txzmq import exceptions, util
 from txzmq.connection import ZmqConnection
 
 
+_packCounter = struct.Struct('!Q').pack
+
+
+class _RetryState(object):
+    """
+    Request which could be sent again.
+    """
+    __slots__ = ('parts', 'retries', 'timeout', 'firstSent', 'started',
+                 'sends', 'hedging')
+
+    def __init__(self, parts, retries, timeout):
+        self.parts = parts
+        self.retries = retries
+        self.timeout = timeout
+        self.firstSent = None
+        self.started = None
+        self.sends = 0
+        self.hedging = False
+
+
 class ZmqXREQConnection(ZmqConnection):
     """
     A XREQ connection.
+
+    Requests could time out: timeouts are kept in a heap served by single
+    delayed call, so cost of pending request doesn't depend on number of
+    requests in flight.
+
+    Requests not replied in time could be sent again (see L{retries}), and
+    slow requests could be hedged: sent again once they take longer than
+    most of requests do (see L{hedgeQuantile}); first reply wins. XREQ
+    socket passes messages to connected endpoints round-robin, so copies
+    of request go to other endpoints of L{endpoints}. All the copies have
+    the same message id, late replies to them are dropped.
+
+    @cvar requestTimeout: default request timeout (in seconds), C{None}
+        for no timeout
+    @type requestTimeout: C{float}
+    @cvar maxPendingRequests: maximum number of requests sent and waiting
+        for reply; further requests are queued until replies arrive,
+        C{None} for no limit
+    @type maxPendingRequests: C{int}
+    @cvar maxWaitingRequests: maximum number of requests queued because of
+        L{maxPendingRequests}; further requests are rejected with
+        L{exceptions.QueueFullError}, C{None} for no limit
+    @type maxWaitingRequests: C{int}
+    @cvar retries: number of times request is sent again if there is no
+        reply in L{retryTimeout}; request fails with
+        L{exceptions.RequestTimeoutError} once they are used up
+    @type retries: C{int}
+    @cvar retryTimeout: time to wait for reply (in seconds) before first
+        retry
+    @type retryTimeout: C{float}
+    @cvar retryBackoff: time to wait for reply is multiplied by that on
+        each retry
+    @type retryBackoff: C{float}
+    @cvar hedgeQuantile: if set, request is sent again once it takes
+        longer than that quantile (e.g. 0.95) of recent request latencies,
+        C{None} for no hedging; without L{retries} hedged request fails
+        only by its timeout
+    @type hedgeQuantile: C{float}
+    @cvar hedgeMinSamples: number of latencies to collect before hedging
+        starts
+    @type hedgeMinSamples: C{int}
+    @cvar latencyWindow: number of recent latencies L{hedgeQuantile} is
+        computed over
+    @type latencyWindow: C{int}
+
+    @ivar retriedRequests: number of requests sent again by L{retries}
+    @type retriedRequests: C{int}
+    @ivar hedgedRequests: number of requests sent again by hedging
+    @type hedgedRequests: C{int}
+    @ivar duplicateReplies: number of late replies to requests sent
+        several times, which were dropped
+    @type duplicateReplies: C{int}
     """
     socketType = constants.XREQ
+    requestTimeout = None
+    maxPendingRequests = None
+    maxWaitingRequests = 1000
+    retries = 0
+    retryTimeout = 1.0
+    retryBackoff = 2.0
+    hedgeQuantile = None
+    hedgeMinSamples = 20
+    latencyWindow = 1000
+
+    # number of ids of requests sent several times remembered to drop
+    # duplicate replies
+    _duplicatesLimit = 10000
 
     def __init__(self, factory, *endpoints):
         ZmqConnection.__init__(self, factory, *endpoints)
         self._requests = {}
+        self._waiting = OrderedDict()
+        self._deadlines = {}
+        self._timeouts = []
+        self._timeoutCall = None
+        self._idPrefix = os.urandom(8)
+        self._idCounter = itertools.count()
+        self._retrying = {}
+        self._retryDeadlines = {}
+        self._duplicates = OrderedDict()
+        self._latencies = deque()
+        self._newLatencies = 0
+        self._hedgeDelay = None
+        self.retriedRequests = 0
+        self.hedgedRequests = 0
+        self.duplicateReplies = 0
+
+    def shutdown(self):
+        """
+        Shutdown connection and socket, failing pending and queued
+        requests with L{error.ConnectionDone}.
+        """
+        if self._timeoutCall is not None:
+            self._timeoutCall.cancel()
+            self._timeoutCall = None
+        pending = self._requests.values() + [
+            d for d, message_parts in self._waiting.itervalues()]
+        self._requests.clear()
+        self._waiting.clear()
+        self._deadlines.clear()
+        self._timeouts = []
+        self._retrying.clear()
+        self._retryDeadlines.clear()
+        ZmqConnection.shutdown(self)
+        for d in pending:
+            d.errback(error.ConnectionDone("connection shut down"))
 
     def _getNextId(self):
         """
         Returns an unique id.
+
+        Id is 16 bytes: random per-connection prefix and counter, so it
+        is unique across connections and processes.
         """
-        raise NotImplementedError(self)
+        return self._idPrefix + _packCounter(next(self._idCounter))
 
-    def sendMsg(self, *message_parts):
+    def sendMsg(self, *message_parts, **kwargs):
         """
         Send L{message} with specified L{tag}.
 
+        Returned deferred could be cancelled, request is forgotten then
+        (and not sent at all, if it is still queued).
+
         @param message_parts: message data
         @type message: C{tuple}
+        @keyword timeout: request timeout (in seconds), overrides
+            L{requestTimeout}
+        @return: deferred firing with reply message parts, or failing
+            with L{exceptions.RequestTimeoutError}
+        @rtype: L{Deferred}
+        @raise exceptions.QueueFullError: L{maxWaitingRequests} requests
+            are queued already
         """
-        d = defer.Deferred()
+        timeout = kwargs.pop('timeout', self.requestTimeout)
+        if kwargs:
+            raise TypeError("unexpected keyword arguments: %s" % (
+                ", ".join(kwargs),))
+        queue = (self.maxPendingRequests is not None and
+                 len(self._requests) >= self.maxPendingRequests)
+        if (queue and self.maxWaitingRequests is not None and
+                len(self._waiting) >= self.maxWaitingRequests):
+            raise exceptions.QueueFullError(
+                "%d requests pending, %d queued" % (
+                    len(self._requests), len(self._waiting)))
         message_id = self._getNextId()
-        self._requests[message_id] = d
-        self.send([message_id, ''] + list(message_parts))
+        d = defer.Deferred(lambda _: self._forget(message_id))
+        if queue:
+            self._waiting[message_id] = (d, message_parts)
+        else:
+            self._send(message_id, d, message_parts)
+        if timeout is not None and not d.called:
+            self._addTimeout(message_id, timeout)
         return d
 
+    def _send(self, message_id, d, message_parts):
+        """
+        Send request message.
+
+        @param message_id: message id
+        @type message_id: C{str}
+        @param d: deferred firing with reply
+        @type d: L{Deferred}
+        @param message_parts: message data
+        @type message_parts: C{tuple}
+        """
+        self._requests[message_id] = d
+        try:
+            sent = self._sendPayloads(
+                [[message_id, '']], [message_parts], operator.add)
+        except Exception:
+            del self._requests[message_id]
+            raise
+        if sent is not None:
+            sent.addErrback(self._sendFailed, message_id)
+        if self.retries or self.hedgeQuantile is not None:
+            # when only hedging, request is failed only by its timeout
+            state = self._retrying[message_id] = _RetryState(
+                message_parts, self.retries,
+                self.retryTimeout if self.retries else None)
+            self._startAttempt(message_id, state)
+
+    def _startAttempt(self, message_id, state):
+        """
+        Schedule retry (or hedging) of request just sent.
+
+        @param message_id: message id
+        @type message_id: C{str}
+        @param state: retry state of request
+        @type state: L{_RetryState}
+        """
+        now = self.factory.reactor.seconds()
+        if state.firstSent is None:
+            state.firstSent = now
+        state.started = now
+        state.sends += 1
+        delay = state.timeout
+        if state.sends == 1 and self._hedgeDelay is not None:
+            if delay is None or self._hedgeDelay < delay:
+                state.hedging = True
+                delay = self._hedgeDelay
+        if delay is None:
+            return
+        self._retryDeadlines[message_id] = now + delay
+        self._pushDeadline(now + delay, message_id)
+
+    def _retry(self, message_id):
+        """
+        Send request again, or fail it if retries are used up.
+
+        @param message_id: message id
+        @type message_id: C{str}
+        """
+        state = self._retrying[message_id]
+        if state.hedging:
+            state.hedging = False
+            self.hedgedRequests += 1
+            deadline = None
+            if state.timeout is not None:
+                deadline = state.started + state.timeout
+            state.sends += 1
+            self._resend(message_id, state)
+            if message_id in self._retrying and deadline is not None:
+                self._retryDeadlines[message_id] = deadline
+                self._pushDeadline(deadline, message_id)
+            return
+        if not state.retries:
+            d = self._forget(message_id)
+            d.errback(exceptions.RequestTimeoutError(
+                "no reply to request %r after %d attempts" % (
+                    message_id, self.retries + 1)))
+            return
+        state.retries -= 1
+        state.timeout *= self.retryBackoff
+        self.retriedRequests += 1
+        self._resend(message_id, state)
+        if message_id in self._retrying:
+            self._startAttempt(message_id, state)
+
+    def _resend(self, message_id, state):
+        """
+        Send copy of request.
+
+        @param message_id: message id
+        @type message_id: C{str}
+        @param state: retry state of request
+        @type state: L{_RetryState}
+        """
+        try:
+            sent = self._sendPayloads(
+                [[message_id, '']], [state.parts], operator.add)
+        except Exception:
+            self._forget(message_id).errback()
+            return
+        if sent is not None:
+            sent.addErrback(self._sendFailed, message_id)
+
+    def _addLatency(self, latency):
+        """
+        Collect request latency, updating hedging delay from time to time.
+
+        @param latency: latency, in seconds
+        @type latency: C{float}
+        """
+        latencies = self._latencies
+        latencies.append(latency)
+        if len(latencies) > self.latencyWindow:
+            latencies.popleft()
+        self._newLatencies += 1
+        if (len(latencies) >= self.hedgeMinSamples and
+                self._newLatencies * 20 >= len(latencies)):
+            self._newLatencies = 0
+            ordered = sorted(latencies)
+            self._hedgeDelay = ordered[min(
+                len(ordered) - 1, int(len(ordered) * self.hedgeQuantile))]
+
+    def _sendWaiting(self):
+        """
+        Send queued requests while there is room for them.
+        """
+        while self._waiting and (
+                len(self._requests) < self.maxPendingRequests):
+            message_id, (d, message_parts) = self._waiting.popitem(False)
+            try:
+                self._send(message_id, d, message_parts)
+            except Exception:
+                self._deadlines.pop(message_id, None)
+                d.errback()
+
+    def _forget(self, message_id):
+        """
+        Drop sent or queued request.
+
+        @param message_id: message id
+        @type message_id: C{str}
+        @return: request deferred, or C{None} if request is unknown
+        @rtype: L{Deferred}
+        """
+        self._deadlines.pop(message_id, None)
+        d = self._requests.pop(message_id, None)
+        if d is not None:
+            state = self._retrying.pop(message_id, None)
+            if state is not None:
+                self._retryDeadlines.pop(message_id, None)
+                if state.sends > 1:
+                    # replies to other copies may still arrive
+                    self._duplicates[message_id] = None
+                    if len(self._duplicates) > self._duplicatesLimit:
+                        self._duplicates.popitem(False)
+            if self._waiting:
+                self._sendWaiting()
+            return d
+        waiting = self._waiting.pop(message_id, None)
+        if waiting is not None:
+            return waiting[0]
+        return None
+
+    def _addTimeout(self, message_id, timeout):
+        """
+        Schedule request timeout.
+
+        @param message_id: message id
+        @type message_id: C{str}
+        @param timeout: timeout, in seconds
+        @type timeout: C{float}
+        """
+        deadline = self.factory.reactor.seconds() + timeout
+        self._deadlines[message_id] = deadline
+        self._pushDeadline(deadline, message_id)
+
+    def _pushDeadline(self, deadline, message_id):
+        """
+        Add timeout or retry deadline to the heap.
+
+        @param deadline: time deadline is at
+        @type deadline: C{float}
+        @param message_id: message id
+        @type message_id: C{str}
+        """
+        heapq.heappush(self._timeouts, (deadline, message_id))
+        pending = len(self._deadlines) + len(self._retryDeadlines)
+        if len(self._timeouts) > 2 * pending + 64:
+            # drop deadlines of requests which are already done
+            self._timeouts = [
+                (pending_deadline, pending_id)
+                for deadlines in (self._deadlines, self._retryDeadlines)
+                for pending_id, pending_deadline in deadlines.iteritems()]
+            heapq.heapify(self._timeouts)
+        self._scheduleTimeouts()
+
+    def _scheduleTimeouts(self):
+        """
+        Make sure delayed call fires at the earliest deadline.
+        """
+        if not self._timeouts:
+            if self._timeoutCall is not None:
+                self._timeoutCall.cancel()
+                self._timeoutCall = None
+            return
+        reactor = self.factory.reactor
+        deadline = self._timeouts[0][0]
+        delay = max(0, deadline - reactor.seconds())
+        if self._timeoutCall is None:
+            self._timeoutCall = reactor.callLater(delay, self._checkTimeouts)
+        elif self._timeoutCall.getTime() > deadline:
+            self._timeoutCall.reset(delay)
+
+    def _checkTimeouts(self):
+        """
+        Fail requests which have timed out, retry the ones due.
+        """
+        self._timeoutCall = None
+        now = self.factory.reactor.seconds()
+        expired, retried = [], []
+        while self._timeouts and self._timeouts[0][0] <= now:
+            deadline, message_id = heapq.heappop(self._timeouts)
+            if self._deadlines.get(message_id) == deadline:
+                expired.append(message_id)
+            if self._retryDeadlines.get(message_id) == deadline:
+                retried.append(message_id)
+        for message_id in expired:
+            d = self._forget(message_id)
+            if d is not None:
+                d.errback(exceptions.RequestTimeoutError(
+                    "no reply to request %r" % (message_id,)))
+        for message_id in retried:
+            # request might be done by now
+            if self._retryDeadlines.pop(message_id, None) is not None:
+                self._retry(message_id)
+                if self.factory is None:  # disconnected
+                    return
+        if self.factory is not None:
+            self._scheduleTimeouts()
+
+    def _sendFailed(self, failure, message_id):
+        """
+        Called when request message couldn't be sent.
+
+        @param failure: reason
+        @type failure: L{Failure}
+        @param message_id: message id
+        @type message_id: C{str}
+        """
+        d = self._forget(message_id)
+        if d is not None:
+            d.errback(failure)
+
+    def _splitPayload(self, message):
+        """
+        Split message into message id (with delimiter) and payload.
+
+        @param message: message data
+        @type message: C{list}
+        """
+        return message[:2], message[2:]
+
     def messageReceived(self, message):
         """
         Called on incoming message from ZeroMQ.
 
         @param message: message data
         """
-        msg_id, _, msg = message[0], message[1], message[2:]
-        d = self._requests.pop(msg_id)
+        msg_id, _, msg = util.toBytes(message[0]), message[1], message[2:]
+        if self.hedgeQuantile is not None:
+            # latency of every request, hedged or not: counting only the
+            # ones replied before hedging would keep lowering the delay
+            state = self._retrying.get(msg_id)
+            if state is not None:
+                self._addLatency(
+                    self.factory.reactor.seconds() - state.firstSent)
+        d = self._forget(msg_id)
+        if d is None:
+            if msg_id in self._duplicates:
+                self.duplicateReplies += 1
+            else:
+                log.msg("Reply to unknown request %r dropped in %r" % (
+                    msg_id, self))
+            return
         d.callback(msg)
 
 
 class ZmqXREPConnection(ZmqConnection):
     """
     A XREP connection.
+
+    Routing info of each request is kept until reply is sent. Requests
+    never replied to are forgotten when limits below are hit.
+
+    @cvar routingTimeout: forget routing info of requests not replied to
+        in that many seconds, C{None} for no limit
+    @type routingTimeout: C{float}
+    @cvar maxPendingReplies: maximum number of requests waiting for reply,
+        routing info of oldest requests is forgotten when it is exceeded;
+        C{None} for no limit
+    @type maxPendingReplies: C{int}
+    @ivar expiredReplies: number of requests forgotten because of
+        L{routingTimeout}
+    @type expiredReplies: C{int}
+    @ivar evictedReplies: number of requests forgotten because of
+        L{maxPendingReplies}
+    @type evictedReplies: C{int}
+    @cvar autoReply: if True, value returned by L{gotMessage} (or
+        deferred result) is sent as reply; tuple is sent as multipart
+        reply, C{None} is not sent at all. Failures are replied with
+        L{errorReply}
+    @type autoReply: C{boolean}
+    @cvar maxInFlight: with L{autoReply}, maximum number of requests
+        being handled at once; reading from socket is paused when it is
+        reached, C{None} for no limit
+    @type maxInFlight: C{int}
+    @cvar replyCacheSize: with L{autoReply}, maximum number of replies
+        cached by L{cacheKey} of request, least recently used ones are
+        evicted; identical requests being handled are coalesced into
+        single L{gotMessage} call. C{0} coalesces requests without
+        caching, C{None} disables both. Failures aren't cached
+    @type replyCacheSize: C{int}
+    @cvar replyCacheTTL: time (in seconds) replies are cached for,
+        C{None} for no limit
+    @type replyCacheTTL: C{float}
+    @ivar cacheHits: number of requests replied from cache
+    @type cacheHits: C{int}
+    @ivar cacheMisses: number of requests passed to L{gotMessage}
+    @type cacheMisses: C{int}
+    @ivar cacheEvictions: number of replies evicted from full cache
+    @type cacheEvictions: C{int}
+    @ivar coalescedRequests: number of requests coalesced with identical
+        one being handled
+    @type coalescedRequests: C{int}
     """
     socketType = constants.XREP
+    routingTimeout = None
+    maxPendingReplies = None
+    autoReply = False
+    maxInFlight = None
+    replyCacheSize = None
+    replyCacheTTL = None
 
     def __init__(self, factory, *endpoints):
         ZmqConnection.__init__(self, factory, *endpoints)
-        self._routing_info = {}  # keep track of routing info
+        # message id -> (routing info, time received), oldest first
+        self._routing_info = OrderedDict()
+        self.expiredReplies = 0
+        self.evictedReplies = 0
+        self._inFlight = 0
+        self._backlog = deque()
+        self._runningBacklog = False
+        # cache key -> (expiration time, reply), least recently used first
+        self._replyCache = OrderedDict()
+        # cache key -> ids of identical requests being handled
+        self._coalesced = {}
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.cacheEvictions = 0
+        self.coalescedRequests = 0
 
     def reply(self, message_id, *message_parts):
         """
         Send L{message} with specified L{tag}.
 
+        Reply to request which is unknown (or forgotten) is dropped.
+
         @param message_id: message uuid
         @type message_id: C{str}
         @param message: message data
         @type message: C{str}
         """
-        routing_info = self._routing_info[message_id]
-        self.send(routing_info + [message_id, ''] + list(message_parts))
+        routing = self._routing_info.pop(message_id, None)
+        if routing is None:
+            log.msg("Reply to unknown request %r dropped in %r" % (
+                message_id, self))
+            return
+        routing_info = list(routing[0])
+        sent = self._sendPayloads(
+            [routing_info + [message_id, '']], [message_parts], operator.add)
+        if sent is not None:
+            sent.addErrback(log.err, "Failed to send reply in %r" % (self,))
+
+    def _splitPayload(self, message):
+        """
+        Split message into routing info, message id, delimiter and payload.
+
+        @param message: message data
+        @type message: C{list}
+        """
+        i = map(len, message).index(0)
+        return message[:i + 1], message[i + 1:]
 
     def messageReceived(self, message):
         """
@@ -76,18 +592,230 @@ class ZmqXREPConnection(ZmqConnection):
 
         @param message: message data
         """
-        i = message.index('')
+        i = 0
+        while len(message[i]):
+            i += 1
         assert i > 0
         (routing_info, msg_id, payload) = (
-            message[:i - 1], message[i - 1], message[i + 1:])
+            map(util.toBytes, message[:i - 1]), util.toBytes(message[i - 1]),
+            message[i + 1:])
         msg_parts = payload[0:]
-        self._routing_info[msg_id] = routing_info
-        self.gotMessage(msg_id, *msg_parts)
+        routing_info = tuple(routing_info)
+        self._addRouting(msg_id, routing_info)
+        if self.autoReply:
+            if self.replyCacheSize is None:
+                self._handle(routing_info, msg_id, msg_parts)
+            else:
+                self._handleCached(routing_info, msg_id, msg_parts)
+        elif self.executor is None:
+            self.gotMessage(msg_id, *msg_parts)
+        else:
+            d = self._callHandler(
+                routing_info, self.gotMessage, msg_id, *msg_parts)
+            d.addErrback(log.err, "Request handler failed in %r" % (self,))
+
+    def _addRouting(self, message_id, routing_info):
+        """
+        Remember routing info of request, forgetting expired and excess
+        requests.
+
+        @param message_id: message id
+        @type message_id: C{str}
+        @param routing_info: routing info
+        @type routing_info: C{tuple}
+        """
+        routing = self._routing_info
+        now = None
+        if self.routingTimeout is not None:
+            now = self.factory.reactor.seconds()
+            expired = now - self.routingTimeout
+            while routing and next(routing.itervalues())[1] <= expired:
+                routing.popitem(False)
+                self.expiredReplies += 1
+        routing.pop(message_id, None)
+        routing[message_id] = (routing_info, now)
+        if self.maxPendingReplies is not None:
+            while len(routing) > self.maxPendingReplies:
+                routing.popitem(False)
+                self.evictedReplies += 1
+
+    def _handleCached(self, routing_info, message_id, message_parts):
+        """
+        Reply from cache, wait for identical request being handled, or
+        handle request.
+
+        @param routing_info: routing info
+        @type routing_info: C{tuple}
+        @param message_id: message id
+        @type message_id: C{str}
+        @param message_parts: message data
+        @type message_parts: C{list}
+        """
+        key = self.cacheKey(message_parts)
+        cache = self._replyCache
+        entry = cache.pop(key, None)
+        if entry is not None:
+            expires, reply = entry
+            if expires is None or expires > self.factory.reactor.seconds():
+                cache[key] = entry
+                self.cacheHits += 1
+                if reply is not None:
+                    self.reply(message_id, *reply)
+                else:
+                    self._routing_info.pop(message_id, None)
+                return
+        waiting = self._coalesced.get(key)
+        if waiting is not None:
+            self.coalescedRequests += 1
+            # copies of the same request (e.g. retried) are replied once
+            if message_id not in waiting:
+                waiting.append(message_id)
+            return
+        self.cacheMisses += 1
+        self._coalesced[key] = [message_id]
+        self._handle(routing_info, message_id, message_parts, key)
+
+    def _cacheReply(self, key, reply):
+        """
+        Cache reply, evicting least recently used ones.
+        """
+        if not self.replyCacheSize:
+            return
+        expires = None
+        if self.replyCacheTTL is not None:
+            expires = self.factory.reactor.seconds() + self.replyCacheTTL
+        cache = self._replyCache
+        cache[key] = (expires, reply)
+        while len(cache) > self.replyCacheSize:
+            cache.popitem(False)
+            self.cacheEvictions += 1
+
+    def clearReplyCache(self):
+        """
+        Forget all the cached replies.
+        """
+        self._replyCache.clear()
+
+    def cacheKey(self, message_parts):
+        """
+        Build reply cache key of request.
+
+        Default key is tuple of payload parts (encoded with L{codec}, if
+        it is set, so they could be hashed).
+
+        @param message_parts: message data
+        @type message_parts: C{list}
+        @return: hashable key, requests with equal keys get the same reply
+        """
+        if self.codec is not None:
+            return tuple(map(self.codec.encode, message_parts))
+        return tuple(map(util.toBytes, message_parts))
+
+    def _readLimit(self):
+        """
+        Don't read more requests than there is room for in L{maxInFlight},
+        so the rest is left in ZeroMQ queues.
+        """
+        if not self.autoReply or self.maxInFlight is None:
+            return None
+        return self.maxInFlight - self._inFlight
+
+    def _handle(self, routing_info, message_id, message_parts, key=None):
+        """
+        Call L{gotMessage} and reply with its result, or put request
+        to backlog if L{maxInFlight} requests are being handled.
+
+        @param routing_info: routing info, ordering key for L{executor}
+        @type routing_info: C{tuple}
+        @param message_id: message id
+        @type message_id: C{str}
+        @param message_parts: message data
+        @type message_parts: C{list}
+        @param key: reply cache key, if reply is cached
+        """
+        if self.maxInFlight is not None:
+            if self._inFlight >= self.maxInFlight:
+                self._backlog.append(
+                    (routing_info, message_id, message_parts, key))
+                return
+            if self._inFlight + 1 >= self.maxInFlight:
+                self.pauseReading()
+        self._inFlight += 1
+        d = self._callHandler(
+            routing_info, self.gotMessage, message_id, *message_parts)
+        d.addCallbacks(self._handled, self._handlerFailed,
+                       callbackArgs=(message_id, key),
+                       errbackArgs=(message_id, key))
+        d.addErrback(log.err, "Failed to reply in %r" % (self,))
+        d.addCallback(self._handlerDone)
+
+    def _handled(self, result, message_id, key):
+        """
+        Reply with result of L{gotMessage}.
+        """
+        if result is not None and not isinstance(result, tuple):
+            result = (result,)
+        message_ids = [message_id]
+        if key is not None:
+            message_ids = self._coalesced.pop(key)
+            self._cacheReply(key, result)
+        if result is None:
+            # no reply, forget routing info
+            for request_id in message_ids:
+                self._routing_info.pop(request_id, None)
+            return
+        for request_id in message_ids:
+            self.reply(request_id, *result)
+
+    def _handlerFailed(self, failure, message_id, key):
+        """
+        Log failure of L{gotMessage} and reply with L{errorReply}.
+        """
+        log.err(failure, "Request handler failed in %r" % (self,))
+        message_ids = [message_id]
+        if key is not None:
+            message_ids = self._coalesced.pop(key)
+        reply = self.errorReply(failure)
+        for request_id in message_ids:
+            self.reply(request_id, *reply)
+
+    def _handlerDone(self, _):
+        """
+        Start handling requests from backlog, resume reading when there
+        is room for more requests.
+        """
+        self._inFlight -= 1
+        if self.factory is None or self._runningBacklog:
+            return
+        self._runningBacklog = True
+        try:
+            while self._backlog and self._inFlight < self.maxInFlight:
+                self._handle(*self._backlog.popleft())
+        finally:
+            self._runningBacklog = False
+        if self.maxInFlight is None or self._inFlight < self.maxInFlight:
+            self.resumeReading()
+
+    def errorReply(self, failure):
+        """
+        Build reply to request which handler failed (with L{autoReply}).
+
+        @param failure: reason
+        @type failure: L{Failure}
+        @return: reply message parts
+        @rtype: C{tuple}
+        """
+        return ('ERROR', util.buildErrorMessage(failure.value))
 
     def gotMessage(self, message_id, *message_parts):
         """
         Called on incoming message.
 
+        With L{autoReply}, should return reply (or deferred firing with
+        it), otherwise should call L{reply}. When run in L{executor},
+        it should return reply (L{autoReply} has to be set) or call
+        L{reply} via C{reactor.callFromThread}.
+
         @param message_parts: message data
         @param tag: message tag
         """